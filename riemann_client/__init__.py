@@ -3,7 +3,12 @@
 from .client import Client, QueuedClient
 from .transport import (
     BlankTransport,
+    PipelinedTCPTransport,
+    PooledTCPTransport,
+    PooledTLSTransport,
+    PooledTransport,
     RiemannError,
+    ShardedTransport,
     SocketTransport,
     TCPTransport,
     TLSTransport,
@@ -22,8 +27,13 @@ __all__ = (
     "AutoFlushingQueuedClient",
     "BlankTransport",
     "Client",
+    "PipelinedTCPTransport",
+    "PooledTCPTransport",
+    "PooledTLSTransport",
+    "PooledTransport",
     "QueuedClient",
     "RiemannError",
+    "ShardedTransport",
     "SocketTransport",
     "TCPTransport",
     "TLSTransport",
@@ -0,0 +1,330 @@
+"""Asyncio versions of the clients and transports, for use inside an event
+loop. The API mirrors :py:mod:`riemann_client.client` and
+:py:mod:`riemann_client.transport`, except that any method that communicates
+with the Riemann server is a coroutine.
+
+    >>> async with AsyncClient(AsyncTCPTransport()) as client:
+    ...     await client.event(service='riemann-client', state='awesome')
+    ...     await client.query('true')
+
+Requires Python 3.7 or above.
+"""
+
+import abc
+import asyncio
+import collections
+import ssl
+import struct
+
+from . import riemann_pb2
+from .client import Client
+from .transport import (
+    HOST, MAX_DATAGRAM_SIZE, PORT, TIMEOUT, RiemannError, create_ssl_context)
+from .wire import split_message
+
+__all__ = (
+    'AsyncClient', 'AsyncQueuedClient', 'AsyncTransport',
+    'AsyncUDPTransport', 'AsyncTCPTransport', 'AsyncTLSTransport',
+)
+
+
+class AsyncTransport(abc.ABC):
+    """Abstract asyncio transport definition
+
+    Subclasses must implement the :py:meth:`.connect`, :py:meth:`.disconnect`
+    and :py:meth:`.send` coroutines.
+
+    Can be used as an asynchronous context manager, which will call
+    :py:meth:`.connect` on entry and :py:meth:`.disconnect` on exit.
+    """
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+    @abc.abstractmethod
+    async def connect(self):
+        pass
+
+    @abc.abstractmethod
+    async def disconnect(self):
+        pass
+
+    @abc.abstractmethod
+    async def send(self, message):
+        pass
+
+
+class AsyncUDPTransport(AsyncTransport):
+    def __init__(self, host=HOST, port=PORT,
+                 max_datagram_size=MAX_DATAGRAM_SIZE):
+        """Communicates with Riemann over UDP using a datagram endpoint
+
+        :param str host: The hostname to send to
+        :param int port: The port to send to
+        :param int max_datagram_size: The maximum size of a datagram in bytes,
+            larger messages are split as by :py:class:`.UDPTransport`
+        """
+        self.host = host
+        self.port = port
+        self.max_datagram_size = max_datagram_size
+        self.transport = None
+
+    async def connect(self):
+        """Creates a datagram endpoint"""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=(self.host, self.port))
+
+    async def disconnect(self):
+        """Closes the datagram endpoint"""
+        self.transport.close()
+
+    async def send(self, message):
+        """Sends a message, but does not return a response
+
+        :returns: None - can't receive a response over UDP
+        """
+        if self.transport is None:
+            raise RuntimeError("Transport has not been connected!")
+        data = message.SerializeToString()
+        for datagram in split_message(data, self.max_datagram_size):
+            self.transport.sendto(datagram)
+        return None
+
+
+class AsyncTCPTransport(AsyncTransport):
+    def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT):
+        """Communicates with Riemann over TCP using asyncio streams
+
+        Concurrent sends from several tasks are written back to back on the
+        same connection, and each response is matched to the oldest waiting
+        send, as Riemann responds to messages in the order it receives them.
+
+        :param str host: The hostname to connect to
+        :param int port: The port to connect to
+        :param int timeout: The time in seconds to wait before raising an error
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self._pending = collections.deque()
+        self._read_task = None
+        self._error = None
+
+    def ssl_context(self):
+        """:returns: The SSL context used to wrap the connection, or None"""
+        return None
+
+    async def connect(self):
+        """Connects to the given host and starts reading responses"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl_context()),
+            self.timeout)
+        self._error = None
+        self._read_task = asyncio.ensure_future(
+            self._read_responses(self.reader))
+
+    async def disconnect(self):
+        """Closes the connection"""
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        await asyncio.gather(self._read_task, return_exceptions=True)
+
+    async def send(self, message):
+        """Sends a message to a Riemann server and returns it's response
+
+        :param message: The message to send to the Riemann server
+        :returns: The response message from Riemann
+        :raises RiemannError: if the server returns an error
+        """
+        if self.writer is None:
+            raise RuntimeError("Transport has not been connected!")
+        if self._error is not None:
+            raise self._error
+        payload = message.SerializeToString()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self.writer.writelines((struct.pack('!I', len(payload)), payload))
+        await self.writer.drain()
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    async def _read_responses(self, reader):
+        """Resolves pending sends as responses are read from the stream"""
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                response = riemann_pb2.Msg.FromString(
+                    await reader.readexactly(struct.unpack('!I', header)[0]))
+                future = self._pending.popleft()
+                if future.done():
+                    continue
+                if response.ok:
+                    future.set_result(response)
+                else:
+                    future.set_exception(RiemannError(response.error))
+        except Exception as error:
+            if not isinstance(error, OSError):
+                error = ConnectionError("Invalid response: {0}".format(error))
+            self._error = error
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+
+class AsyncTLSTransport(AsyncTCPTransport):
+    def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT, ca_certs=None,
+                 keyfile=None, certfile=None):
+        """Communicates with Riemann over TCP + TLS using asyncio streams
+
+        Options are the same as :py:class:`.AsyncTCPTransport` unless noted
+
+        :param str ca_certs: Path to a CA Cert bundle used to create the socket
+        :param str keyfile:  Path to a client key file
+        :param str certfile: Path to a client certificate file
+        """
+        super().__init__(host, port, timeout)
+        self.ca_certs = ca_certs
+        self.keyfile = keyfile
+        self.certfile = certfile
+
+    def ssl_context(self):
+        """:returns: The SSL context shared with :py:class:`.TLSTransport`"""
+        return create_ssl_context(self.ca_certs, self.keyfile, self.certfile)
+
+
+class AsyncClient(object):
+    """An asyncio client for sending events and querying a Riemann server.
+
+    Provides the same methods as :py:class:`riemann_client.client.Client`,
+    with :py:meth:`.send_event`, :py:meth:`.send_events`,
+    :py:meth:`.send_query`, :py:meth:`.event`, :py:meth:`.events` and
+    :py:meth:`.query` being coroutines.
+    """
+
+    create_event = staticmethod(Client.create_event)
+    create_dict = staticmethod(Client.create_dict)
+
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = AsyncTCPTransport()
+        self.transport = transport
+
+    async def __aenter__(self):
+        await self.transport.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.transport.disconnect()
+
+    async def send_events(self, events):
+        """Sends multiple events to Riemann in a single message
+
+        :param events: A list or iterable of ``Event`` objects
+        :returns: The response message from Riemann
+        """
+        message = riemann_pb2.Msg()
+        for event in events:
+            message.events.add().MergeFrom(event)
+        return await self.transport.send(message)
+
+    async def send_event(self, event):
+        """Sends a single event to Riemann
+
+        :param event: An ``Event`` protocol buffer object
+        :returns: The response message from Riemann
+        """
+        return await self.send_events((event,))
+
+    async def events(self, *events):
+        """Sends multiple events in a single message
+
+        :param events: event dictionaries for :py:func:`create_event`
+        :returns: The response message from Riemann
+        """
+        return await self.send_events(self.create_event(e) for e in events)
+
+    async def event(self, **data):
+        """Sends an event, using keyword arguments to create an Event
+
+        :param data: keyword arguments used for :py:func:`create_event`
+        :returns: The response message from Riemann
+        """
+        return await self.send_event(self.create_event(data))
+
+    async def send_query(self, query):
+        """Sends a query to the Riemann server
+
+        :returns: The response message from Riemann
+        """
+        message = riemann_pb2.Msg()
+        message.query.string = query
+        return await self.transport.send(message)
+
+    async def query(self, query):
+        """Sends a query to the Riemann server
+
+        :returns: A list of event dictionaries taken from the response
+        :raises Exception: if used with a :py:class:`.AsyncUDPTransport`
+        """
+        if isinstance(self.transport, AsyncUDPTransport):
+            raise Exception('Cannot query the Riemann server over UDP')
+        response = await self.send_query(query)
+        return [self.create_dict(e) for e in response.events]
+
+
+class AsyncQueuedClient(AsyncClient):
+    """An asyncio client using a queue that can be used to batch send events.
+
+    Events are added to the queue by :py:meth:`.send_event` and
+    :py:meth:`.send_events`, and sent in a single message by awaiting
+    :py:meth:`.flush`.
+    """
+
+    def __init__(self, transport=None):
+        super().__init__(transport)
+        self.clear_queue()
+
+    async def flush(self):
+        """Sends the waiting message to Riemann
+
+        :returns: The response message from Riemann
+        """
+        queue, self.queue = self.queue, riemann_pb2.Msg()
+        try:
+            return await self.transport.send(queue)
+        except Exception:
+            # Put the events back in front of any queued while sending
+            queue.events.extend(self.queue.events)
+            self.queue = queue
+            raise
+
+    async def send_event(self, event):
+        """Adds a single event to the queued message
+
+        :returns: None - nothing has been sent to the Riemann server yet
+        """
+        return await self.send_events((event,))
+
+    async def send_events(self, events):
+        """Adds multiple events to the queued message
+
+        :returns: None - nothing has been sent to the Riemann server yet
+        """
+        for event in events:
+            self.queue.events.add().MergeFrom(event)
+        return None
+
+    def clear_queue(self):
+        """Resets the message/queue to a blank :py:class:`.Msg` object"""
+        self.queue = riemann_pb2.Msg()
@@ -0,0 +1,139 @@
+"""Batch policies, which decide how many events
+:py:class:`riemann_client.client.AutoFlushingQueuedClient` sends in each
+batch and how long it holds events for.
+
+A policy is told about each batch after it has been sent, and the client
+reads the policy's :py:attr:`~.BatchPolicy.max_batch_size` and
+:py:attr:`~.BatchPolicy.max_delay` before adding more events::
+
+    client = AutoFlushingQueuedClient(
+        TCPTransport(), batch_policy=AdaptiveBatchPolicy(max_delay=1))
+"""
+
+from __future__ import absolute_import, division
+
+import abc
+import math
+
+
+class BatchPolicy(object):
+    """Abstract batch policy definition
+
+    Subclasses must set ``max_batch_size`` and ``max_delay``, and can change
+    them in :py:meth:`.flushed`, which is only called by one thread at a
+    time.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    #: The number of queued events that causes the queue to be flushed
+    max_batch_size = None
+
+    #: The longest time in seconds between flushes
+    max_delay = None
+
+    @property
+    def idle_delay(self):
+        """The time in seconds between checks of an empty queue, which is
+        ``max_delay`` unless the policy shortens the delay under light
+        traffic"""
+        return self.max_delay
+
+    @abc.abstractmethod
+    def flushed(self, events, interval, latency):
+        """Updates the policy after a batch has been sent
+
+        :param int events: The number of events in the batch
+        :param float interval: The time in seconds since the previous batch
+            was taken from the queue, during which the events were added
+        :param float latency: The time in seconds taken to send the batch and
+            receive the response, or None if it could not be sent
+        """
+        pass
+
+
+class StaticBatchPolicy(BatchPolicy):
+    """A policy that always uses the same limits
+
+    :param int max_batch_size: The number of events to send per batch
+    :param float max_delay: The longest time in seconds to hold events for
+    """
+
+    def __init__(self, max_batch_size=100, max_delay=0.5):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+    def flushed(self, events, interval, latency):
+        pass
+
+
+class AdaptiveBatchPolicy(BatchPolicy):
+    """A policy that sizes batches from the observed arrival rate and
+    round trip latency
+
+    The arrival rate and latency are exponentially weighted moving averages.
+    While fewer than one event arrives per round trip, traffic is light and
+    the queue is flushed after ``min_delay``, so events are sent almost
+    immediately. Under load, batches grow to hold the events that arrive
+    during ``headroom`` round trips, so sending keeps up with the arrival
+    rate, and the delay is the time taken to fill a batch.
+
+    :param int min_batch_size: The smallest batch size used
+    :param int max_batch_size: The largest batch size used
+    :param float min_delay: The shortest delay used, in seconds
+    :param float max_delay: The longest delay used, in seconds
+    :param float alpha: The weight given to each new measurement, between 0
+        and 1
+    :param float headroom: The number of round trips of events each batch
+        holds under load
+    """
+
+    def __init__(self, min_batch_size=10, max_batch_size=1000,
+                 min_delay=0.01, max_delay=0.5, alpha=0.2, headroom=2.0):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be between 0 and 1")
+        self.min_batch_size = min_batch_size
+        self.min_delay = min_delay
+        self.upper_batch_size = max_batch_size
+        self.upper_delay = max_delay
+        self.alpha = alpha
+        self.headroom = headroom
+        self.rate = None
+        self.latency = None
+        # Start with large batches that are flushed soon, which suits both
+        # light and heavy traffic until there are measurements
+        self.max_batch_size = max_batch_size
+        self.max_delay = min_delay
+
+    @property
+    def idle_delay(self):
+        """An empty queue is checked after ``max_delay`` given to the
+        policy, rather than ``min_delay``, so an idle client does not wake
+        up a hundred times a second"""
+        return self.upper_delay
+
+    def average(self, average, sample):
+        if average is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * average
+
+    def flushed(self, events, interval, latency):
+        if interval > 0:
+            self.rate = self.average(self.rate, events / interval)
+        if latency is not None:
+            self.latency = self.average(self.latency, latency)
+        if self.rate is None or self.latency is None:
+            return
+
+        if self.rate * self.latency < 1:
+            self.max_batch_size = self.min_batch_size
+            self.max_delay = self.min_delay
+            return
+        self.max_batch_size = int(min(self.upper_batch_size, max(
+            self.min_batch_size,
+            math.ceil(self.headroom * self.rate * self.latency))))
+        self.max_delay = min(self.upper_delay, max(
+            self.min_delay, self.max_batch_size / self.rate))
+
+
+__all__ = ('AdaptiveBatchPolicy', 'BatchPolicy', 'StaticBatchPolicy')
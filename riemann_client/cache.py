@@ -0,0 +1,196 @@
+"""A cache of query responses, used by :py:class:`riemann_client.client.Client`
+to avoid sending the same query to the Riemann server many times a second::
+
+    client = Client(TCPTransport(), cache=QueryCache(max_age=5))
+
+Responses are kept until the first of their events expires, using each
+event's ``time`` and ``ttl``, or until they are ``max_age`` seconds old. The
+least recently used responses are evicted when the cache holds more than
+``max_entries`` responses or ``max_bytes`` bytes, and threads sending a query
+that is already in flight wait for it's response instead of sending it again.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import os
+import threading
+import time
+from time import monotonic
+
+from .codec import EventView
+from .wire import LENGTH_DELIMITED, MSG_EVENTS, iter_fields
+
+MAX_ENTRIES = 1024
+MAX_BYTES = 64 * 1024 * 1024
+MAX_AGE = 1.0
+
+
+def response_ttl(response, now=None):
+    """Finds the time until the first event in a response expires
+
+    :param bytes response: A serialized ``Msg``
+    :param float now: The current time, defaults to ``time.time()``
+    :returns: The number of seconds until the earliest expiry, or None if no
+        event has a ``ttl``
+    """
+    now = time.time() if now is None else now
+    ttl = None
+    for number, wire_type, value, _, _ in iter_fields(memoryview(response)):
+        if number != MSG_EVENTS or wire_type != LENGTH_DELIMITED:
+            continue
+        event = EventView(value)
+        if 'ttl' not in event:
+            continue
+        expires = event.get('time', now) + event['ttl'] - now
+        if ttl is None or expires < ttl:
+            ttl = expires
+    return ttl
+
+
+class _Request(object):
+    """A query that is in flight, which other threads can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class QueryCache(object):
+    """A thread safe LRU cache of serialized query responses
+
+    :param int max_entries: The maximum number of responses to keep
+    :param int max_bytes: The maximum total size of the responses to keep
+    :param float max_age: The maximum time in seconds to keep a response,
+        or None to only use the events' ``ttl``. Responses with no events
+        with a ``ttl`` are not cached if this is None.
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES,
+                 max_age=MAX_AGE):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = self.misses = 0
+        self.reset()
+
+    def reset(self):
+        """Empties the cache, and forgets queries in flight"""
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.in_flight = {}
+        self.size = 0
+        self.pid = os.getpid()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, query, send):
+        """Returns a cached response, or calls ``send`` to fetch it
+
+        If another thread is already fetching the same query, waits for and
+        returns it's response instead of calling ``send``. Errors raised by
+        ``send`` are raised in every waiting thread, and are not cached.
+
+        :param str query: The query string, which is the cache key
+        :param send: A function returning the serialized response ``Msg``
+        :returns: The serialized response
+        """
+        if self.pid != os.getpid():
+            # Queries in flight in the parent will never complete in the child
+            self.reset()
+
+        with self.lock:
+            response = self.lookup(query)
+            if response is not None:
+                self.hits += 1
+                return response
+            request = self.in_flight.get(query)
+            if request is not None:
+                self.hits += 1
+                owner = False
+            else:
+                self.misses += 1
+                request = self.in_flight[query] = _Request()
+                owner = True
+
+        if not owner:
+            return request.result()
+
+        ttl = None
+        try:
+            request.response = send()
+            # Decoding a large response is slow, so it is not done while
+            # holding the lock
+            ttl = self.ttl(request.response)
+        except Exception as error:
+            request.error = error
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(query, None)
+                if ttl is not None:
+                    self.store(query, request.response, ttl)
+            request.done.set()
+        return request.response
+
+    def lookup(self, query):
+        """:returns: The unexpired response for a query, or None"""
+        entry = self.entries.pop(query, None)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires <= monotonic():
+            self.size -= len(response)
+            return None
+        # Reinsert the entry to mark it as the most recently used
+        self.entries[query] = entry
+        return response
+
+    def ttl(self, response):
+        """:returns: The time in seconds to cache a response for, or None if
+            it should not be cached"""
+        if response is None or len(response) > self.max_bytes:
+            return None
+        ttl = response_ttl(response)
+        if self.max_age is not None:
+            ttl = self.max_age if ttl is None else min(ttl, self.max_age)
+        if ttl is None or ttl <= 0:
+            return None
+        return ttl
+
+    def store(self, query, response, ttl):
+        """Adds a response that expires in ``ttl`` seconds, evicting the
+        least recently used responses if the cache is full"""
+        self.discard(query)
+        self.entries[query] = (monotonic() + ttl, response)
+        self.size += len(response)
+        while len(self.entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, query):
+        """Removes a query's response from the cache"""
+        entry = self.entries.pop(query, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def invalidate(self, query=None):
+        """Removes a query's response, or every response, from the cache"""
+        with self.lock:
+            if query is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self.discard(query)
+
+
+__all__ = ('QueryCache', 'response_ttl')
@@ -15,21 +15,52 @@ except ImportError:
         def emit(self, record):
             pass
 
+import collections
+import itertools
+import os
 import socket
 try:
+    from threading import Condition
+    from threading import Lock
     from threading import RLock
-    from threading import Timer
+    from threading import Thread
+    from threading import current_thread, local
 except ImportError:
+    Condition = None
+    Lock = None
     RLock = None
-    Timer = None
+    Thread = None
+    current_thread = local = None
 import time
+import weakref
 
 from . import riemann_pb2
-from .transport import UDPTransport, TCPTransport
+from .batching import StaticBatchPolicy
+from .codec import (
+    create_dict, create_event, default_codec, encode_columns, event_views)
+from .scheduler import default_scheduler
+from .transport import RiemannError, UDPTransport, TCPTransport
+from .wire import MessageBuffer, SerializedMessage
 
 logger = logging.getLogger(__name__)
 logger.addHandler(NullHandler())
 
+# The default limit on queued events in background mode, so that a slow or
+# unavailable server can't make the queue grow without bound
+BACKGROUND_MAX_QUEUE_SIZE = 10000
+
+# Clients that are reset in the child process after a fork
+_forkable_clients = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for client in list(_forkable_clients):
+        client.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 
 class Client(object):
     """A client for sending events and querying a Riemann server.
@@ -60,12 +91,27 @@ class Client(object):
         ...     # Calls transport.connect()
         ...     client.query('true')
         ...     # Calls transport.disconnect()
+
+    The extended API converts events using a
+    :py:class:`riemann_client.codec.Codec`, which defaults to the fastest
+    codec available.
+
+    Query responses can be shared between callers by passing a
+    :py:class:`riemann_client.cache.QueryCache`, which is used by
+    :py:meth:`.query` and :py:meth:`.send_query`.
     """
 
-    def __init__(self, transport=None):
+    create_event = staticmethod(create_event)
+    create_dict = staticmethod(create_dict)
+
+    def __init__(self, transport=None, codec=None, cache=None):
         if transport is None:
             transport = TCPTransport()
+        if codec is None:
+            codec = default_codec()
         self.transport = transport
+        self.codec = codec
+        self.cache = cache
 
     def __enter__(self):
         self.transport.connect()
@@ -74,36 +120,14 @@ class Client(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.transport.disconnect()
 
-    @staticmethod
-    def create_event(data):
-        """Translates a dictionary of event attributes to an Event object
-
-        :param dict data: The attributes to be set on the event
-        :returns: A protocol buffer ``Event`` object
-        """
-        event = riemann_pb2.Event()
-        event.host = socket.gethostname()
-        event.tags.extend(data.pop('tags', []))
-
-        for key, value in data.pop('attributes', {}).items():
-            attribute = event.attributes.add()
-            attribute.key, attribute.value = key, value
-
-        for name, value in data.items():
-            if value is not None:
-                setattr(event, name, value)
-        return event
-
     def send_events(self, events):
         """Sends multiple events to Riemann in a single message
 
         :param events: A list or iterable of ``Event`` objects
         :returns: The response message from Riemann
         """
-        message = riemann_pb2.Msg()
-        for event in events:
-            message.events.add().MergeFrom(event)
-        return self.transport.send(message)
+        return self.send_serialized_events(
+            event.SerializeToString() for event in events)
 
     def send_event(self, event):
         """Sends a single event to Riemann
@@ -113,6 +137,37 @@ class Client(object):
         """
         return self.send_events((event,))
 
+    def send_serialized_events(self, events):
+        """Sends multiple serialized events to Riemann in a single message
+
+        The events are not decoded, so this is used with
+        :py:class:`riemann_client.template.EventTemplate` to avoid creating a
+        protocol buffer object for each event.
+
+        :param events: A list or iterable of serialized ``Event`` bytes
+        :returns: The response message from Riemann
+        """
+        message = MessageBuffer()
+        for data in events:
+            message.append(data)
+        return self.transport.send(message)
+
+    def send_columns(self, **columns):
+        """Sends events built from columns of values, such as NumPy arrays
+
+        >>> client.send_columns(service='shard', metric=array([1.5, 2.5]),
+        ...                     host=['shard-0', 'shard-1'], tags=['a'])
+
+        Events are serialized directly from the columns, without creating a
+        dictionary or protocol buffer object for each one.
+
+        :param columns: Sequences of event fields, or values used for every
+            event, as described by
+            :py:func:`riemann_client.codec.encode_columns`
+        :returns: The response message from Riemann
+        """
+        return self.send_serialized_events(encode_columns(columns))
+
     def events(self, *events):
         """Sends multiple events in a single message
 
@@ -121,7 +176,8 @@ class Client(object):
          :param events: event dictionaries for :py:func:`create_event`
          :returns: The response message from Riemann
         """
-        return self.send_events(self.create_event(e) for e in events)
+        return self.send_serialized_events(
+            self.codec.encode_event(e) for e in events)
 
     def event(self, **data):
         """Sends an event, using keyword arguments to create an Event
@@ -131,51 +187,79 @@ class Client(object):
         :param data: keyword arguments used for :py:func:`create_event`
         :returns: The response message from Riemann
         """
-        return self.send_event(self.create_event(data))
-
-    @staticmethod
-    def create_dict(event):
-        """Translates an Event object to a dictionary of event attributes
-
-        All attributes are included, so ``create_dict(create_event(input))``
-        may return more attributes than were present in the input.
-
-        :param event: A protocol buffer ``Event`` object
-        :returns: A dictionary of event attributes
-        """
-
-        data = dict()
-
-        for descriptor, value in event.ListFields():
-            if descriptor.name == 'tags':
-                value = list(value)
-            elif descriptor.name == 'attributes':
-                value = dict(((a.key, a.value) for a in value))
-            data[descriptor.name] = value
-
-        return data
+        return self.send_serialized_events((self.codec.encode_event(data),))
 
     def send_query(self, query):
         """Sends a query to the Riemann server
 
         :returns: The response message from Riemann
         """
+        if self.cache is not None:
+            return riemann_pb2.Msg.FromString(
+                self.send_serialized_query(query))
         message = riemann_pb2.Msg()
         message.query.string = query
         return self.transport.send(message)
 
-    def query(self, query):
+    def send_serialized_query(self, query):
+        """Sends a query to the Riemann server, or takes the response from
+        the client's cache
+
+        :returns: The serialized response message from Riemann
+        """
+        data = self.codec.encode_query(query)
+        if self.cache is None:
+            return self.transport.send_serialized(data)
+        return self.cache.get(
+            query, lambda: self.transport.send_serialized(data))
+
+    def query(self, query, lazy=False):
         """Sends a query to the Riemann server
 
         >>> client.query('true')
 
+        :param bool lazy: Return read-only
+            :py:class:`riemann_client.codec.EventView` mappings, which only
+            decode fields as they are accessed, instead of dictionaries
         :returns: A list of event dictionaries taken from the response
         :raises Exception: if used with a :py:class:`.UDPTransport`
         """
         if isinstance(self.transport, UDPTransport):
             raise Exception('Cannot query the Riemann server over UDP')
-        response = self.send_query(query)
-        return [self.create_dict(e) for e in response.events]
+        response = self.send_serialized_query(query)
+        if lazy:
+            return event_views(response)
+        return self.codec.decode_events(response)
+
+    def iter_query(self, query):
+        """Sends a query to the Riemann server, and yields each event as soon
+        as it has been received
+
+        >>> for event in client.iter_query('true'):
+        ...     print(event['service'])
+
+        Only one event is held in memory at a time with a TCP or TLS
+        transport, so this can be used for responses that are too large to
+        hold in memory. If iteration stops early the iterator should be
+        closed, which discards the rest of the response. Streamed responses
+        are never cached.
+
+        :returns: An iterator of event dictionaries
+        :raises Exception: if used with a :py:class:`.UDPTransport`
+        """
+        if isinstance(self.transport, UDPTransport):
+            raise Exception('Cannot query the Riemann server over UDP')
+        return self.decode_stream(self.transport.stream_serialized(
+            self.codec.encode_query(query)))
+
+    def decode_stream(self, events):
+        """Decodes serialized events from an iterator, closing it once
+        iteration stops"""
+        try:
+            for data in events:
+                yield self.codec.decode_event(data)
+        finally:
+            events.close()
 
 
 class QueuedClient(Client):
@@ -183,11 +267,13 @@ class QueuedClient(Client):
 
     A message object is used as a queue, with the :py:meth:`.send_event` and
     :py:meth:`.send_events` methods adding new events to the message and the
-    :py:meth:`.flush` sending the message.
+    :py:meth:`.flush` sending the message. The queue is a
+    :py:class:`riemann_client.wire.MessageBuffer`, so each event is serialized
+    once when it is added, and the queue is sent without being copied.
     """
 
-    def __init__(self, transport=None):
-        super(QueuedClient, self).__init__(transport)
+    def __init__(self, transport=None, codec=None):
+        super(QueuedClient, self).__init__(transport, codec)
         self.clear_queue()
 
     def flush(self):
@@ -213,15 +299,96 @@ class QueuedClient(Client):
         :returns: None - nothing has been sent to the Riemann server yet
         """
         for event in events:
-            self.queue.events.add().MergeFrom(event)
+            self.queue.append(event.SerializeToString())
+        return None
+
+    def send_serialized_events(self, events):
+        """Adds multiple serialized events to the queued message
+
+        :returns: None - nothing has been sent to the Riemann server yet
+        """
+        for data in events:
+            self.queue.append(data)
         return None
 
     def clear_queue(self):
-        """Resets the message/queue to a blank :py:class:`.Msg` object"""
-        self.queue = riemann_pb2.Msg()
+        """Resets the message/queue to an empty message"""
+        self.queue = MessageBuffer()
+
+
+class ThreadBuffers(object):
+    """Serialized events buffered separately by each thread
+
+    Each thread appends to it's own deque, which is thread safe without a
+    lock, and :py:meth:`.take` moves the events from every thread's deque to
+    a single message. Events from one thread stay in order, but events from
+    different threads may be reordered.
+    """
+
+    def __init__(self):
+        self.local = local()
+        self.lock = Lock()
+        self.buffers = []
+        self.added = itertools.count(1)
+        self.last_added = 0
+        self.taken = 0
+        # The average size of a buffered event in the message, in bytes
+        self.event_size = 0
+
+    def __len__(self):
+        """:returns: An estimate of the number of buffered events, which is
+            exact when no thread is adding events"""
+        return max(0, self.last_added - self.taken)
+
+    def byte_size(self):
+        """:returns: An estimate of the size of the buffered events in a
+            message, based on the size of the events taken previously"""
+        return len(self) * self.event_size
+
+    def append(self, data):
+        """Adds a serialized event to the current thread's buffer
+
+        :returns: An estimate of the number of buffered events
+        """
+        try:
+            buffer = self.local.buffer
+        except AttributeError:
+            buffer = self.local.buffer = collections.deque()
+            with self.lock:
+                self.buffers.append((current_thread(), buffer))
+                self.event_size = self.event_size or len(data) + 3
+        buffer.append(data)
+        # Advancing the shared counter is atomic, unlike incrementing an int
+        self.last_added = added = next(self.added)
+        return added - self.taken
+
+    def take(self, message):
+        """Moves every buffered event to the end of a message
 
+        Only one thread may take events at a time.
 
-if RLock and Timer:  # noqa
+        :param message: A :py:class:`riemann_client.wire.MessageBuffer`
+        """
+        with self.lock:
+            buffers = list(self.buffers)
+        taken, size = 0, message.ByteSize()
+        for _, buffer in buffers:
+            while True:
+                try:
+                    message.append(buffer.popleft())
+                except IndexError:
+                    break
+                taken += 1
+        self.taken += taken
+        if taken:
+            self.event_size = (message.ByteSize() - size) // taken
+        with self.lock:
+            # Forget the buffers of threads that have exited
+            self.buffers = [(thread, buffer) for thread, buffer in self.buffers
+                            if buffer or thread.is_alive()]
+
+
+if RLock and Thread:  # noqa
     class AutoFlushingQueuedClient(QueuedClient):
         """A Riemann client using a queue and a timer that will automatically
         flush its contents if either:
@@ -234,6 +401,45 @@ if RLock and Timer:  # noqa
         the next flush.
         if :param clear_on_fail: is True, then the client will discard its
         buffer after the second retry in the event of a socket error.
+        if :param spool: is a :py:class:`riemann_client.spool.Spool`, then
+        batches that could not be sent are written to it instead, and are
+        replayed in the background at up to :param spool_rate: messages per
+        second once a flush succeeds.
+        if :param background: is True, then a single sender thread owns the
+        transport and performs every flush, so threads adding events never
+        wait for the network. :param max_queue_size: limits the number of
+        queued events, and events added while the queue is full are
+        dropped and counted in ``dropped_events``. In background mode the
+        limit defaults to ``BACKGROUND_MAX_QUEUE_SIZE`` events.
+
+        The queue is double buffered: a flush swaps the queue for an empty
+        one while briefly holding ``lock``, and sends the old queue while
+        only holding ``flush_lock``, so other threads can keep adding events
+        to the new queue. A thread that fills the queue while another thread
+        is flushing leaves the flushing thread to send its events, so only
+        one thread at a time waits for the network.
+        if :param thread_buffers: is True, then each thread adds events to a
+        :py:class:`.ThreadBuffers` buffer of it's own without taking ``lock``,
+        and the buffers are merged into one message when the queue is
+        flushed. The batch size and delay limits apply to the total number
+        of buffered events, which is estimated while threads add events.
+
+        The client can be created before a process forks, such as in the
+        master process of a pre-fork server. Each child starts with an empty
+        queue, a rescheduled timer or a new sender thread and no connection,
+        and connects when it first flushes. Events queued before the fork are
+        only sent by the parent, and a spool stays with the parent.
+
+        if :param max_batch_bytes: is set, then the queue is also flushed
+        before an event is added that would take the serialized events past
+        that many bytes, and a flushed batch is sent in messages of no more
+        than that size, unless a single event is larger.
+
+        if :param batch_policy: is a
+        :py:class:`riemann_client.batching.BatchPolicy`, such as an
+        :py:class:`riemann_client.batching.AdaptiveBatchPolicy`, then it sets
+        the batch size and delay after each flush, and
+        :param max_batch_size: and :param max_delay: are ignored.
 
         A message object is used as a queue, and the following methods are
         given:
@@ -248,19 +454,94 @@ if RLock and Timer:  # noqa
         """
 
         def __init__(self, transport, max_delay=0.5, max_batch_size=100,
-                     stay_connected=False, clear_on_fail=False):
-            super(AutoFlushingQueuedClient, self).__init__(transport)
+                     stay_connected=False, clear_on_fail=False, spool=None,
+                     spool_rate=100, background=False, max_queue_size=None,
+                     codec=None, thread_buffers=False, max_batch_bytes=None,
+                     batch_policy=None):
+            super(AutoFlushingQueuedClient, self).__init__(transport, codec)
             self.stay_connected = stay_connected
             self.clear_on_fail = clear_on_fail
-            self.max_delay = max_delay
-            self.max_batch_size = max_batch_size
+            self.spool = spool
+            self.spool_rate = spool_rate
+            self.spool_thread = None
+            if batch_policy is None:
+                batch_policy = StaticBatchPolicy(max_batch_size, max_delay)
+            self.batch_policy = batch_policy
+            self.max_delay = batch_policy.max_delay
+            self.max_batch_size = batch_policy.max_batch_size
+            self.max_batch_bytes = max_batch_bytes
+            if max_queue_size is None and background:
+                max_queue_size = BACKGROUND_MAX_QUEUE_SIZE
+            self.max_queue_size = max_queue_size
+            self.dropped_events = 0
             self.lock = RLock()
+            self.flush_lock = Lock()
+            self.thread_buffers = ThreadBuffers() if thread_buffers else None
             self.event_counter = 0
-            self.last_flush = time.time()
+            self.last_flush = self.batch_started = time.time()
             self.timer = None
 
-            # start the timer
-            self.start_timer()
+            self.background = background
+            self.condition = Condition(self.lock)
+            self.sender_thread = None
+            self.sender_stopping = False
+            self.flush_requested = 0
+            self.flush_completed = 0
+            self.last_response = None
+            self.next_spooled = None
+
+            self.pid = os.getpid()
+            _forkable_clients.add(self)
+
+            if background:
+                self.start_sender()
+            else:
+                # start the timer
+                self.start_timer()
+
+        def check_for_fork(self):
+            """Resets the client if the process has forked without
+            :py:meth:`.after_fork` being called, such as on platforms without
+            ``os.register_at_fork``"""
+            if self.pid != os.getpid():
+                self.after_fork()
+
+        def after_fork(self):
+            """Resets the client in the child process after a fork
+
+            The parent's queued events are discarded, as the parent will send
+            them itself, and the transport's connection is closed without
+            affecting the parent's. Locks are replaced, as they may have been
+            held by threads that do not exist in the child.
+            """
+            self.pid = os.getpid()
+            self.lock = RLock()
+            self.flush_lock = Lock()
+            self.condition = Condition(self.lock)
+            self.clear_queue()
+            if self.thread_buffers is not None:
+                self.thread_buffers = ThreadBuffers()
+            self.event_counter = 0
+            self.dropped_events = 0
+            self.last_flush = self.batch_started = time.time()
+            self.flush_requested = self.flush_completed = 0
+            self.last_response = None
+            self.next_spooled = None
+            self.spool_thread = None
+            if self.spool is not None:
+                # Both processes would replay the same messages
+                logger.warning("Spool detached from the forked process")
+                self.spool = None
+
+            after_fork = getattr(self.transport, 'after_fork', None)
+            if after_fork is not None:
+                after_fork()
+
+            self.timer = None
+            if self.background:
+                self.start_sender()
+            else:
+                self.start_timer()
 
         def connect(self):
             """Connect the transport if it is not already connected."""
@@ -269,13 +550,23 @@ if RLock and Timer:  # noqa
 
         def is_connected(self):
             """Check whether the transport is connected."""
+            is_connected = getattr(self.transport, 'is_connected', None)
+            if is_connected is not None:
+                return is_connected()
             try:
                 # this will throw an exception whenever socket isn't connected
-                self.transport.socket.type
-                return True
+                return self.transport.socket.fileno() != -1
             except (AttributeError, RuntimeError, socket.error):
                 return False
 
+        def disconnect(self):
+            """Disconnect the transport, ignoring errors from a transport
+            that was never connected."""
+            try:
+                self.transport.disconnect()
+            except (RuntimeError, socket.error):
+                pass
+
         def event(self, **data):
             """Enqueues an event, using keyword arguments to create an Event
 
@@ -283,7 +574,7 @@ if RLock and Timer:  # noqa
 
             :param data: keyword arguments used for :py:func:`create_event`
             """
-            self.send_events((self.create_event(data),))
+            self.send_serialized_events((self.codec.encode_event(data),))
 
         def events(self, *events):
             """Enqueues multiple events in a single message
@@ -294,7 +585,8 @@ if RLock and Timer:  # noqa
              :param events: event dictionaries for :py:func:`create_event`
              :returns: The response message from Riemann
             """
-            self.send_events(self.create_event(evd) for evd in events)
+            self.send_serialized_events(
+                self.codec.encode_event(evd) for evd in events)
 
         def send_events(self, events):
             """Enqueues multiple events
@@ -302,67 +594,481 @@ if RLock and Timer:  # noqa
             :param events: A list or iterable of ``Event`` objects
             :returns: The response message from Riemann
             """
+            self.send_serialized_events(
+                event.SerializeToString() for event in events)
+
+        def send_serialized_events(self, events):
+            """Enqueues multiple serialized events
+
+            :param events: A list or iterable of serialized ``Event`` bytes
+            """
+            self.check_for_fork()
+            if self.thread_buffers is not None:
+                self.enqueue_local(events)
+                return
+            events, pending = iter(events), []
+            while self.add_until_ready(events, pending):
+                self.flush_if_ready(full=bool(pending))
+
+        def add_until_ready(self, events, pending):
+            """Adds events to the queue one at a time until it is ready to be
+            flushed, dropping events while the queue is full
+
+            The queue is flushed after releasing ``lock``, so other threads
+            can add events while it is sent. In background mode, the sender
+            thread is woken and events are added until there are none left.
+
+            :param events: An iterator of serialized events
+            :param list pending: An event taken from ``events`` that has not
+                been added, because it would not fit in the queued batch.
+                It is added before the rest of ``events``.
+            :returns: True if the queue should be flushed by this thread
+            """
             with self.lock:
-                for event in events:
-                    self.queue.events.add().MergeFrom(event)
+                if pending:
+                    events = itertools.chain((pending.pop(),), events)
+                for data in events:
+                    if self.queue_full():
+                        self.dropped_events += 1
+                        continue
+                    if not self.background and self.batch_full(data):
+                        pending.append(data)
+                        return True
+                    self.queue.append(data)
                     self.event_counter += 1
+                    if self.flush_due():
+                        if not self.background:
+                            return True
+                        self.condition.notify()
+            return False
+
+        def enqueue_local(self, events):
+            """Adds events to the current thread's buffer, only taking
+            ``lock`` when the queue is full or ready to be flushed"""
+            for data in events:
+                if self.queue_full():
+                    with self.lock:
+                        self.dropped_events += 1
+                    continue
+                buffered = self.thread_buffers.append(data)
+                if self.flush_lock.locked():
+                    # The flushing thread checks the queue again when done
+                    continue
+                if (buffered >= self.max_batch_size or
+                        (self.max_batch_bytes is not None and
+                         self.thread_buffers.byte_size() >=
+                         self.max_batch_bytes) or
+                        time.time() - self.last_flush >= self.max_delay):
                     self.check_for_flush()
 
+        def queued_events(self):
+            """:returns: The number of events waiting to be sent"""
+            if self.thread_buffers is None:
+                return len(self.queue)
+            return len(self.queue) + len(self.thread_buffers)
+
+        def queue_full(self):
+            """Checks if the queue has reached ``max_queue_size``"""
+            return (self.max_queue_size is not None and
+                    self.queued_events() >= self.max_queue_size)
+
         def flush(self):
             """Sends the events in the queue to Riemann in a single protobuf
             message
 
+            In background mode, this asks the sender thread to flush the
+            queue and waits for it to finish.
+
+            :returns: The response message from Riemann
+            """
+            self.check_for_fork()
+            if self.background:
+                return self.wait_for_flush()
+
+            with self.flush_lock:
+                response = self.flush_queue()
+            # Other threads may have filled the queue while this one was
+            # sending, and left this thread to flush it
+            self.flush_if_ready()
+            return response
+
+        def flush_queue(self):
+            """Swaps the queue for an empty one and sends it, while holding
+            ``flush_lock`` but not ``lock``
+
             :returns: The response message from Riemann
             """
-            response = None
             with self.lock:
-                if not self.is_connected():
-                    self.connect()
-                try:
-                    response = super(AutoFlushingQueuedClient, self).flush()
-                except socket.error:
-                    # log and retry
-                    logger.warning("Socket error on flushing. "
-                                   "Attempting reconnect and retry...")
-                    try:
-                        self.transport.disconnect()
-                        self.connect()
-                        response = (
-                            super(AutoFlushingQueuedClient, self).flush())
-                    except Exception:
-                        logger.warning("Socket error on flushing "
-                                       "second attempt. Batch discarded.")
-                        self.transport.disconnect()
-                        if self.clear_on_fail:
-                            self.clear_queue()
-                self.event_counter = 0
-                if not self.stay_connected:
-                    self.transport.disconnect()
-                self.last_flush = time.time()
+                batch = self.take_batch()
+            events, started, response = len(batch), time.time(), None
+            try:
+                response = self.send_batch(batch)
+            finally:
+                with self.lock:
+                    self.batch_sent(events, started, response)
+            if response is not None and self.spool:
+                self.start_spool_thread()
             self.start_timer()
             return response
 
+        def batch_sent(self, events, started, response):
+            """Records a flush, and updates the batch size and delay from
+            the batch policy, while holding ``lock``
+
+            :param int events: The number of events in the batch
+            :param float started: The time the batch started to be sent
+            :param response: The response, or None if it was not sent
+            """
+            self.last_flush = time.time()
+            if not events:
+                # An empty batch says nothing about the latency, and the
+                # time since the last batch is counted in the next one
+                return
+            self.batch_policy.flushed(
+                events, started - self.batch_started,
+                None if response is None else self.last_flush - started)
+            self.batch_started = started
+            self.max_batch_size = self.batch_policy.max_batch_size
+            self.max_delay = self.batch_policy.max_delay
+
+        def flush_if_ready(self, full=False):
+            """Flushes the queue until it is no longer ready to be flushed,
+            unless another thread is already flushing it
+
+            The flushing thread checks the queue again after releasing
+            ``flush_lock``, so events added while it was sending are flushed
+            by that thread.
+
+            :param bool full: Flush the queue even if it is not due yet,
+                because the next event would take it past
+                ``max_batch_bytes``
+            """
+            flushed = False
+            while True:
+                with self.lock:
+                    # Only flush an empty queue once, when the timer is due
+                    if not (full or self.flush_due()) or (
+                            flushed and not self.queued_events()):
+                        return
+                if not self.flush_lock.acquire(False):
+                    return
+                flushed, full = True, False
+                try:
+                    self.flush_queue()
+                finally:
+                    self.flush_lock.release()
+
+        def take_batch(self):
+            """Replaces the queue with an empty message, after moving any
+            events buffered by threads into it
+
+            :returns: The previous queue
+            """
+            if self.thread_buffers is not None:
+                self.thread_buffers.take(self.queue)
+            batch = self.queue
+            self.clear_queue()
+            self.event_counter = 0
+            return batch
+
+        def send_batch(self, batch):
+            """Sends a batch of events, reconnecting and retrying once if
+            there is a socket error
+
+            Batches that fail twice are passed to :py:meth:`.flush_failed`,
+            and batches rejected by the server are discarded.
+
+            :returns: The response message from Riemann, or None if the batch
+                could not be sent
+            :raises RiemannError: if the server returns an error
+            """
+            try:
+                self.connect()
+                return self.send_message(batch)
+            except socket.error:
+                # log and retry
+                logger.warning("Socket error on flushing. "
+                               "Attempting reconnect and retry...")
+                try:
+                    self.disconnect()
+                    self.connect()
+                    return self.send_message(batch)
+                except RiemannError:
+                    raise
+                except Exception:
+                    self.disconnect()
+                    self.flush_failed(batch)
+                    return None
+            finally:
+                if not self.stay_connected:
+                    self.disconnect()
+
+        def send_message(self, batch):
+            """Sends a batch in messages of up to ``max_batch_bytes``
+
+            Events are removed from the batch as each message is sent, so
+            only unsent events are retried if a message fails.
+
+            :returns: The response to the last message
+            """
+            if self.max_batch_bytes is None:
+                return self.transport.send(batch)
+            while True:
+                message = batch.head(self.max_batch_bytes)
+                response = self.transport.send(message)
+                if message is batch:
+                    return response
+                batch.drop(len(message))
+
+        def flush_failed(self, batch):
+            """Spools, discards or requeues a batch after the second attempt
+            to send it has failed
+
+            Only requeueing takes ``lock``, as the spool has a lock of it's
+            own, so threads adding events don't wait for it to be written.
+            """
+            spool = self.spool
+            if spool is not None:
+                logger.warning("Socket error on flushing second attempt. "
+                               "Batch spooled.")
+                spool.append(batch.SerializeToString())
+            elif self.clear_on_fail:
+                logger.warning("Socket error on flushing second attempt. "
+                               "Batch discarded.")
+            else:
+                logger.warning("Socket error on flushing second attempt. "
+                               "Batch kept for the next flush.")
+                with self.lock:
+                    self.requeue(batch)
+
+        def requeue(self, batch):
+            """Puts a batch back in front of the queue, dropping the oldest
+            events if that exceeds ``max_queue_size``"""
+            batch.extend(self.queue)
+            if self.max_queue_size is not None:
+                excess = len(batch) - self.max_queue_size
+                if excess > 0:
+                    self.dropped_events += excess
+                    batch.drop(excess)
+            self.queue = batch
+
+        def start_spool_thread(self):
+            """Starts replaying the spool in the background, unless it is
+            already being replayed"""
+            with self.lock:
+                if self.spool_thread and self.spool_thread.is_alive():
+                    return
+                self.spool_thread = Thread(target=self.drain_spool)
+                self.spool_thread.daemon = True
+                self.spool_thread.start()
+
+        def drain_spool(self):
+            """Sends spooled messages at up to ``spool_rate`` per second,
+            stopping if the server becomes unavailable again"""
+            while True:
+                with self.flush_lock:
+                    if not self.send_spooled():
+                        return
+                time.sleep(1.0 / self.spool_rate)
+
+        def send_spooled(self):
+            """Sends the oldest spooled message
+
+            :returns: True if there may be more spooled messages to send
+            """
+            message = self.spool.peek()
+            if message is None:
+                return False
+            try:
+                self.connect()
+                self.transport.send(SerializedMessage(message))
+            except RiemannError as error:
+                logger.warning("Spooled message rejected by the server, "
+                               "discarding it: %s", error)
+            except Exception:
+                logger.warning("Error sending spooled message, "
+                               "will retry after the next flush.")
+                self.disconnect()
+                return False
+            finally:
+                if not self.stay_connected:
+                    self.disconnect()
+            self.spool.commit()
+            return True
+
+        def flush_due(self):
+            """Checks the conditions for flushing the queue, while holding
+            ``lock``"""
+            return (self.batch_events() >= self.max_batch_size or
+                    (self.max_batch_bytes is not None and
+                     self.batch_bytes() >= self.max_batch_bytes) or
+                    (time.time() - self.last_flush) >= self.max_delay)
+
+        def batch_full(self, data):
+            """Checks if adding an event would take the queued message past
+            ``max_batch_bytes``, so it should be flushed first, while holding
+            ``lock``
+
+            While another thread is flushing, events are added regardless,
+            and the batch is split into messages when it is sent.
+            """
+            return (self.max_batch_bytes is not None and
+                    len(self.queue) > 0 and
+                    not self.flush_lock.locked() and
+                    self.queue.size_with(data) > self.max_batch_bytes)
+
+        def batch_bytes(self):
+            """:returns: The size of the queued message in bytes, which is
+                estimated for events still in thread buffers"""
+            if self.thread_buffers is None:
+                return self.queue.ByteSize()
+            return self.queue.ByteSize() + self.thread_buffers.byte_size()
+
+        def batch_events(self):
+            """:returns: The number of events added since the last flush"""
+            if self.thread_buffers is None:
+                return self.event_counter
+            return self.event_counter + len(self.thread_buffers)
+
         def check_for_flush(self):
-            """Checks the conditions for flushing the queue"""
-            if (self.event_counter >= self.max_batch_size or
-                    (time.time() - self.last_flush) >= self.max_delay):
-                self.flush()
+            """Flushes the queue if it is ready, or wakes the sender thread
+            in background mode
+
+            An empty queue is not flushed, and the timer is restarted with
+            the batch policy's ``idle_delay`` instead, so an idle client
+            does not send empty messages or wake up every ``max_delay``.
+            Events added once the queue is due are flushed as they are
+            added, so they are not held for the longer delay.
+            """
+            if self.background:
+                with self.lock:
+                    if self.flush_due():
+                        self.condition.notify()
+                return
+            with self.lock:
+                idle = not self.queued_events()
+            if idle:
+                self.start_timer(self.batch_policy.idle_delay)
+            else:
+                self.flush_if_ready()
 
-        def start_timer(self):
+        def start_timer(self, delay=None):
             """Cycle the timer responsible for periodically flushing the queue
+
+            :param float delay: The time in seconds until the queue is
+                checked, which defaults to ``max_delay``
+
+            The timer is a call scheduled with the process-wide
+            :py:class:`riemann_client.scheduler.Scheduler`, so clients share
+            the scheduler's threads instead of starting one each, and a
+            flush that blocks does not delay other clients' timers.
             """
             if self.timer:
                 self.timer.cancel()
-            self.timer = Timer(self.max_delay, self.check_for_flush)
-            self.timer.daemon = True
-            self.timer.start()
+            self.timer = default_scheduler().call_later(
+                self.max_delay if delay is None else delay,
+                self.check_for_flush)
 
         def stop_timer(self):
             """Stops the current timer
 
-            a :py:meth:`.flush` event will reactviate the timer
+            a :py:meth:`.flush` event will reactviate the timer. In background
+            mode there is no timer, and :py:meth:`.stop_sender` stops the
+            sender thread instead.
+            """
+            if self.timer:
+                self.timer.cancel()
+
+        def start_sender(self):
+            """Starts the thread that performs every flush in background
+            mode"""
+            self.sender_stopping = False
+            self.sender_thread = Thread(target=self.run_sender,
+                                        name='riemann-client-sender')
+            self.sender_thread.daemon = True
+            self.sender_thread.start()
+
+        def stop_sender(self, timeout=None):
+            """Flushes any queued events and stops the sender thread"""
+            with self.lock:
+                self.sender_stopping = True
+                self.condition.notify_all()
+            self.sender_thread.join(timeout)
+
+        def wait_for_flush(self):
+            """Asks the sender thread to flush the queue, and waits for it
+
+            :returns: The response message from Riemann
             """
-            self.timer.cancel()
+            with self.lock:
+                self.flush_requested += 1
+                generation = self.flush_requested
+                self.condition.notify_all()
+                while self.flush_completed < generation:
+                    if not self.sender_thread.is_alive():
+                        raise RuntimeError("The sender thread has stopped")
+                    self.condition.wait(self.max_delay)
+                return self.last_response
+
+        def run_sender(self):
+            """Sends batches and spooled messages until stopped"""
+            while True:
+                with self.lock:
+                    batch, generation = self.wait_for_batch()
+                if batch is not None:
+                    self.send_background_batch(batch, generation)
+                elif self.sender_stopping:
+                    return
+                elif not self.send_spooled():
+                    self.next_spooled = None
+                else:
+                    self.next_spooled = time.time() + 1.0 / self.spool_rate
+
+        def wait_for_batch(self):
+            """Waits until the queue should be flushed or a spooled message
+            should be sent
+
+            :returns: A tuple of the batch to send and the flush generation
+                it completes, or ``(None, None)`` if a spooled message is due
+                or the sender is stopping
+            """
+            while True:
+                now = time.time()
+                due = self.last_flush + self.max_delay
+                if (self.flush_requested > self.flush_completed or
+                        self.batch_events() >= self.max_batch_size or
+                        (self.max_batch_bytes is not None and
+                         self.batch_bytes() >= self.max_batch_bytes) or
+                        (self.queued_events() and (
+                            now >= due or self.sender_stopping))):
+                    return self.take_batch(), self.flush_requested
+                if self.sender_stopping:
+                    return None, None
+                if self.next_spooled is not None:
+                    if now >= self.next_spooled:
+                        return None, None
+                    due = min(due, self.next_spooled)
+                if not self.queued_events():
+                    due = max(due, now + self.max_delay)
+                self.condition.wait(max(0, due - now))
+
+        def send_background_batch(self, batch, generation):
+            """Sends a batch from the sender thread and wakes any threads
+            waiting for it in :py:meth:`.flush`"""
+            events, started, response = len(batch), time.time(), None
+            try:
+                response = self.send_batch(batch)
+            except RiemannError as error:
+                logger.warning("Batch rejected by the server: %s", error)
+            except Exception:
+                logger.exception("Unexpected error flushing batch")
+            with self.lock:
+                self.batch_sent(events, started, response)
+                self.last_response = response
+                self.flush_completed = generation
+                if response is not None and self.spool:
+                    self.next_spooled = self.next_spooled or time.time()
+                self.condition.notify_all()
 
 
 __all__ = 'Client', 'QueuedClient', 'AutoFlushingQueuedClient'
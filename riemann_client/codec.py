@@ -0,0 +1,467 @@
+"""Codecs convert event dictionaries to serialized messages and back, and are
+used by :py:class:`riemann_client.client.Client` for it's extended API.
+
+Two codecs are provided: :py:class:`.ProtobufCodec` uses the generated
+``riemann_pb2`` module, and :py:class:`.WireCodec` reads and writes the wire
+format directly, which is much faster when ``protobuf`` is using it's pure
+Python implementation. Clients use whichever is faster in the current
+environment, unless the ``RIEMANN_CLIENT_CODEC`` environment variable is set
+to the name of a codec.
+"""
+
+from __future__ import absolute_import
+
+import abc
+import numbers
+import os
+import socket
+import struct
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from . import riemann_pb2
+from .wire import (
+    FIXED32, FIXED64, LENGTH_DELIMITED, MSG_EVENTS, VARINT,
+    encode_length_delimited, field_encoder, iter_fields)
+
+ENVIRONMENT_VARIABLE = 'RIEMANN_CLIENT_CODEC'
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+def create_event(data):
+    """Translates a dictionary of event attributes to an Event object
+
+    :param dict data: The attributes to be set on the event
+    :returns: A protocol buffer ``Event`` object
+    """
+    event = riemann_pb2.Event()
+    event.host = socket.gethostname()
+    event.tags.extend(data.pop('tags', []))
+
+    for key, value in data.pop('attributes', {}).items():
+        attribute = event.attributes.add()
+        attribute.key, attribute.value = key, value
+
+    for name, value in data.items():
+        if value is not None:
+            setattr(event, name, value)
+    return event
+
+
+def create_dict(event):
+    """Translates an Event object to a dictionary of event attributes
+
+    All attributes are included, so ``create_dict(create_event(input))``
+    may return more attributes than were present in the input.
+
+    :param event: A protocol buffer ``Event`` object
+    :returns: A dictionary of event attributes
+    """
+
+    data = dict()
+
+    for descriptor, value in event.ListFields():
+        if descriptor.name == 'tags':
+            value = list(value)
+        elif descriptor.name == 'attributes':
+            value = dict(((a.key, a.value) for a in value))
+        data[descriptor.name] = value
+
+    return data
+
+
+class Codec(object):
+    """Abstract codec definition
+
+    Subclasses must implement :py:meth:`.encode_event`,
+    :py:meth:`.decode_event`, :py:meth:`.decode_events` and
+    :py:meth:`.encode_query`, and give the codec a ``name``.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    name = None
+
+    @abc.abstractmethod
+    def encode_event(self, data):
+        """Serializes an event dictionary, as :py:func:`.create_event`
+
+        :returns: A serialized ``Event``
+        """
+        pass
+
+    @abc.abstractmethod
+    def decode_event(self, data):
+        """Decodes a serialized ``Event``, as :py:func:`.create_dict`
+
+        :returns: An event dictionary
+        """
+        pass
+
+    @abc.abstractmethod
+    def decode_events(self, data):
+        """Decodes the events in a serialized ``Msg``, as
+        :py:func:`.create_dict`
+
+        :returns: A list of event dictionaries
+        """
+        pass
+
+    @abc.abstractmethod
+    def encode_query(self, query):
+        """:returns: A serialized ``Msg`` containing a query"""
+        pass
+
+
+class ProtobufCodec(Codec):
+    """Converts events using the generated protocol buffer classes"""
+
+    name = 'protobuf'
+
+    def encode_event(self, data):
+        return create_event(dict(data)).SerializeToString()
+
+    def decode_event(self, data):
+        return create_dict(riemann_pb2.Event.FromString(data))
+
+    def decode_events(self, data):
+        message = riemann_pb2.Msg.FromString(data)
+        return [create_dict(event) for event in message.events]
+
+    def encode_query(self, query):
+        message = riemann_pb2.Msg()
+        message.query.string = query
+        return message.SerializeToString()
+
+
+_event_fields = riemann_pb2.Event.DESCRIPTOR.fields_by_name
+_attribute_fields = riemann_pb2.Attribute.DESCRIPTOR.fields_by_name
+
+EVENT_ENCODERS = dict(
+    (name, field_encoder(_event_fields[name])) for name in (
+        'time', 'state', 'service', 'host', 'description', 'ttl',
+        'metric_sint64', 'metric_d', 'metric_f'))
+_encode_tag = field_encoder(_event_fields['tags'])
+_encode_key = field_encoder(_attribute_fields['key'])
+_encode_value = field_encoder(_attribute_fields['value'])
+_encode_query = field_encoder(
+    riemann_pb2.Query.DESCRIPTOR.fields_by_name['string'])
+_ATTRIBUTES = _event_fields['attributes'].number
+_QUERY = riemann_pb2.Msg.DESCRIPTOR.fields_by_name['query'].number
+
+
+def encode_tags(tags):
+    """:returns: The encoded ``tags`` fields for a list of tags"""
+    return b"".join(_encode_tag(tag) for tag in tags)
+
+
+def encode_attributes(attributes):
+    """:returns: The encoded ``attributes`` fields for a dictionary"""
+    return b"".join(
+        encode_length_delimited(_ATTRIBUTES,
+                                _encode_key(key) + _encode_value(value))
+        for key, value in attributes.items())
+
+
+def encode_metric(value):
+    """Encodes a metric as ``metric_sint64`` if it is an integer, and as
+    ``metric_d`` otherwise"""
+    if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+        return EVENT_ENCODERS['metric_sint64'](value)
+    return EVENT_ENCODERS['metric_d'](value)
+
+
+def _column_encoder(name):
+    if name == 'tags':
+        return encode_tags
+    elif name == 'attributes':
+        return encode_attributes
+    elif name == 'metric':
+        return encode_metric
+    elif name in EVENT_ENCODERS:
+        return EVENT_ENCODERS[name]
+    raise AttributeError("Events have no field {0!r}".format(name))
+
+
+def _is_scalar(name, values):
+    if name == 'tags':
+        return not values or not isinstance(values[0], (list, tuple))
+    elif name == 'attributes':
+        return isinstance(values, dict)
+    return isinstance(values, (bytes, type(u''), numbers.Number))
+
+
+def encode_columns(columns):
+    """Serializes events from columns of field values
+
+    Each column is a sequence with one value per event, or a single value
+    used for every event. Sequences with a ``tolist`` method, such as NumPy
+    arrays, are converted with it first. ``tags`` is a list of tags for
+    every event, or a sequence of lists, and ``attributes`` is a dictionary
+    for every event, or a sequence of dictionaries. ``metric`` sets
+    ``metric_sint64`` for integers and ``metric_d`` otherwise. ``None``
+    values are left unset. Single values are only encoded once.
+
+    :param dict columns: Event field names and their values
+    :returns: A list of serialized ``Event`` bytes
+    :raises ValueError: if the sequences have different lengths
+    """
+    columns = dict(columns)
+    if columns.get('host') is None:
+        columns['host'] = socket.gethostname()
+
+    constant, varying, length = [], [], None
+    for name, values in columns.items():
+        if values is None:
+            continue
+        encode = _column_encoder(name)
+        if hasattr(values, 'tolist'):
+            values = values.tolist()
+        if _is_scalar(name, values):
+            constant.append(encode(values))
+            continue
+        if length is None:
+            length = len(values)
+        elif len(values) != length:
+            raise ValueError(
+                "Column {0!r} has {1} values, expected {2}".format(
+                    name, len(values), length))
+        varying.append([b"" if v is None else encode(v) for v in values])
+
+    prefix = b"".join(constant)
+    if not varying:
+        return [prefix]
+    return [prefix + b"".join(row) for row in zip(*varying)]
+
+
+def _decode_string(value):
+    return bytes(value).decode('utf-8')
+
+
+def _decode_int64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _decode_sint64(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _decode_double(value):
+    return struct.unpack('<d', value)[0]
+
+
+def _decode_float(value):
+    return struct.unpack('<f', value)[0]
+
+
+def _decode_attribute(data):
+    key = value = u''
+    for number, wire_type, field, _, _ in iter_fields(data):
+        if number == 1 and wire_type == LENGTH_DELIMITED:
+            key = _decode_string(field)
+        elif number == 2 and wire_type == LENGTH_DELIMITED:
+            value = _decode_string(field)
+    return key, value
+
+
+EVENT_DECODERS = dict(
+    (_event_fields[name].number, (name, wire_type, decode))
+    for name, wire_type, decode in (
+        ('time', VARINT, _decode_int64),
+        ('state', LENGTH_DELIMITED, _decode_string),
+        ('service', LENGTH_DELIMITED, _decode_string),
+        ('host', LENGTH_DELIMITED, _decode_string),
+        ('description', LENGTH_DELIMITED, _decode_string),
+        ('tags', LENGTH_DELIMITED, _decode_string),
+        ('ttl', FIXED32, _decode_float),
+        ('attributes', LENGTH_DELIMITED, _decode_attribute),
+        ('metric_sint64', VARINT, _decode_sint64),
+        ('metric_d', FIXED64, _decode_double),
+        ('metric_f', FIXED32, _decode_float),
+    ))
+
+
+_decoders_by_name = dict(
+    (name, decode) for name, _, decode in EVENT_DECODERS.values())
+
+
+class EventView(Mapping):
+    """A read-only mapping of an event's fields, backed by a serialized
+    ``Event``
+
+    Fields are only decoded when they are accessed, so reading a few fields
+    of many events is much cheaper than creating a dictionary for each one.
+    The keys and values are the same as :py:func:`.create_dict`, which
+    :py:meth:`.to_dict` returns.
+
+    :param data: A serialized ``Event``, usually a memoryview of a response
+    """
+
+    __slots__ = ('data', '_values')
+
+    def __init__(self, data):
+        self.data = data
+        self._values = None
+
+    def _fields(self):
+        """Finds the encoded values of each field, without decoding them"""
+        if self._values is None:
+            values = {}
+            for number, wire_type, value, _, _ in iter_fields(self.data):
+                field = EVENT_DECODERS.get(number)
+                if field is not None and wire_type == field[1]:
+                    values.setdefault(field[0], []).append(value)
+            self._values = values
+        return self._values
+
+    def __getitem__(self, name):
+        values = self._fields()[name]
+        decode = _decoders_by_name[name]
+        if name == 'tags':
+            return [decode(value) for value in values]
+        elif name == 'attributes':
+            return dict(decode(value) for value in values)
+        # The last value of a repeated scalar field is used
+        return decode(values[-1])
+
+    def __iter__(self):
+        return iter(self._fields())
+
+    def __len__(self):
+        return len(self._fields())
+
+    def __repr__(self):
+        return 'EventView({0!r})'.format(self.to_dict())
+
+    def to_dict(self):
+        """:returns: A dictionary of every field in the event"""
+        return dict(self.items())
+
+
+def event_views(data):
+    """Creates views of the events in a serialized ``Msg``
+
+    :returns: A list of :py:class:`.EventView` objects, which keep ``data``
+        alive
+    """
+    return [EventView(value)
+            for number, wire_type, value, _, _ in iter_fields(memoryview(data))
+            if number == MSG_EVENTS and wire_type == LENGTH_DELIMITED]
+
+
+class WireCodec(Codec):
+    """Converts events directly to and from the protocol buffer wire format,
+    without creating protocol buffer objects"""
+
+    name = 'wire'
+
+    def encode_event(self, data):
+        parts = []
+        if data.get('host') is None:
+            parts.append(EVENT_ENCODERS['host'](socket.gethostname()))
+        for name, value in data.items():
+            if value is None:
+                continue
+            elif name == 'tags':
+                parts.append(encode_tags(value))
+            elif name == 'attributes':
+                parts.append(encode_attributes(value))
+            elif name in EVENT_ENCODERS:
+                parts.append(EVENT_ENCODERS[name](value))
+            else:
+                raise AttributeError(
+                    "Events have no field {0!r}".format(name))
+        return b"".join(parts)
+
+    def decode_events(self, data):
+        return [self.decode_event(value)
+                for number, wire_type, value, _, _ in iter_fields(data)
+                if number == MSG_EVENTS and wire_type == LENGTH_DELIMITED]
+
+    def decode_event(self, data):
+        event = {}
+        for number, wire_type, value, _, _ in iter_fields(data):
+            if number not in EVENT_DECODERS:
+                continue
+            name, expected_wire_type, decode = EVENT_DECODERS[number]
+            if wire_type != expected_wire_type:
+                continue
+            if name == 'tags':
+                event.setdefault(name, []).append(decode(value))
+            elif name == 'attributes':
+                key, value = decode(value)
+                event.setdefault(name, {})[key] = value
+            else:
+                event[name] = decode(value)
+        return event
+
+    def encode_query(self, query):
+        return encode_length_delimited(_QUERY, _encode_query(query))
+
+
+CODECS = dict((codec.name, codec) for codec in (ProtobufCodec, WireCodec))
+
+_sample_event = {
+    'host': 'localhost', 'service': 'riemann-client', 'state': 'ok',
+    'metric_f': 1.5, 'ttl': 60, 'tags': ['a', 'b'],
+    'attributes': {'key': 'value'},
+}
+
+
+def benchmark(codec, iterations=20):
+    """Times encoding an event, and decoding a message containing it
+
+    :returns: The time taken in seconds
+    """
+    response = riemann_pb2.Msg()
+    response.ok = True
+    response.events.add().MergeFrom(create_event(dict(_sample_event)))
+    response = response.SerializeToString()
+
+    start = _clock()
+    for _ in range(iterations):
+        codec.encode_event(_sample_event)
+        codec.decode_events(response)
+    return _clock() - start
+
+
+def select_codec():
+    """Chooses the codec named by ``RIEMANN_CLIENT_CODEC``, or the fastest
+
+    :returns: A :py:class:`.Codec` instance
+    """
+    name = os.environ.get(ENVIRONMENT_VARIABLE)
+    if name:
+        try:
+            return CODECS[name]()
+        except KeyError:
+            raise ValueError("Unknown codec {0!r}, expected one of {1}".format(
+                name, ', '.join(sorted(CODECS))))
+    return min((codec() for codec in CODECS.values()),
+               key=lambda codec: min(benchmark(codec) for _ in range(3)))
+
+
+_default_codec = None
+
+
+def default_codec():
+    """:returns: The codec used by clients, selected when first needed"""
+    global _default_codec
+    if _default_codec is None:
+        _default_codec = select_codec()
+    return _default_codec
+
+
+__all__ = (
+    'Codec', 'ProtobufCodec', 'WireCodec', 'create_event', 'create_dict',
+    'encode_columns', 'EventView', 'event_views', 'default_codec',
+    'select_codec',
+)
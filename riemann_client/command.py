@@ -3,12 +3,14 @@
 from __future__ import absolute_import, print_function
 
 import json
+import signal
 import sys
 
 import click
 
 from . import __version__
 from .client import Client
+from .relay import LISTEN_HOST, LISTEN_PORT, Relay
 from .transport import (
     RiemannError, UDPTransport, TCPTransport,
     TLSTransport, BlankTransport
@@ -149,3 +151,49 @@ def query(transport, query):
     """Query the Riemann server"""
     with CommandLineClient(transport) as client:
         echo_event(client.query(query))
+
+
+@main.command()
+@click.option('--listen-host', type=click.STRING, default=LISTEN_HOST,
+              help="Address to receive UDP datagrams on.")
+@click.option('--listen-port', type=click.INT, default=LISTEN_PORT,
+              help="Port to receive UDP datagrams on.")
+@click.option('--udp/--no-udp', 'udp', default=True,
+              help="Receive events over UDP.")
+@click.option('--unix-socket', type=click.Path(),
+              help="Path of a Unix datagram socket to receive events on.")
+@click.option('--json/--no-json', 'json_lines', default=False,
+              help="Also accept JSON events, one per line.")
+@click.option('--batch-size', type=click.INT, default=1000,
+              help="Number of events to send upstream in each message.")
+@click.option('--delay', type=click.FLOAT, default=1.0,
+              help="Maximum time in seconds to hold events before sending.")
+@click.option('--queue-size', type=click.INT, default=100000,
+              help="Number of events to hold before dropping new ones.")
+@click.pass_obj
+def relay(transport, listen_host, listen_port, udp, unix_socket, json_lines,
+          batch_size, delay, queue_size):
+    """Relay events from local processes to Riemann in large batches
+
+    Events sent to the relay as protocol buffer datagrams, over UDP or a Unix
+    socket, are queued and forwarded over a single connection using the
+    configured transport.
+    """
+    if not udp and unix_socket is None:
+        raise click.UsageError('--no-udp requires --unix-socket')
+    server = Relay(
+        transport,
+        udp_address=(listen_host, listen_port) if udp else None,
+        unix_path=unix_socket,
+        json_lines=json_lines,
+        max_batch_size=batch_size,
+        max_delay=delay,
+        max_queue_size=queue_size)
+    server.bind()
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
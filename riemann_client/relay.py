@@ -0,0 +1,147 @@
+"""A local relay that receives events from many short-lived processes and
+forwards them to Riemann in large batches over a single connection. Used by
+``riemann-client relay``.
+
+Processes send ``Msg`` protocol buffers as datagrams, over UDP or a Unix
+datagram socket, exactly as they would to Riemann with a
+:py:class:`riemann_client.transport.UDPTransport`. Datagrams can optionally
+contain JSON objects, one event per line, with the same keys accepted by
+:py:meth:`riemann_client.client.Client.create_event`.
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import selectors
+import socket
+
+from .client import AutoFlushingQueuedClient
+from .wire import LENGTH_DELIMITED, MSG_EVENTS, iter_fields
+
+logger = logging.getLogger(__name__)
+
+LISTEN_HOST = '127.0.0.1'
+LISTEN_PORT = 5555
+MAX_DATAGRAM = 65535
+
+
+class Relay(object):
+    def __init__(self, transport, udp_address=(LISTEN_HOST, LISTEN_PORT),
+                 unix_path=None, json_lines=False, max_batch_size=1000,
+                 max_delay=1.0, max_queue_size=100000):
+        """Relays events received from local sockets to a transport
+
+        Events are queued by an :py:class:`.AutoFlushingQueuedClient` in
+        background mode, so receiving is never blocked by the upstream
+        connection, which is kept open between batches.
+
+        :param transport: The transport used to send events upstream
+        :param udp_address: A ``(host, port)`` tuple to receive UDP datagrams
+            on, or None
+        :param str unix_path: A path to receive Unix datagrams on, or None
+        :param bool json_lines: Also accept datagrams containing JSON events
+        :param int max_batch_size: The number of events to send per batch
+        :param float max_delay: The maximum time to hold events for
+        :param int max_queue_size: The number of events to hold before
+            dropping new ones
+        """
+        self.udp_address = udp_address
+        self.unix_path = unix_path
+        self.json_lines = json_lines
+        self.client = AutoFlushingQueuedClient(
+            transport, max_delay=max_delay, max_batch_size=max_batch_size,
+            stay_connected=True, background=True,
+            max_queue_size=max_queue_size)
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        self.running = False
+
+    def bind(self):
+        """Creates and binds the listening sockets"""
+        if self.udp_address is not None:
+            family = socket.AF_INET6 if ':' in self.udp_address[0] \
+                else socket.AF_INET
+            self.listen(socket.socket(family, socket.SOCK_DGRAM),
+                        self.udp_address)
+        if self.unix_path is not None:
+            if os.path.exists(self.unix_path):
+                os.unlink(self.unix_path)
+            self.listen(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM),
+                        self.unix_path)
+
+    def listen(self, sock, address):
+        sock.bind(address)
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.sockets.append(sock)
+
+    def close(self):
+        """Closes the listening sockets and sends any queued events"""
+        for sock in self.sockets:
+            self.selector.unregister(sock)
+            sock.close()
+        self.sockets = []
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+        self.client.stop_sender()
+        self.client.disconnect()
+
+    def serve_forever(self, poll_interval=0.5):
+        """Relays events until :py:meth:`.stop` is called"""
+        self.running = True
+        while self.running:
+            self.poll(poll_interval)
+
+    def stop(self):
+        """Stops :py:meth:`.serve_forever` after the current poll"""
+        self.running = False
+
+    def poll(self, timeout=None):
+        """Waits for datagrams, and handles every datagram that is waiting"""
+        for key, _ in self.selector.select(timeout):
+            while True:
+                try:
+                    data = key.fileobj.recv(MAX_DATAGRAM)
+                except (BlockingIOError, InterruptedError):
+                    break
+                self.handle_datagram(data)
+
+    def handle_datagram(self, data):
+        """Queues the events contained in a datagram
+
+        Events are queued as they were received, without being decoded.
+        """
+        try:
+            if self.json_lines and data[:1] == b'{':
+                events = [self.client.codec.encode_event(json.loads(line))
+                          for line in data.decode('utf-8').splitlines()
+                          if line.strip()]
+            else:
+                events = self.split_events(data)
+        except Exception as error:
+            logger.warning("Discarding invalid datagram: %s", error)
+            return
+        self.client.send_serialized_events(events)
+
+    @staticmethod
+    def split_events(data):
+        """Finds the serialized events in a ``Msg``
+
+        Each event is checked to be a well formed message, so that one bad
+        datagram can't cause Riemann to reject a whole batch.
+
+        :returns: A list of serialized ``Event`` bytes
+        :raises DecodeError: if the message or an event is malformed
+        """
+        events = []
+        for number, wire_type, value, _, _ in iter_fields(data):
+            if number == MSG_EVENTS and wire_type == LENGTH_DELIMITED:
+                for _ in iter_fields(value):
+                    pass
+                events.append(value)
+        return events
+
+
+__all__ = ('Relay',)
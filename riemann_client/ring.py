@@ -0,0 +1,433 @@
+"""Shared memory ring buffers, used to collect events from many processes on
+the same host and send them to Riemann through a single client.
+
+A :py:class:`.RingCollector` creates a file of fixed size rings, normally in
+``/dev/shm``, which each :py:class:`.RingProducer` maps into memory. Every
+producer process claims a ring of it's own when it starts, so each ring is
+written by one process and read by one collector thread, and events are added
+and removed without any locks or system calls::
+
+    collector = RingCollector(AutoFlushingQueuedClient(TCPTransport()))
+    collector.start()
+
+    # In each worker process, such as after a pre-fork server forks
+    producer = RingProducer(collector.path)
+    producer.event(service='worker', metric_f=1)
+
+Events are dropped, and counted, when a producer's ring is full. Rings are
+claimed with ``fcntl`` locks, which are released when a producer exits, so
+this is only available on POSIX systems.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .codec import create_event, default_codec
+
+logger = logging.getLogger(__name__)
+
+SLOTS = 64
+SLOT_SIZE = 1024 * 1024
+INTERVAL = 0.05
+SHM_DIRECTORY = '/dev/shm'
+
+MAGIC = b'RIEMANN\x01'
+FILE_HEADER = struct.Struct('<8sII')
+FILE_HEADER_SIZE = 64
+# Each ring starts with the producer's counters and the collector's counter
+# on separate cache lines, followed by the ring's data
+HEAD_OFFSET = 0
+DROPPED_OFFSET = 8
+TAIL_OFFSET = 64
+SLOT_HEADER_SIZE = 128
+COUNTER = struct.Struct('<Q')
+LENGTH = struct.Struct('<I')
+
+# The rings claimed by producers in this process, by path
+_claimed = {}
+_claimed_lock = threading.Lock()
+
+# The ring files opened by this process, by path. Closing any descriptor for
+# a file releases every ``lockf`` lock the process holds on it, including
+# other producers' claims, so each file is opened once and only closed when
+# nothing in the process uses it.
+_files = {}
+
+
+def _open_file(path, fd=None):
+    """Returns this process's :py:class:`.RingFile` for a path, opening it if
+    it is not already open, while holding ``_claimed_lock``
+
+    :param int fd: A descriptor for a file the caller has just created,
+        which replaces any file previously opened at the same path
+    """
+    key = os.path.realpath(path)
+    ring_file = _files.get(key)
+    if ring_file is None or fd is not None:
+        if fd is None:
+            fd = os.open(path, os.O_RDWR)
+        ring_file = _files[key] = RingFile(path, fd)
+    ring_file.users += 1
+    return ring_file
+
+
+def _release_file(ring_file):
+    """Closes a :py:class:`.RingFile` once nothing in this process uses it,
+    while holding ``_claimed_lock``"""
+    ring_file.users -= 1
+    if ring_file.users > 0:
+        return
+    key = os.path.realpath(ring_file.path)
+    if _files.get(key) is ring_file:
+        del _files[key]
+    ring_file.close()
+
+
+def _after_fork_in_child():
+    """Forgets the parent's claims, as ``fcntl`` locks are not inherited"""
+    global _claimed_lock
+    _claimed.clear()
+    _claimed_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class RingFile(object):
+    """A memory-mapped file containing a number of rings
+
+    :param int fd: An open file descriptor for the file
+    """
+
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.users = 0
+        self.mmap = mmap.mmap(fd, 0)
+        magic, self.slots, self.slot_size = FILE_HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{0} is not a ring file".format(path))
+
+    @staticmethod
+    def size(slots, slot_size):
+        """:returns: The size in bytes of a file containing ``slots`` rings"""
+        return FILE_HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size)
+
+    def offset(self, slot):
+        """:returns: The offset of a ring's header in the file"""
+        return FILE_HEADER_SIZE + slot * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def read_counter(self, offset):
+        return COUNTER.unpack_from(self.mmap, offset)[0]
+
+    def write_counter(self, offset, value):
+        COUNTER.pack_into(self.mmap, offset, value)
+
+    def close(self):
+        """Unmaps and closes the file"""
+        self.mmap.close()
+        os.close(self.fd)
+
+
+class RingProducer(object):
+    """Adds events to a ring shared with a :py:class:`.RingCollector`
+
+    Provides the same methods for sending events as
+    :py:class:`riemann_client.client.Client`, all of which return None, as
+    events are sent to Riemann by the collector. Only one producer can be
+    created for a ring file in each process, and it can be shared between
+    threads. A producer inherited by a forked process claims a new ring when
+    it is first used.
+
+    :param str path: The path of the collector's ring file
+    :param codec: The :py:class:`riemann_client.codec.Codec` used by
+        :py:meth:`.event` and :py:meth:`.events`
+    :raises RuntimeError: if every ring has been claimed
+    """
+
+    create_event = staticmethod(create_event)
+
+    def __init__(self, path, codec=None):
+        self.codec = codec or default_codec()
+        if fcntl is None:
+            raise RuntimeError("RingProducer requires fcntl")
+        self.lock = threading.Lock()
+        self.pid = None
+        self.slot = None
+        with _claimed_lock:
+            self.check_unclaimed(path)
+            self.file = _open_file(path)
+            try:
+                self.claim()
+            except Exception:
+                _release_file(self.file)
+                raise
+
+    @staticmethod
+    def check_unclaimed(path):
+        """Checks that this process does not already have a producer for a
+        ring file, while holding ``_claimed_lock``"""
+        if os.path.realpath(path) in _claimed:
+            raise RuntimeError(
+                "This process already has a producer for {0}".format(path))
+
+    def claim(self):
+        """Claims a ring that is not used by any other process, while
+        holding ``_claimed_lock``"""
+        key = os.path.realpath(self.file.path)
+        self.check_unclaimed(key)
+        for slot in range(self.file.slots):
+            try:
+                fcntl.lockf(self.file.fd, fcntl.LOCK_EX | fcntl.LOCK_NB,
+                            1, self.file.offset(slot))
+            except (IOError, OSError):
+                continue
+            _claimed[key] = slot
+            break
+        else:
+            raise RuntimeError("Every ring in {0} is in use".format(
+                self.file.path))
+
+        self.pid = os.getpid()
+        self.slot = slot
+        self.base = self.file.offset(slot)
+        self.data = self.base + SLOT_HEADER_SIZE
+        # Only this process writes the head, so it is read once
+        self.head = self.file.read_counter(self.base + HEAD_OFFSET)
+        self.tail = self.file.read_counter(self.base + TAIL_OFFSET)
+
+    @property
+    def dropped(self):
+        """The number of events dropped because the ring was full"""
+        return self.file.read_counter(self.base + DROPPED_OFFSET)
+
+    def send_event(self, event):
+        """Adds a single event to the ring
+
+        :param event: An ``Event`` protocol buffer object
+        """
+        self.send_events((event,))
+
+    def send_events(self, events):
+        """Adds multiple events to the ring, which are made visible to the
+        collector together
+
+        :param events: A list or iterable of ``Event`` objects
+        """
+        self.send_serialized_events(
+            [event.SerializeToString() for event in events])
+
+    def send_serialized_events(self, records):
+        """Adds multiple serialized events to the ring
+
+        :param records: A list or iterable of serialized ``Event`` bytes
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                with _claimed_lock:
+                    self.claim()
+            dropped = 0
+            for record in records:
+                if not self.write(record):
+                    dropped += 1
+            # Publish the head after the records have been written
+            self.file.write_counter(self.base + HEAD_OFFSET, self.head)
+            if dropped:
+                self.file.write_counter(self.base + DROPPED_OFFSET,
+                                        self.dropped + dropped)
+
+    def event(self, **data):
+        """Adds an event to the ring, using keyword arguments to create it
+
+        :param data: keyword arguments used for :py:func:`create_event`
+        """
+        self.send_serialized_events((self.codec.encode_event(data),))
+
+    def events(self, *events):
+        """Adds multiple events to the ring from dictionaries
+
+        :param events: event dictionaries for :py:func:`create_event`
+        """
+        self.send_serialized_events(
+            [self.codec.encode_event(e) for e in events])
+
+    def write(self, record):
+        """Writes a record after the unpublished head
+
+        :returns: False if the ring is full
+        """
+        size = LENGTH.size + len(record)
+        slot_size = self.file.slot_size
+        if self.head + size - self.tail > slot_size:
+            # Only read the collector's counter when the ring looks full
+            self.tail = self.file.read_counter(self.base + TAIL_OFFSET)
+            if self.head + size - self.tail > slot_size:
+                return False
+
+        data = LENGTH.pack(len(record)) + record
+        position = self.head % slot_size
+        first = min(size, slot_size - position)
+        start = self.data + position
+        self.file.mmap[start:start + first] = data[:first]
+        if first < size:
+            self.file.mmap[self.data:self.data + size - first] = data[first:]
+        self.head += size
+        return True
+
+    def close(self):
+        """Releases the ring and unmaps the file"""
+        with _claimed_lock:
+            if self.pid == os.getpid():
+                _claimed.pop(os.path.realpath(self.file.path), None)
+            _release_file(self.file)
+
+
+class RingCollector(object):
+    """Moves events from shared memory rings into a client
+
+    The collector creates the ring file, and a thread started by
+    :py:meth:`.start` drains every ring into ``client`` - normally an
+    :py:class:`.AutoFlushingQueuedClient`, which sends them to Riemann in
+    large batches. Events are passed on without being decoded.
+
+    :param client: The client events are passed to with
+        ``send_serialized_events``
+    :param str path: The path of the ring file to create, defaults to a new
+        file in ``/dev/shm`` or the temporary directory
+    :param int slots: The number of rings, which limits the number of
+        producer processes
+    :param int slot_size: The size in bytes of each ring
+    :param float interval: The time in seconds to wait when every ring is
+        empty
+    """
+
+    def __init__(self, client, path=None, slots=SLOTS, slot_size=SLOT_SIZE,
+                 interval=INTERVAL):
+        self.client = client
+        self.interval = interval
+        if path is None:
+            directory = SHM_DIRECTORY if os.path.isdir(SHM_DIRECTORY) \
+                else tempfile.gettempdir()
+            fd, path = tempfile.mkstemp(
+                prefix='riemann-', suffix='.ring', dir=directory)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, RingFile.size(slots, slot_size))
+            os.write(fd, FILE_HEADER.pack(MAGIC, slots, slot_size))
+            with _claimed_lock:
+                self.file = _open_file(path, fd)
+        except Exception:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def path(self):
+        """The path of the ring file, which is passed to producers"""
+        return self.file.path
+
+    @property
+    def dropped(self):
+        """The total number of events dropped by producers"""
+        return sum(self.file.read_counter(self.file.offset(slot) +
+                                          DROPPED_OFFSET)
+                   for slot in range(self.file.slots))
+
+    def start(self):
+        """Starts draining the rings in a background thread"""
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name='riemann-client-ring-collector')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread, after draining the rings again"""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.drain()
+
+    def close(self):
+        """Stops the collector, and removes the ring file"""
+        self.stop()
+        with _claimed_lock:
+            _release_file(self.file)
+        try:
+            os.unlink(self.file.path)
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                collected = self.drain()
+            except Exception:
+                logger.exception("Error passing events to the client")
+                collected = 0
+            if not collected:
+                self.stopping.wait(self.interval)
+
+    def drain(self):
+        """Passes the events in every ring to the client
+
+        :returns: The number of events collected
+        """
+        records = []
+        for slot in range(self.file.slots):
+            records.extend(self.drain_slot(slot))
+        if records:
+            self.client.send_serialized_events(records)
+        return len(records)
+
+    def drain_slot(self, slot):
+        """Removes every published record from a ring
+
+        :returns: A list of serialized events
+        """
+        base = self.file.offset(slot)
+        head = self.file.read_counter(base + HEAD_OFFSET)
+        tail = self.file.read_counter(base + TAIL_OFFSET)
+        if head == tail:
+            return []
+
+        slot_size, start = self.file.slot_size, base + SLOT_HEADER_SIZE
+        position, size = tail % slot_size, head - tail
+        first = min(size, slot_size - position)
+        data = self.file.mmap[start + position:start + position + first]
+        if first < size:
+            data += self.file.mmap[start:start + size - first]
+        # The records have been copied, so the producer can reuse the space
+        self.file.write_counter(base + TAIL_OFFSET, head)
+
+        records, offset = [], 0
+        while offset < size:
+            length = LENGTH.unpack_from(data, offset)[0]
+            offset += LENGTH.size
+            if offset + length > size:
+                logger.warning("Discarding a truncated record from ring %d",
+                               slot)
+                break
+            records.append(data[offset:offset + length])
+            offset += length
+        return records
+
+
+__all__ = ('RingCollector', 'RingProducer')
@@ -0,0 +1,225 @@
+"""A process-wide scheduler, used by
+:py:class:`riemann_client.client.AutoFlushingQueuedClient` to flush queues
+periodically without starting a new thread for each flush.
+
+Calls are kept in a heap ordered by their deadline, which is watched by a
+single daemon thread that is started when the first call is scheduled::
+
+    call = default_scheduler().call_later(0.5, client.check_for_flush)
+    call.cancel()
+
+Scheduling and cancelling a call take ``O(log n)`` time. Cancelled calls are
+left in the heap until they are reached, and the heap is rebuilt when most
+of it has been cancelled.
+
+The scheduler's thread only waits for deadlines, and due calls are run by a
+small pool of worker threads, so a callback that blocks - such as a flush to
+a server that has stopped responding - does not delay calls for other
+clients. Workers are started when every worker is busy, up to
+``max_workers``, and exit after ``idle_timeout`` seconds without work.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import heapq
+import itertools
+import logging
+import os
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# The heap is only rebuilt once it contains at least this many cancelled calls
+COMPACT_THRESHOLD = 64
+
+MAX_WORKERS = 4
+WORKER_IDLE_TIMEOUT = 60.0
+
+
+class ScheduledCall(object):
+    """A call waiting to be run by a :py:class:`.Scheduler`
+
+    Provides the ``cancel`` and ``is_alive`` methods of ``threading.Timer``.
+    """
+
+    __slots__ = ('scheduler', 'deadline', 'callback', 'cancelled', 'called')
+
+    def __init__(self, scheduler, deadline, callback):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+        self.called = False
+
+    def cancel(self):
+        """Stops the call from being run, if it has not been run yet"""
+        self.scheduler.cancel(self)
+
+    def is_alive(self):
+        """:returns: True if the call is waiting to be run"""
+        return not (self.cancelled or self.called)
+
+
+class Scheduler(object):
+    """Runs callbacks after a delay, using a single daemon thread to wait
+    for deadlines and a pool of worker threads to run the callbacks
+
+    :param int max_workers: The largest number of callbacks run at once
+    :param float idle_timeout: The time in seconds an idle worker waits for
+        another call before exiting
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS,
+                 idle_timeout=WORKER_IDLE_TIMEOUT):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.reset()
+
+    def reset(self):
+        """Forgets every scheduled call, such as in the child process after a
+        fork, where the scheduler's thread does not exist"""
+        lock = threading.Lock()
+        self.condition = threading.Condition(lock)
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled = 0
+        self.thread = None
+        # Due calls waiting for a worker, which share the scheduler's lock
+        self.ready = collections.deque()
+        self.ready_condition = threading.Condition(lock)
+        self.workers = 0
+        self.idle_workers = 0
+        self.pid = os.getpid()
+
+    def __len__(self):
+        """:returns: The number of calls waiting to be run"""
+        with self.condition:
+            return len(self.heap) - self.cancelled
+
+    def call_later(self, delay, callback):
+        """Schedules a function to be called after ``delay`` seconds
+
+        :returns: A :py:class:`.ScheduledCall`, which can be cancelled
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        call = ScheduledCall(self, monotonic() + delay, callback)
+        with self.condition:
+            heapq.heappush(self.heap,
+                           (call.deadline, next(self.counter), call))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='riemann-client-scheduler')
+                self.thread.daemon = True
+                self.thread.start()
+            elif self.heap[0][2] is call:
+                # The thread is waiting for a later deadline
+                self.condition.notify()
+        return call
+
+    def cancel(self, call):
+        """Cancels a call, without removing it from the heap"""
+        with self.condition:
+            if not call.is_alive():
+                return
+            call.cancelled = True
+            self.cancelled += 1
+            if (self.cancelled >= COMPACT_THRESHOLD and
+                    self.cancelled * 2 > len(self.heap)):
+                self.heap = [e for e in self.heap if not e[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def next_call(self):
+        """Waits until the earliest call is due, and removes it from the heap
+
+        Must be called while holding the scheduler's condition.
+        """
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+            if not self.heap:
+                self.condition.wait()
+                continue
+            wait = self.heap[0][0] - monotonic()
+            if wait <= 0:
+                call = heapq.heappop(self.heap)[2]
+                call.called = True
+                return call
+            self.condition.wait(wait)
+
+    def dispatch(self, call):
+        """Passes a due call to an idle worker, starting a worker if every
+        worker is busy
+
+        Must be called while holding the scheduler's condition.
+        """
+        self.ready.append(call)
+        if (len(self.ready) > self.idle_workers and
+                self.workers < self.max_workers):
+            self.workers += 1
+            worker = threading.Thread(target=self.run_worker,
+                                      name='riemann-client-scheduler-worker')
+            worker.daemon = True
+            worker.start()
+        else:
+            self.ready_condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.dispatch(self.next_call())
+
+    def next_ready(self):
+        """Waits for a due call, and removes it from the ready queue
+
+        Must be called while holding the scheduler's condition.
+
+        :returns: The call, or None if the worker has been idle for
+            ``idle_timeout`` seconds and should exit
+        """
+        deadline = monotonic() + self.idle_timeout
+        while not self.ready:
+            wait = deadline - monotonic()
+            if wait <= 0:
+                return None
+            self.idle_workers += 1
+            try:
+                self.ready_condition.wait(wait)
+            finally:
+                self.idle_workers -= 1
+        return self.ready.popleft()
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                call = self.next_ready()
+                if call is None:
+                    self.workers -= 1
+                    return
+            try:
+                call.callback()
+            except Exception:
+                logger.exception("Error in scheduled call %r", call.callback)
+
+
+_scheduler = Scheduler()
+
+
+def default_scheduler():
+    """:returns: The scheduler shared by every client in the process"""
+    return _scheduler
+
+
+def _after_fork_in_child():
+    _scheduler.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+__all__ = ('Scheduler', 'ScheduledCall', 'default_scheduler')
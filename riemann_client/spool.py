@@ -0,0 +1,179 @@
+"""A durable on-disk queue of serialized messages, used by
+:py:class:`riemann_client.client.AutoFlushingQueuedClient` to keep batches
+that could not be sent while the Riemann server was unavailable.
+
+Messages are appended to segment files as length prefixed frames - the same
+framing used by the TCP transport. When a segment reaches ``segment_size`` a
+new one is started, and when the spool exceeds ``max_size`` the oldest
+segments are discarded. Segments are memory-mapped to be replayed, and are
+deleted once every message in them has been sent.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SIZE = 256 * 1024 * 1024
+SUFFIX = '.spool'
+
+
+class Spool(object):
+    """An append-only, segment-rotated queue of messages in a directory
+
+    Messages are delivered at least once: a message is only removed once
+    :py:meth:`.commit` has been called for it, and the read position within
+    a segment is not persisted, so a process that stops part way through a
+    segment will replay that segment from the start.
+
+    :param str directory: The directory to store segments in, which is
+        created if it does not exist. Segments already in the directory are
+        replayed.
+    :param int segment_size: The size in bytes at which to start a new segment
+    :param int max_size: The maximum total size of the spool in bytes
+    :param bool fsync: Sync each message to disk before returning
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 max_size=MAX_SIZE, fsync=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.lock = threading.RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(
+            int(name[:-len(SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit())
+        self.size = sum(os.path.getsize(self.path(s)) for s in self.segments)
+
+        self._writer = None
+        self._writer_segment = None
+        self._reader = None
+        self._offset = 0
+
+    def __len__(self):
+        """:returns: The number of segments waiting to be sent"""
+        return len(self.segments)
+
+    def path(self, segment):
+        """:returns: The path to a segment file"""
+        return os.path.join(self.directory, '{0:020d}{1}'.format(
+            segment, SUFFIX))
+
+    def append(self, data):
+        """Appends a serialized message to the spool
+
+        :param bytes data: A serialized ``Msg``
+        """
+        frame = struct.pack('!I', len(data)) + data
+        with self.lock:
+            writer = self._writer
+            if writer is None or writer.tell() + len(frame) > \
+                    self.segment_size and writer.tell() > 0:
+                writer = self._rotate()
+            writer.write(frame)
+            writer.flush()
+            if self.fsync:
+                os.fsync(writer.fileno())
+            self.size += len(frame)
+            self._enforce_max_size()
+
+    def peek(self):
+        """Reads the oldest message that has not been committed
+
+        :returns: The serialized message, or None if the spool is empty
+        """
+        with self.lock:
+            while self.segments:
+                if self._writer is not None and \
+                        self._writer_segment == self.segments[0]:
+                    # Never read from the segment that is being written to
+                    self._close_writer()
+                if self._reader is None:
+                    self._open_reader()
+                frame = self._read_frame()
+                if frame is not None:
+                    return frame
+                self._delete_oldest()
+            return None
+
+    def commit(self):
+        """Removes the message returned by the last :py:meth:`.peek`"""
+        with self.lock:
+            if self._reader is None:
+                return
+            length = struct.unpack_from('!I', self._reader, self._offset)[0]
+            self._offset += 4 + length
+            if self._offset >= len(self._reader):
+                self._delete_oldest()
+
+    def close(self):
+        """Closes any open segments, leaving them on disk"""
+        with self.lock:
+            self._close_writer()
+            self._close_reader()
+
+    def _rotate(self):
+        self._close_writer()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self._writer = open(self.path(segment), 'ab')
+        self._writer_segment = segment
+        return self._writer
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _open_reader(self):
+        path = self.path(self.segments[0])
+        self._offset = 0
+        if os.path.getsize(path) == 0:
+            self._reader = b""
+            return
+        with open(path, 'rb') as segment:
+            self._reader = mmap.mmap(
+                segment.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_reader(self):
+        if isinstance(self._reader, mmap.mmap):
+            self._reader.close()
+        self._reader = None
+
+    def _read_frame(self):
+        reader, offset = self._reader, self._offset
+        if offset + 4 > len(reader):
+            return None
+        length = struct.unpack_from('!I', reader, offset)[0]
+        if offset + 4 + length > len(reader):
+            logger.warning("Discarding a truncated message from the spool")
+            return None
+        return reader[offset + 4:offset + 4 + length]
+
+    def _delete_oldest(self):
+        self._close_reader()
+        if self._writer is not None and \
+                self._writer_segment == self.segments[0]:
+            self._close_writer()
+        path = self.path(self.segments.pop(0))
+        self.size -= os.path.getsize(path)
+        os.remove(path)
+
+    def _enforce_max_size(self):
+        while self.size > self.max_size and len(self.segments) > 1:
+            logger.warning("Spool exceeded %d bytes, discarding the oldest "
+                           "segment", self.max_size)
+            self._delete_oldest()
+
+
+__all__ = ('Spool',)
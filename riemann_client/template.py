@@ -0,0 +1,78 @@
+"""Event templates, used to send many events that share most of their fields
+without building a protocol buffer object for each one.
+
+    >>> template = EventTemplate(tags=['web'], attributes={'dc': 'eu'}, ttl=60)
+    >>> client.send_serialized_events(
+    ...     template.serialize(service='requests', metric=count)
+    ...     for count in counts)
+"""
+
+from __future__ import absolute_import
+
+from . import riemann_pb2
+from .codec import (
+    EVENT_ENCODERS, create_event, encode_attributes, encode_metric,
+    encode_tags)
+
+
+class EventTemplate(object):
+    """Fields shared by many events, serialized once
+
+    The template's fields are serialized when it is created, and each event
+    only encodes the fields passed to :py:meth:`.serialize`, which are
+    appended to the template's. Fields given for an event replace the
+    template's value, and tags and attributes are added to the template's.
+
+    :param str host: The event host, defaults to the system's hostname
+    :param str service_prefix: A string prepended to each event's service
+    :param tags: Tags added to every event
+    :param dict attributes: Attributes added to every event
+    :param fields: Any other fields shared by every event, such as ``ttl``
+    """
+
+    def __init__(self, host=None, service_prefix='', tags=(),
+                 attributes=None, **fields):
+        fields['tags'] = list(tags)
+        fields['attributes'] = dict(attributes or {})
+        if host is not None:
+            fields['host'] = host
+        self.service_prefix = service_prefix
+        self.data = create_event(fields).SerializeToString()
+
+    def serialize(self, **fields):
+        """Encodes an event from the template and the given fields
+
+        Fields are those of :py:func:`.create_event`, and ``metric`` is
+        also accepted, which sets ``metric_sint64`` for integers and
+        ``metric_d`` otherwise.
+
+        :returns: A serialized ``Event``
+        :raises TypeError: if a field is not an event field
+        """
+        parts = [self.data]
+        for name, value in fields.items():
+            if value is None:
+                continue
+            if name == 'service':
+                parts.append(EVENT_ENCODERS[name](self.service_prefix + value))
+            elif name == 'metric':
+                parts.append(encode_metric(value))
+            elif name == 'tags':
+                parts.append(encode_tags(value))
+            elif name == 'attributes':
+                parts.append(encode_attributes(value))
+            elif name in EVENT_ENCODERS:
+                parts.append(EVENT_ENCODERS[name](value))
+            else:
+                raise TypeError("Unknown event field {0!r}".format(name))
+        return b"".join(parts)
+
+    def create_event(self, **fields):
+        """Creates an event from the template and the given fields
+
+        :returns: A protocol buffer ``Event`` object
+        """
+        return riemann_pb2.Event.FromString(self.serialize(**fields))
+
+
+__all__ = ('EventTemplate',)
@@ -5,25 +5,364 @@ protocol buffer objects."""
 from __future__ import absolute_import
 
 import abc
+import bisect
+import collections
+import errno
+import hashlib
+import os
+import selectors
 import socket
 import ssl
 import struct
+import threading
+from time import monotonic
+
+try:
+    from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import wait as wait_for_futures
+except ImportError:
+    Future = FutureTimeoutError = ThreadPoolExecutor = None
+    wait_for_futures = None
 
 from . import riemann_pb2
+from .wire import FIXED32, FIXED64, LENGTH_DELIMITED, VARINT
+from .wire import MSG_ERROR, MSG_EVENTS, MSG_OK
+from .wire import DecodeError, SerializedMessage, iter_fields, split_message
 
 
 # Default arguments
 HOST = 'localhost'
 PORT = 5555
 TIMEOUT = None
+MAX_IN_FLIGHT = 64
+MAX_CONNECTIONS = 8
+SHARD_FIELDS = ('host', 'service')
+SHARD_REPLICAS = 128
+# A 1500 byte Ethernet MTU, less the IPv6 and UDP headers
+MAX_DATAGRAM_SIZE = 1452
+
+
+# Resolved addresses are cached for this many seconds
+DNS_TTL = 60
+# The time to wait for a connection attempt before starting the next one in
+# parallel, from RFC 8305 (Happy Eyeballs Version 2)
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+# Frames larger than this are read into a temporary buffer, so that one large
+# query response does not pin that much memory to the transport forever
+MAX_RETAINED_BUFFER = 1024 * 1024
+
+# Streamed responses are received in chunks of up to this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 def socket_recvall(socket, length, bufsize=4096):
     """A helper method to read of bytes from a socket to a maximum length"""
-    data = b""
-    while len(data) < length:
-        data += socket.recv(bufsize)
-    return data
+    chunks = []
+    received = 0
+    while received < length:
+        chunk = socket.recv(bufsize)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        received += len(chunk)
+    return b"".join(chunks)
+
+
+def socket_recv_into(sock, view):
+    """Fills a memoryview with data read from a socket
+
+    Reads are made directly into the view, and short reads are retried until
+    the view is full.
+
+    :raises socket.error: if the connection is closed first
+    """
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise socket.error("Connection closed by the server")
+        received += count
+
+
+def socket_sendall_frame(sock, payload):
+    """Sends a length prefixed frame without concatenating its parts
+
+    ``sendmsg`` is used to write the header and payload with a single call
+    where it is available. TLS sockets do not support it, and encrypt data
+    into a new buffer anyway, so the parts are joined for them instead.
+    """
+    header = struct.pack('!I', len(payload))
+    if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join((header, payload)))
+        return
+
+    buffers = [memoryview(header), memoryview(payload)]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][sent:]
+
+
+class FrameBuffer(object):
+    """A reusable buffer that length prefixed frames are received into
+
+    The buffer grows to fit the largest frame received, up to
+    ``MAX_RETAINED_BUFFER`` bytes. The memoryview returned by
+    :py:meth:`.recv_frame` is only valid until the next frame is received.
+    """
+
+    def __init__(self, size=4096):
+        self.header = bytearray(4)
+        self.buffer = bytearray(size)
+
+    def recv_frame(self, sock):
+        """Receives a single frame from a socket
+
+        :returns: A memoryview of the frame's payload
+        """
+        socket_recv_into(sock, memoryview(self.header))
+        length = struct.unpack('!I', bytes(self.header))[0]
+
+        buffer = self.buffer
+        if length > len(buffer):
+            buffer = bytearray(length)
+            if length <= MAX_RETAINED_BUFFER:
+                self.buffer = buffer
+
+        view = memoryview(buffer)[:length]
+        socket_recv_into(sock, view)
+        return view
+
+
+def write_frame(sock, message):
+    """Writes a length prefixed message to a socket
+
+    :param message: A protocol buffer ``Msg`` object, or a
+        :py:class:`.SerializedMessage` which is sent without being copied
+    """
+    if isinstance(message, SerializedMessage):
+        socket_sendall_frame(sock, message.data)
+    else:
+        socket_sendall_frame(sock, message.SerializeToString())
+
+
+def read_frame(sock, buffer):
+    """Reads a length prefixed message from a socket
+
+    :param buffer: The :py:class:`.FrameBuffer` to receive the message into
+    :returns: A protocol buffer ``Msg`` object
+    """
+    response = riemann_pb2.Msg()
+    response.ParseFromString(buffer.recv_frame(sock))
+    return response
+
+
+class ResponseStream(object):
+    """Reads the top level fields of a frame as they are received
+
+    At most one field and one chunk are held in memory at a time, however
+    large the frame is.
+
+    :param sock: The socket to read from, positioned after the frame header
+    :param int length: The length of the frame
+    """
+
+    def __init__(self, sock, length, chunk_size=STREAM_CHUNK_SIZE):
+        self.sock = sock
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def fill(self, size):
+        """Receives data until at least ``size`` bytes are buffered"""
+        del self.buffer[:self.offset]
+        self.offset = 0
+        while len(self.buffer) < size:
+            if not self.remaining:
+                raise DecodeError("Truncated response")
+            chunk = self.sock.recv(min(
+                self.remaining, max(self.chunk_size, size - len(self.buffer))))
+            if not chunk:
+                raise socket.error("Connection closed by the server")
+            self.buffer += chunk
+            self.remaining -= len(chunk)
+
+    def read(self, size):
+        """:returns: The next ``size`` bytes of the frame"""
+        if len(self.buffer) - self.offset < size:
+            self.fill(size)
+        data = bytes(self.buffer[self.offset:self.offset + size])
+        self.offset += size
+        return data
+
+    def read_varint(self):
+        """:returns: The value of the next varint in the frame"""
+        value = shift = 0
+        while True:
+            if self.offset >= len(self.buffer):
+                self.fill(1)
+            byte = self.buffer[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def fields(self):
+        """Reads the fields of the frame
+
+        :returns: An iterator of ``(number, wire_type, value)`` tuples
+        :raises DecodeError: if the frame is not a valid message
+        """
+        while self.remaining or self.offset < len(self.buffer):
+            tag = self.read_varint()
+            number, wire_type = tag >> 3, tag & 0x7
+            if wire_type == VARINT:
+                value = self.read_varint()
+            elif wire_type == LENGTH_DELIMITED:
+                value = self.read(self.read_varint())
+            elif wire_type == FIXED64:
+                value = self.read(8)
+            elif wire_type == FIXED32:
+                value = self.read(4)
+            else:
+                raise DecodeError(
+                    "Unsupported wire type {0}".format(wire_type))
+            yield number, wire_type, value
+
+    def discard(self):
+        """Receives and discards the rest of the frame"""
+        self.buffer, self.offset = bytearray(), 0
+        while self.remaining:
+            chunk = self.sock.recv(min(self.remaining, self.chunk_size))
+            if not chunk:
+                raise socket.error("Connection closed by the server")
+            self.remaining -= len(chunk)
+
+
+class AddressCache(object):
+    """Caches the results of ``getaddrinfo`` for a limited time
+
+    Addresses are returned with address families interleaved, as recommended
+    by RFC 8305, so that a connection attempt to each family is made early.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def resolve(self, host, port, socktype, ttl=DNS_TTL):
+        """Resolves a host and port, using a cached result if it has not
+        expired
+
+        :returns: A list of ``getaddrinfo`` tuples
+        """
+        key = host, port, socktype
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        addresses = socket.getaddrinfo(host, port, 0, socktype)
+        addresses = self.interleave(addresses)
+        with self._lock:
+            self._entries[key] = now + ttl, addresses
+        return addresses
+
+    def invalidate(self, host, port, socktype):
+        """Removes a cached result, so that the next lookup is made again"""
+        with self._lock:
+            self._entries.pop((host, port, socktype), None)
+
+    @staticmethod
+    def interleave(addresses):
+        """Reorders addresses to alternate between address families"""
+        families = collections.OrderedDict()
+        for address in addresses:
+            families.setdefault(address[0], []).append(address)
+        interleaved = []
+        while families:
+            for family in list(families):
+                interleaved.append(families[family].pop(0))
+                if not families[family]:
+                    del families[family]
+        return interleaved
+
+
+resolver = AddressCache()
+
+
+def create_connection(addresses, timeout=None,
+                      delay=CONNECTION_ATTEMPT_DELAY):
+    """Connects to the first of several addresses to accept a connection
+
+    Unlike :py:func:`socket.create_connection`, a new attempt is started
+    every ``delay`` seconds while earlier attempts are still pending, so an
+    unreachable address does not hold up the others (RFC 8305).
+
+    :param addresses: A list of ``getaddrinfo`` tuples
+    :param timeout: The time in seconds to wait for a connection, which is
+        also set as the timeout of the returned socket
+    :returns: A connected socket
+    :raises socket.error: if no address accepted a connection
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    remaining = list(addresses)
+    error = socket.error("No addresses to connect to")
+    selector = selectors.DefaultSelector()
+    try:
+        while remaining or selector.get_map():
+            if remaining:
+                try:
+                    selector.register(
+                        start_connection(remaining.pop(0)),
+                        selectors.EVENT_WRITE)
+                except socket.error as e:
+                    error = e
+                    continue
+
+            wait = delay if remaining else None
+            if deadline is not None:
+                wait = max(0, min(deadline - monotonic(), wait or delay))
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code == 0:
+                    sock.settimeout(timeout)
+                    return sock
+                error = socket.error(code, os.strerror(code))
+                sock.close()
+
+            if deadline is not None and monotonic() >= deadline:
+                raise socket.timeout("Timed out connecting to Riemann")
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    raise error
+
+
+def start_connection(address):
+    """Starts a non-blocking connection to a ``getaddrinfo`` tuple
+
+    :returns: A socket that will become writable once connected
+    """
+    family, socktype, proto, _, sockaddr = address
+    sock = socket.socket(family, socktype, proto)
+    sock.setblocking(False)
+    code = sock.connect_ex(sockaddr)
+    if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        sock.close()
+        raise socket.error(code, os.strerror(code))
+    return sock
 
 
 class RiemannError(Exception):
@@ -31,6 +370,21 @@ class RiemannError(Exception):
     pass
 
 
+def check_response(data):
+    """Checks a serialized response without decoding it's events
+
+    :raises RiemannError: if the response is not ok
+    """
+    ok, error = False, u''
+    for number, wire_type, value, _, _ in iter_fields(memoryview(data)):
+        if number == MSG_OK and wire_type == VARINT:
+            ok = bool(value)
+        elif number == MSG_ERROR and wire_type == LENGTH_DELIMITED:
+            error = bytes(value).decode('utf-8', 'replace')
+    if not ok:
+        raise RiemannError(error)
+
+
 class Transport(object):
     """Abstract transport definition
 
@@ -39,6 +393,9 @@ class Transport(object):
 
     Can be used as a context manager, which will call :py:meth:`.connect` on
     entry and :py:meth:`.disconnect` on exit.
+
+    Subclasses holding connections or threads should override
+    :py:meth:`.after_fork`.
     """
 
     __metaclass__ = abc.ABCMeta
@@ -62,14 +419,79 @@ class Transport(object):
     def send(self, message):
         pass
 
+    def is_connected(self):
+        """Checks if :py:meth:`.connect` has been called and the connection
+        is still open
+
+        Transports that can tell override this, and by default a transport
+        is never reported as connected.
+        """
+        return False
+
+    def send_serialized(self, data):
+        """Sends a serialized message and returns the serialized response
+
+        Transports that can return the response without decoding it override
+        this, so that a :py:class:`riemann_client.codec.Codec` can decode it.
+
+        :param bytes data: A serialized ``Msg``
+        :returns: The serialized response, or None if there is no response
+        :raises RiemannError: if the server returns an error
+        """
+        response = self.send(SerializedMessage(data))
+        if response is None:
+            return None
+        return response.SerializeToString()
+
+    def stream_serialized(self, data):
+        """Sends a serialized message and iterates over the serialized events
+        in the response
+
+        Transports that can decode the response as it is received override
+        this, and by default the whole response is received first.
+
+        :param bytes data: A serialized ``Msg``
+        :returns: An iterator of serialized ``Event`` bytes
+        :raises RiemannError: if the server returns an error
+        """
+        response = self.send_serialized(data)
+        if response is None:
+            return
+        for number, wire_type, value, _, _ in iter_fields(
+                memoryview(response)):
+            if number == MSG_EVENTS and wire_type == LENGTH_DELIMITED:
+                yield value
+
+    def after_fork(self):
+        """Discards state inherited from the parent process after a fork
+
+        Called in the child process, this must not affect the parent's use of
+        any connections, and the transport is connected again when needed.
+        """
+        pass
+
 
 class SocketTransport(Transport):
-    """Provides common methods for Transports that use a sockets"""
+    """Provides common methods for Transports that use a sockets
+
+    Addresses are resolved through a cache shared by all transports, and are
+    reused for ``dns_ttl`` seconds.
+    """
+
+    dns_ttl = DNS_TTL
 
     def __init__(self, host=HOST, port=PORT):
         self.host = host
         self.port = port
 
+    def resolve(self, socktype):
+        """Resolves the transport's address, using the shared cache
+
+        :param socktype: The socket type to resolve addresses for
+        :returns: A list of ``getaddrinfo`` tuples
+        """
+        return resolver.resolve(self.host, self.port, socktype, self.dns_ttl)
+
     @property
     def address(self):
         """
@@ -89,11 +511,68 @@ class SocketTransport(Transport):
     def socket(self, value):
         self._socket = value
 
+    def is_connected(self):
+        """Checks if the socket has been created and not closed"""
+        sock = getattr(self, '_socket', None)
+        try:
+            return sock is not None and sock.fileno() != -1
+        except socket.error:
+            return False
+
+    def after_fork(self):
+        """Closes the child's copy of the socket
+
+        The socket is closed without being shut down, which leaves the
+        parent's connection open.
+        """
+        sock = getattr(self, '_socket', None)
+        if sock is not None:
+            del self._socket
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
 
 class UDPTransport(SocketTransport):
+    def __init__(self, host=HOST, port=PORT,
+                 max_datagram_size=MAX_DATAGRAM_SIZE):
+        """Communicates with Riemann over UDP
+
+        Messages that are too large for a single datagram are split into as
+        few datagrams as possible, each containing a subset of the events,
+        so that batches of events are not fragmented or dropped.
+
+        :param str host: The hostname to send to
+        :param int port: The port to send to
+        :param int max_datagram_size: The maximum size of a datagram in bytes
+        """
+        super(UDPTransport, self).__init__(host, port)
+        self.max_datagram_size = max_datagram_size
+
     def connect(self):
-        """Creates a UDP socket"""
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        """Creates a UDP socket connected to the first usable address
+
+        Connecting the socket means the address does not need to be looked up
+        or passed to the kernel for each datagram. Connecting a UDP socket
+        can't detect whether a server is listening, so IPv4 addresses are
+        used before IPv6 addresses, as Riemann's UDP server listens on IPv4
+        by default.
+        """
+        error = socket.error("No addresses to connect to")
+        addresses = sorted(self.resolve(socket.SOCK_DGRAM),
+                           key=lambda address: address[0] != socket.AF_INET)
+        for family, socktype, proto, _, sockaddr in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.connect(sockaddr)
+            except socket.error as e:
+                sock.close()
+                error = e
+                continue
+            self.socket = sock
+            return
+        raise error
 
     def disconnect(self):
         """Closes the socket"""
@@ -104,11 +583,32 @@ class UDPTransport(SocketTransport):
 
         :returns: None - can't receive a response over UDP
         """
-        self.socket.sendto(message.SerializeToString(), self.address)
+        data = message.SerializeToString()
+        for datagram in split_message(data, self.max_datagram_size):
+            self.send_datagram(datagram)
         return None
 
+    def send_datagram(self, datagram):
+        """Sends a single datagram, retrying once if the socket reports that
+        an earlier datagram was refused
+
+        A connected UDP socket reports ICMP port unreachable messages from
+        earlier datagrams as an error from a later send, which fails without
+        sending it. An unconnected socket would ignore them, so the datagram
+        is sent again, and dropped if it is refused twice.
+        """
+        for _ in range(2):
+            try:
+                self.socket.send(datagram)
+                return
+            except socket.error as error:
+                if error.errno != errno.ECONNREFUSED:
+                    raise
+
 
 class TCPTransport(SocketTransport):
+    stream_chunk_size = STREAM_CHUNK_SIZE
+
     def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT):
         """Communicates with Riemann over TCP
 
@@ -118,10 +618,21 @@ class TCPTransport(SocketTransport):
         """
         super(TCPTransport, self).__init__(host, port)
         self.timeout = timeout
+        self.buffer = FrameBuffer()
 
     def connect(self):
-        """Connects to the given host"""
-        self.socket = socket.create_connection(self.address, self.timeout)
+        """Connects to the given host
+
+        Each resolved address is tried in parallel, staggered by
+        ``CONNECTION_ATTEMPT_DELAY``, and the first to connect is used.
+        """
+        try:
+            self.socket = create_connection(
+                self.resolve(socket.SOCK_STREAM), self.timeout)
+        except socket.error:
+            # The server may have moved, so look it up again next time
+            resolver.invalidate(self.host, self.port, socket.SOCK_STREAM)
+            raise
 
     def disconnect(self):
         """Closes the socket"""
@@ -134,24 +645,279 @@ class TCPTransport(SocketTransport):
         :returns: The response message from Riemann
         :raises RiemannError: if the server returns an error
         """
-        message = message.SerializeToString()
-        self.socket.sendall(struct.pack('!I', len(message)) + message)
-
-        length = struct.unpack('!I', self.socket.recv(4))[0]
-        response = riemann_pb2.Msg()
-        response.ParseFromString(socket_recvall(self.socket, length))
+        write_frame(self.socket, message)
+        response = read_frame(self.socket, self.buffer)
 
         if not response.ok:
             raise RiemannError(response.error)
 
         return response
 
+    def send_serialized(self, data):
+        """Sends a serialized message, and returns the response without
+        decoding it"""
+        socket_sendall_frame(self.socket, data)
+        response = bytes(self.buffer.recv_frame(self.socket))
+        check_response(response)
+        return response
+
+    def stream_serialized(self, data):
+        """Sends a serialized message, and yields each event in the response
+        as soon as it has been received
+
+        If iteration stops early, the rest of the response is received and
+        discarded when the iterator is closed, so the connection can still
+        be used.
+        """
+        socket_sendall_frame(self.socket, data)
+        header = bytearray(4)
+        socket_recv_into(self.socket, memoryview(header))
+        stream = ResponseStream(self.socket,
+                                struct.unpack('!I', bytes(header))[0],
+                                self.stream_chunk_size)
+        ok, error = False, u''
+        try:
+            for number, wire_type, value in stream.fields():
+                if number == MSG_OK and wire_type == VARINT:
+                    ok = bool(value)
+                elif number == MSG_ERROR and wire_type == LENGTH_DELIMITED:
+                    error = value.decode('utf-8', 'replace')
+                elif number == MSG_EVENTS and wire_type == LENGTH_DELIMITED:
+                    yield value
+        except GeneratorExit:
+            stream.discard()
+            raise
+        if not ok:
+            raise RiemannError(error)
+
+
+class PipelinedTCPTransport(TCPTransport):
+    def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT,
+                 max_in_flight=MAX_IN_FLIGHT):
+        """Communicates with Riemann over TCP, without waiting for a response
+        before sending the next message
+
+        Riemann acknowledges messages in the order it receives them, so
+        messages are written back to back and a reader thread matches each
+        response to the oldest pending :py:meth:`.send_async` future. This
+        allows several threads to share a single connection, and removes the
+        round trip between consecutive messages.
+
+        Options are the same as :py:class:`.TCPTransport` unless noted
+
+        :param int max_in_flight: The maximum number of messages that can be
+            waiting for a response, further sends will block until a response
+            has been received
+        """
+        if Future is None:
+            raise RuntimeError(
+                "PipelinedTCPTransport requires concurrent.futures")
+        super(PipelinedTCPTransport, self).__init__(host, port, timeout)
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._write_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = collections.deque()
+        self._error = None
+        self._reader = None
+
+    def connect(self):
+        """Connects to the given host and starts the response reader"""
+        super(PipelinedTCPTransport, self).connect()
+        # The socket keeps it's timeout, so a server that stops reading or
+        # stops part way through a response can't block a thread forever.
+        # The reader waits for each response to start without a timeout.
+        self._error = None
+        self._reader = threading.Thread(
+            target=self._read_responses, args=(self.socket,),
+            name='riemann-client-pipeline-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def disconnect(self):
+        """Waits for pending responses and closes the socket"""
+        with self._pending_lock:
+            pending = list(self._pending)
+        if pending:
+            wait_for_futures(pending, self.timeout)
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+
+    def send_async(self, message):
+        """Sends a message to a Riemann server without waiting for a response
+
+        Blocks if there are already ``max_in_flight`` messages waiting for a
+        response.
+
+        :param message: The message to send to the Riemann server
+        :returns: A ``Future`` that will be resolved with the response message
+            from Riemann, or fail with :py:exc:`.RiemannError` if the server
+            returns an error
+        :raises socket.timeout: if a slot does not become free in time, or
+            the message can't be written in time
+        """
+        sock = self.socket
+        if not self._slots.acquire(timeout=self.timeout):
+            raise socket.timeout("Too many messages waiting for a response")
+        future = Future()
+        future.add_done_callback(lambda _: self._slots.release())
+
+        timeout = -1 if self.timeout is None else self.timeout
+        if not self._write_lock.acquire(timeout=timeout):
+            error = socket.timeout("Timed out waiting to write a message")
+            future.set_exception(error)
+            raise error
+        try:
+            with self._pending_lock:
+                if self._error is not None:
+                    future.set_exception(self._error)
+                    return future
+                self._pending.append(future)
+            try:
+                write_frame(sock, message)
+            except socket.error as error:
+                # A partly written message can't be followed by another
+                self._fail_pending(error)
+                raise
+        finally:
+            self._write_lock.release()
+        return future
+
+    def after_fork(self):
+        """Forgets the parent's pending responses and reader thread"""
+        super(PipelinedTCPTransport, self).after_fork()
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._write_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = collections.deque()
+        self._error = None
+        self._reader = None
+
+    def send(self, message):
+        """Sends a message to a Riemann server and returns it's response
+
+        Other threads may send messages while this one waits for a response.
+
+        :param message: The message to send to the Riemann server
+        :returns: The response message from Riemann
+        :raises RiemannError: if the server returns an error
+        """
+        try:
+            return self.send_async(message).result(self.timeout)
+        except FutureTimeoutError:
+            raise socket.timeout("Timed out waiting for a response")
+
+    def send_serialized(self, data):
+        """Sends a serialized message through the pipeline, as responses are
+        decoded by the reader thread"""
+        return Transport.send_serialized(self, data)
+
+    def stream_serialized(self, data):
+        """Receives the whole response before iterating over it's events, as
+        responses are read by the reader thread"""
+        return Transport.stream_serialized(self, data)
+
+    def _read_responses(self, sock):
+        """Resolves pending futures as responses are read from the socket
+
+        The connection may be idle for any length of time, so the reader
+        waits for a response to start arriving before reading it, which is
+        then subject to the socket's timeout.
+        """
+        try:
+            while True:
+                try:
+                    sock.recv(1, socket.MSG_PEEK)
+                except socket.timeout:
+                    continue
+                response = read_frame(sock, self.buffer)
+                with self._pending_lock:
+                    if not self._pending:
+                        raise socket.error("Received an unexpected response")
+                    future = self._pending.popleft()
+                if response.ok:
+                    future.set_result(response)
+                else:
+                    future.set_exception(RiemannError(response.error))
+        except Exception as error:
+            if not isinstance(error, socket.error):
+                error = socket.error("Invalid response: {0}".format(error))
+            self._fail_pending(error)
+
+    def _fail_pending(self, error):
+        """Fails every pending future, and any future sends"""
+        with self._pending_lock:
+            self._error = error
+            pending, self._pending = self._pending, collections.deque()
+        for future in pending:
+            future.set_exception(error)
+
+
+_ssl_contexts = {}
+_ssl_contexts_lock = threading.Lock()
+
+
+def _after_fork_in_child():
+    """Replaces module locks that may have been held by another thread when
+    the process forked, which would otherwise never be released"""
+    global _ssl_contexts_lock
+    _ssl_contexts_lock = threading.Lock()
+    resolver._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def create_ssl_context(ca_certs=None, keyfile=None, certfile=None):
+    """Returns an SSL context for connecting to Riemann
+
+    Contexts are cached and shared between every transport using the same
+    files, so certificates are only loaded once. The context requires TLS 1.2
+    or above and a certificate signed by ``ca_certs``, but does not check the
+    certificate's hostname.
+
+    :param str ca_certs: Path to a CA Cert bundle, defaults to the system's
+    :param str keyfile:  Path to a client key file
+    :param str certfile: Path to a client certificate file
+    :returns: An :py:class:`ssl.SSLContext`
+    """
+    key = ca_certs, keyfile, certfile
+    with _ssl_contexts_lock:
+        context = _ssl_contexts.get(key)
+        if context is None:
+            context = ssl.SSLContext(
+                getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+            if hasattr(ssl, 'TLSVersion'):
+                context.minimum_version = ssl.TLSVersion.TLSv1_2
+            else:
+                context.options |= (ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 |
+                                    ssl.OP_NO_TLSv1 | ssl.OP_NO_TLSv1_1)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_REQUIRED
+            if ca_certs is None:
+                context.load_default_certs()
+            else:
+                context.load_verify_locations(ca_certs)
+            if certfile is not None:
+                context.load_cert_chain(certfile, keyfile)
+            _ssl_contexts[key] = context
+    return context
+
 
 class TLSTransport(TCPTransport):
     def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT, ca_certs=None,
                  keyfile=None, certfile=None):
         """Communicates with Riemann over TCP + TLS
 
+        The TLS session is kept when disconnecting, and is resumed by the next
+        connection, which avoids a full handshake when reconnecting.
+
         Options are the same as :py:class:`.TCPTransport` unless noted
 
         :param str ca_certs: Path to a CA Cert bundle used to create the socket
@@ -162,17 +928,396 @@ class TLSTransport(TCPTransport):
         self.ca_certs = ca_certs
         self.keyfile = keyfile
         self.certfile = certfile
+        self.session = None
+
+    @property
+    def context(self):
+        """:returns: The shared :py:class:`ssl.SSLContext` for this transport
+        """
+        return create_ssl_context(self.ca_certs, self.keyfile, self.certfile)
 
     def connect(self):
         """Connects using :py:meth:`TLSTransport.connect` and wraps with TLS"""
         super(TLSTransport, self).connect()
-        self.socket = ssl.wrap_socket(
-            self.socket,
-            ssl_version=ssl.PROTOCOL_TLSv1,
-            cert_reqs=ssl.CERT_REQUIRED,
-            ca_certs=self.ca_certs,
-            keyfile=self.keyfile,
-            certfile=self.certfile)
+        # Sessions can only be resumed on Python 3.6 and above
+        options = {} if self.session is None else {'session': self.session}
+        try:
+            self.socket = self.context.wrap_socket(
+                self.socket, server_hostname=self.host, **options)
+        except (ssl.SSLError, socket.error):
+            self.socket.close()
+            self.session = None
+            raise
+
+    def disconnect(self):
+        """Saves the TLS session and closes the socket"""
+        if getattr(self.socket, 'session', None) is not None:
+            self.session = self.socket.session
+        super(TLSTransport, self).disconnect()
+
+
+class PooledTransport(Transport):
+    def __init__(self, factory, max_connections=MAX_CONNECTIONS):
+        """Shares a pool of connections between threads
+
+        Each :py:meth:`.send` checks a connection out of the pool, so
+        concurrent sends never interleave their messages or responses.
+        Connections are created when no idle connection is available, up to
+        ``max_connections``, after which sends wait for one to be returned.
+        Connections that fail with anything other than a
+        :py:exc:`.RiemannError` are closed rather than returned to the pool.
+
+        :param factory: A callable returning a new, unconnected transport
+        :param int max_connections: The maximum number of open connections
+        """
+        self.factory = factory
+        self.max_connections = max_connections
+        self._condition = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._generation = 0
+
+    def connect(self):
+        """Does nothing, connections are opened when they are first needed"""
+        pass
+
+    def is_connected(self):
+        """Always True, as connections are opened when they are needed"""
+        return True
+
+    def disconnect(self):
+        """Closes idle connections
+
+        Connections that are in use are closed when they are returned.
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._generation += 1
+            self._condition.notify_all()
+        for transport, _ in idle:
+            self._close(transport)
+
+    def after_fork(self):
+        """Closes the child's copies of the pooled connections
+
+        Connections that were checked out by the parent's threads are
+        forgotten, as those threads do not exist in the child.
+        """
+        for transport, _ in self._idle:
+            transport.after_fork()
+        self._condition = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._generation += 1
+
+    def send(self, message):
+        """Sends a message using a connection from the pool
+
+        :param message: The message to send to the Riemann server
+        :returns: The response message from Riemann
+        :raises RiemannError: if the server returns an error
+        """
+        return self.call('send', message)
+
+    def send_serialized(self, data):
+        """Sends a serialized message using a connection from the pool
+
+        :returns: The serialized response
+        """
+        return self.call('send_serialized', data)
+
+    def stream_serialized(self, data):
+        """Streams a response using a connection from the pool, which is
+        returned once the response has been read"""
+        transport, generation = self.acquire()
+        events = transport.stream_serialized(data)
+        broken = False
+        try:
+            for event in events:
+                yield event
+        except GeneratorExit:
+            try:
+                events.close()
+            except Exception:
+                broken = True
+            raise
+        except RiemannError:
+            raise
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(transport, generation, broken)
+
+    def call(self, method, value):
+        """Calls a method of a connection from the pool
+
+        :param str method: The name of the transport method to call
+        """
+        transport, generation = self.acquire()
+        try:
+            response = getattr(transport, method)(value)
+        except RiemannError:
+            self.release(transport, generation)
+            raise
+        except Exception:
+            self.release(transport, generation, broken=True)
+            raise
+        self.release(transport, generation)
+        return response
+
+    def acquire(self):
+        """Checks a connection out of the pool, opening one if needed
+
+        :returns: A tuple of the transport and the pool generation it
+            belongs to, which must be passed to :py:meth:`.release`
+        """
+        with self._condition:
+            while not self._idle and self._size >= self.max_connections:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            generation = self._generation
+
+        try:
+            transport = self.factory()
+            transport.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        return transport, generation
+
+    def release(self, transport, generation, broken=False):
+        """Returns a connection to the pool
+
+        :param bool broken: Close the connection instead of reusing it
+        """
+        with self._condition:
+            reuse = not broken and generation == self._generation
+            if reuse:
+                self._idle.append((transport, generation))
+            else:
+                self._size -= 1
+            self._condition.notify()
+        if not reuse:
+            self._close(transport)
+
+    @staticmethod
+    def _close(transport):
+        try:
+            transport.disconnect()
+        except (socket.error, RuntimeError):
+            pass
+
+
+class PooledTCPTransport(PooledTransport):
+    def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT,
+                 max_connections=MAX_CONNECTIONS):
+        """Communicates with Riemann over a pool of TCP connections
+
+        Options are the same as :py:class:`.TCPTransport` and
+        :py:class:`.PooledTransport`
+        """
+        super(PooledTCPTransport, self).__init__(
+            self.create_transport, max_connections)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def create_transport(self):
+        return TCPTransport(self.host, self.port, self.timeout)
+
+
+class PooledTLSTransport(PooledTCPTransport):
+    def __init__(self, host=HOST, port=PORT, timeout=TIMEOUT, ca_certs=None,
+                 keyfile=None, certfile=None,
+                 max_connections=MAX_CONNECTIONS):
+        """Communicates with Riemann over a pool of TLS connections
+
+        Options are the same as :py:class:`.TLSTransport` and
+        :py:class:`.PooledTransport`
+        """
+        super(PooledTLSTransport, self).__init__(
+            host, port, timeout, max_connections)
+        self.ca_certs = ca_certs
+        self.keyfile = keyfile
+        self.certfile = certfile
+
+    def create_transport(self):
+        return TLSTransport(self.host, self.port, self.timeout,
+                            self.ca_certs, self.keyfile, self.certfile)
+
+
+class HashRing(object):
+    """A consistent hash ring, mapping keys to a set of named nodes
+
+    Each node is placed on the ring at ``replicas`` points, and a key belongs
+    to the node at the first point after the key's hash. Adding or removing a
+    node only moves the keys between it and it's neighbours.
+    """
+
+    def __init__(self, replicas=SHARD_REPLICAS):
+        self.replicas = replicas
+        self.nodes = collections.OrderedDict()
+        self._points = []
+        self._owners = []
+
+    @staticmethod
+    def hash(key):
+        """:returns: The position of a bytes key on the ring"""
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, name, node):
+        """Adds a node to the ring under a unique name"""
+        if name in self.nodes:
+            raise ValueError("Node {0!r} is already in the ring".format(name))
+        self.nodes[name] = node
+        for replica in range(self.replicas):
+            point = self.hash('{0}-{1}'.format(name, replica).encode('utf-8'))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, name)
+
+    def remove(self, name):
+        """Removes a node from the ring
+
+        :returns: The removed node
+        """
+        node = self.nodes.pop(name)
+        keep = [i for i, owner in enumerate(self._owners) if owner != name]
+        self._points = [self._points[i] for i in keep]
+        self._owners = [self._owners[i] for i in keep]
+        return node
+
+    def get(self, key):
+        """:returns: The name of the node a bytes key belongs to"""
+        if not self._points:
+            raise LookupError("The ring has no nodes")
+        index = bisect.bisect(self._points, self.hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardedTransport(Transport):
+    def __init__(self, transports=(), fields=SHARD_FIELDS,
+                 replicas=SHARD_REPLICAS):
+        """Shards events between several Riemann servers
+
+        Each message is split into one message per server, using a consistent
+        hash of each event's ``fields`` so that all events for the same stream
+        reach the same server's index. Events are routed without being
+        decoded, and the messages are sent to each server in parallel.
+        Queries are sent to every server, and their results combined.
+
+        Sends are only thread-safe if the underlying transports are, such as
+        :py:class:`.PooledTCPTransport`.
+
+        :param transports: The transports for each server, which are named
+            ``host:port`` on the ring
+        :param fields: The event fields used to choose a server
+        :param int replicas: The number of points for each server on the ring
+        """
+        if ThreadPoolExecutor is None:
+            raise RuntimeError("ShardedTransport requires concurrent.futures")
+        self.ring = HashRing(replicas)
+        self.fields = fields
+        self._numbers = [riemann_pb2.Event.DESCRIPTOR.fields_by_name[f].number
+                         for f in fields]
+        self._executor = None
+        for transport in transports:
+            self.add_transport(transport)
+
+    def add_transport(self, transport, name=None):
+        """Adds a server, which will receive a share of future events
+
+        :param name: A unique name for the server, defaults to ``host:port``
+        """
+        if name is None:
+            name = '{0}:{1}'.format(transport.host, transport.port)
+        self.ring.add(name, transport)
+        self._resize_executor()
+
+    def remove_transport(self, name):
+        """Removes a server, moving it's share of events to the others
+
+        :returns: The removed transport, which has not been disconnected
+        """
+        transport = self.ring.remove(name)
+        self._resize_executor()
+        return transport
+
+    def _resize_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, len(self.ring.nodes)))
+
+    def connect(self):
+        """Connects every transport that is not already connected"""
+        for transport in self.ring.nodes.values():
+            if not transport.is_connected():
+                transport.connect()
+
+    def is_connected(self):
+        """Checks if every transport is connected"""
+        return all(transport.is_connected()
+                   for transport in self.ring.nodes.values())
+
+    def disconnect(self):
+        """Disconnects every transport"""
+        for transport in self.ring.nodes.values():
+            transport.disconnect()
+
+    def after_fork(self):
+        """Resets every transport, and replaces the executor as it's threads
+        do not exist in the child"""
+        for transport in self.ring.nodes.values():
+            transport.after_fork()
+        self._executor = None
+        self._resize_executor()
+
+    def send(self, message):
+        """Sends each server it's share of a message
+
+        :param message: The message to send to the Riemann servers
+        :returns: A response message combining the events from every response
+        :raises RiemannError: if any server returns an error
+        """
+        data = memoryview(message.SerializeToString())
+        shards = collections.defaultdict(list)
+        for number, wire_type, value, start, end in iter_fields(data):
+            if number == MSG_EVENTS and wire_type == LENGTH_DELIMITED:
+                shards[self.ring.get(self.shard_key(value))].append(
+                    data[start:end])
+            else:
+                # Queries and other fields are sent to every server
+                for name in self.ring.nodes:
+                    shards[name].append(data[start:end])
+
+        futures = [
+            self._executor.submit(self.ring.nodes[name].send,
+                                  SerializedMessage(b"".join(parts)))
+            for name, parts in shards.items()]
+        wait_for_futures(futures)
+
+        response = riemann_pb2.Msg()
+        response.ok = True
+        for future in futures:
+            result = future.result()
+            if result is not None:
+                response.events.extend(result.events)
+        return response
+
+    def shard_key(self, event):
+        """:returns: The bytes used to choose a server for a serialized event
+        """
+        values = dict((number, event[start:end])
+                      for number, _, _, start, end in iter_fields(event)
+                      if number in self._numbers)
+        return b"".join(bytes(values.get(n, b"")) for n in self._numbers)
 
 
 class BlankTransport(Transport):
@@ -190,6 +1335,10 @@ class BlankTransport(Transport):
         """Creates a list to hold messages"""
         pass
 
+    def is_connected(self):
+        """Always True, as there is no connection"""
+        return True
+
     def send(self, message):
         """Adds a message to the list, returning a fake 'ok' response
 
@@ -211,5 +1360,8 @@ class BlankTransport(Transport):
 
 __all__ = (
     'RiemannError', 'SocketTransport', 'UDPTransport',
-    'TCPTransport', 'TLSTransport', 'BlankTransport',
+    'TCPTransport', 'PipelinedTCPTransport', 'TLSTransport',
+    'create_ssl_context',
+    'PooledTransport', 'PooledTCPTransport', 'PooledTLSTransport',
+    'HashRing', 'ShardedTransport', 'BlankTransport',
 )
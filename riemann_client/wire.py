@@ -0,0 +1,375 @@
+"""Helpers for working directly with the protocol buffer wire format, used
+where decoding and re-encoding whole messages would be wasteful - such as
+splitting a serialized message into several smaller ones.
+
+Groups are not used by Riemann's messages, and are not supported.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+import operator
+import struct
+
+from google.protobuf.descriptor import FieldDescriptor
+
+from . import riemann_pb2
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# The field numbers of ``Msg.ok``, ``Msg.error`` and ``Msg.events`` in
+# riemann.proto
+MSG_OK = 2
+MSG_ERROR = 3
+MSG_EVENTS = 6
+
+
+class DecodeError(ValueError):
+    """Raised when data is not a valid protocol buffer message"""
+    pass
+
+
+def encode_varint(value):
+    """Encodes a non-negative integer as a varint
+
+    :returns: The encoded bytes
+    """
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_tag(number, wire_type):
+    """:returns: The encoded key of a field"""
+    return encode_varint((number << 3) | wire_type)
+
+
+def encode_length_delimited(number, data):
+    """Encodes a string, bytes or embedded message field
+
+    :param bytes data: The field's value, or a serialized message
+    :returns: The encoded field, including it's tag
+    """
+    return encode_tag(number, LENGTH_DELIMITED) + \
+        encode_varint(len(data)) + data
+
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+FLOAT_MAX = struct.unpack('<f', b'\xff\xff\x7f\x7f')[0]
+
+
+def _type_error(value, expected):
+    return TypeError("{0!r} has type {1}, but expected one of: {2}".format(
+        value, type(value).__name__, expected))
+
+
+def check_string(value):
+    """Checks a value for a string field the same way protocol buffer
+    objects do
+
+    :returns: The value as UTF-8 encoded bytes
+    :raises TypeError: If the value is not text or bytes
+    :raises ValueError: If the value is bytes that are not valid UTF-8
+    """
+    if isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    elif isinstance(value, bytes):
+        try:
+            value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("{0!r} is not valid UTF-8".format(value))
+        return value
+    raise _type_error(value, "bytes, unicode")
+
+
+def check_int64(value):
+    """Checks a value for a 64 bit integer field the same way protocol
+    buffer objects do, which reject floats rather than truncating them
+
+    :returns: The value as an ``int``
+    :raises TypeError: If the value is not an integer
+    :raises ValueError: If the value does not fit in 64 bits
+    """
+    if type(value) is not int:
+        if not hasattr(value, '__index__'):
+            raise _type_error(value, "int")
+        value = operator.index(value)
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise ValueError("Value out of range: {0}".format(value))
+    return value
+
+
+def check_float(value):
+    """Checks a value for a double or float field the same way protocol
+    buffer objects do
+
+    :returns: The value as a ``float``
+    :raises TypeError: If the value is not a number
+    """
+    if type(value) is float:
+        return value
+    if isinstance(value, (bytes, type(u''))) or not (
+            hasattr(value, '__float__') or hasattr(value, '__index__')):
+        raise _type_error(value, "int, float")
+    return float(value)
+
+
+def _string_encoder(tag):
+    def encode(value):
+        value = check_string(value)
+        return tag + encode_varint(len(value)) + value
+    return encode
+
+
+def _int64_encoder(tag):
+    def encode(value):
+        # Negative values are encoded as their 64 bit two's complement
+        return tag + encode_varint(check_int64(value) & 0xffffffffffffffff)
+    return encode
+
+
+def _sint64_encoder(tag):
+    def encode(value):
+        value = check_int64(value)
+        return tag + encode_varint(((value << 1) ^ (value >> 63)) &
+                                   0xffffffffffffffff)
+    return encode
+
+
+def _double_encoder(tag):
+    packer = struct.Struct('<d')
+
+    def encode(value):
+        return tag + packer.pack(check_float(value))
+    return encode
+
+
+def _float_encoder(tag):
+    packer = struct.Struct('<f')
+
+    def encode(value):
+        value = check_float(value)
+        # Like protocol buffer objects, store values too large for a 32 bit
+        # float as infinity instead of raising an error
+        if value > FLOAT_MAX:
+            value = float('inf')
+        elif value < -FLOAT_MAX:
+            value = float('-inf')
+        return tag + packer.pack(value)
+    return encode
+
+
+_encoders = {
+    FieldDescriptor.TYPE_STRING: (LENGTH_DELIMITED, _string_encoder),
+    FieldDescriptor.TYPE_INT64: (VARINT, _int64_encoder),
+    FieldDescriptor.TYPE_SINT64: (VARINT, _sint64_encoder),
+    FieldDescriptor.TYPE_DOUBLE: (FIXED64, _double_encoder),
+    FieldDescriptor.TYPE_FLOAT: (FIXED32, _float_encoder),
+}
+
+
+def field_encoder(field):
+    """Creates a function that encodes a single value of a field
+
+    Encoding fields directly is much cheaper than setting them on a message
+    object and serializing it, when most of a message is already encoded.
+
+    :param field: The ``FieldDescriptor`` of a string, 64 bit integer,
+        double or float field
+    :returns: A function taking a value and returning the encoded field,
+        including it's tag
+    """
+    try:
+        wire_type, encoder = _encoders[field.type]
+    except KeyError:
+        raise TypeError("Can't encode {0} fields".format(field.name))
+    return encoder(encode_tag(field.number, wire_type))
+
+
+_EVENTS_TAG = encode_tag(MSG_EVENTS, LENGTH_DELIMITED)
+
+
+def decode_varint(data, offset):
+    """Decodes a varint from ``data``, starting at ``offset``
+
+    :returns: A tuple of the decoded value and the offset after the varint
+    :raises DecodeError: if the varint is truncated
+    """
+    value = shift = 0
+    try:
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value, offset
+            shift += 7
+    except IndexError:
+        raise DecodeError("Truncated varint")
+
+
+def iter_fields(data):
+    """Iterates over the top level fields of a serialized message
+
+    Length-delimited values are returned as slices of ``data``, so passing a
+    memoryview avoids copying them.
+
+    :param data: A bytes-like object containing a serialized message
+    :returns: An iterator of ``(number, wire_type, value, start, end)`` tuples,
+        where ``data[start:end]`` is the field including it's tag
+    :raises DecodeError: if the data is not a valid message
+    """
+    offset, length = 0, len(data)
+    while offset < length:
+        start = offset
+        tag, offset = decode_varint(data, offset)
+        number, wire_type = tag >> 3, tag & 0x7
+        if wire_type == VARINT:
+            value, offset = decode_varint(data, offset)
+        elif wire_type == LENGTH_DELIMITED:
+            size, offset = decode_varint(data, offset)
+            value, offset = data[offset:offset + size], offset + size
+        elif wire_type == FIXED64:
+            value, offset = data[offset:offset + 8], offset + 8
+        elif wire_type == FIXED32:
+            value, offset = data[offset:offset + 4], offset + 4
+        else:
+            raise DecodeError("Unsupported wire type {0}".format(wire_type))
+        if offset > length:
+            raise DecodeError("Truncated field {0}".format(number))
+        yield number, wire_type, value, start, offset
+
+
+def split_message(data, max_size):
+    """Splits a serialized message into messages of at most ``max_size`` bytes
+
+    Top level fields are packed greedily into each message without being
+    decoded, so a batch of events becomes as few messages as possible. A
+    single field larger than ``max_size`` is placed in a message on it's own.
+
+    :param data: A bytes-like object containing a serialized ``Msg``
+    :param int max_size: The maximum size of each message in bytes
+    :returns: An iterator of serialized messages
+    """
+    if len(data) <= max_size:
+        yield data
+        return
+
+    view = memoryview(data)
+    chunk, size = [], 0
+    for _, _, _, start, end in iter_fields(view):
+        if chunk and size + (end - start) > max_size:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+        chunk.append(view[start:end])
+        size += end - start
+    if chunk:
+        yield b"".join(chunk)
+
+
+class SerializedMessage(object):
+    """A ``Msg`` that has already been serialized
+
+    Can be passed to a transport in place of a ``Msg`` object, which avoids
+    decoding and re-encoding messages that only need to be forwarded.
+    """
+
+    def __init__(self, data=b""):
+        self.data = data
+
+    def SerializeToString(self):
+        """:returns: The serialized message"""
+        return bytes(self.data)
+
+    @property
+    def events(self):
+        """Decodes the events in the message
+
+        :returns: A list of ``Event`` objects
+        """
+        return riemann_pb2.Msg.FromString(bytes(self.data)).events
+
+
+class MessageBuffer(SerializedMessage):
+    """A ``Msg`` that serialized events are appended to
+
+    Each event is serialized once, when it is added, and transports send the
+    buffer as it is, so events are never copied into a message object and the
+    size of the message is always known exactly. The :py:attr:`.events`
+    property decodes a copy of the events, and can't be used to change them.
+    """
+
+    def __init__(self):
+        super(MessageBuffer, self).__init__(bytearray())
+        self.count = 0
+
+    def __len__(self):
+        """:returns: The number of events in the message"""
+        return self.count
+
+    def ByteSize(self):
+        """:returns: The size of the serialized message in bytes"""
+        return len(self.data)
+
+    def size_with(self, data):
+        """:returns: The size the message would be after appending a
+            serialized ``Event``"""
+        return (len(self.data) + len(_EVENTS_TAG) +
+                len(encode_varint(len(data))) + len(data))
+
+    def append(self, data):
+        """Adds a serialized ``Event`` to the message"""
+        self.data += _EVENTS_TAG + encode_varint(len(data))
+        self.data += data
+        self.count += 1
+
+    def extend(self, other):
+        """Adds the events from another buffer to the message"""
+        self.data += other.data
+        self.count += other.count
+
+    def drop(self, count):
+        """Removes the oldest ``count`` events from the message"""
+        end = 0
+        for _, _, _, _, end in itertools.islice(iter_fields(self.data), count):
+            pass
+        del self.data[:end]
+        self.count = max(0, self.count - count)
+
+    def head(self, max_bytes):
+        """Finds the oldest events in the message, up to ``max_bytes`` in
+        total, without removing them
+
+        At least one event is included, even if it is larger than
+        ``max_bytes``.
+
+        :returns: A :py:class:`.MessageBuffer` containing the events, which
+            is the message itself if it is no larger than ``max_bytes``
+        """
+        if len(self.data) <= max_bytes:
+            return self
+
+        end = count = 0
+        while end < len(self.data):
+            _, offset = decode_varint(self.data, end)
+            size, offset = decode_varint(self.data, offset)
+            if offset + size > max_bytes and count:
+                break
+            end, count = offset + size, count + 1
+        head = MessageBuffer()
+        head.data, head.count = self.data[:end], count
+        return head
+
+
+__all__ = (
+    'MSG_OK', 'MSG_ERROR', 'MSG_EVENTS', 'DecodeError', 'encode_varint',
+    'encode_tag', 'encode_length_delimited', 'field_encoder', 'decode_varint',
+    'iter_fields', 'split_message', 'SerializedMessage', 'MessageBuffer',
+)
@@ -1,14 +1,7 @@
-#!/usr/bin/env python2.6
-
-import sys
+#!/usr/bin/env python
 
 import setuptools
 
-if sys.version_info >= (3,):
-    protobuf = 'protobuf>=3.2.0,<4.0.0'
-else:
-    protobuf = 'protobuf>=2.3.0,<4.0.0'
-
 setuptools.setup(
     name='riemann-client',
     version='7.0.0',
@@ -25,9 +18,11 @@ setuptools.setup(
         'riemann_client',
     ],
 
+    python_requires='>=3.4',
+
     install_requires=[
         'click>=3.1',
-        protobuf
+        'protobuf>=3.2.0,<4.0.0'
     ],
 
     extras_require={
@@ -48,9 +43,6 @@ setuptools.setup(
         'License :: OSI Approved',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
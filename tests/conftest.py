@@ -1,9 +1,15 @@
 from __future__ import absolute_import
 
+import socket
+import ssl
+import struct
+import subprocess
 import sys
+import threading
 
 import pytest
 
+import riemann_client.riemann_pb2
 import riemann_client.transport
 
 if sys.version_info >= (3,):
@@ -11,6 +17,9 @@ if sys.version_info >= (3,):
 else:
     from StringIO import StringIO
 
+if sys.version_info < (3, 7):
+    collect_ignore = ['test_riemann_aio.py']
+
 
 class StringTransport(riemann_client.transport.Transport):
     def connect(self):
@@ -28,3 +37,111 @@ class StringTransport(riemann_client.transport.Transport):
 @pytest.fixture
 def string_transport():
     return StringTransport()
+
+
+class FakeRiemannServer(object):
+    """A TCP server that acknowledges each message it receives
+
+    Messages containing an event with the service ``error`` are answered with
+    an error response, and queries are answered with the received events.
+    """
+
+    def __init__(self, ssl_context=None):
+        self.ssl_context = ssl_context
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.host, self.port = self.listener.getsockname()
+        self.messages = []
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def recv(connection, length):
+        data = b''
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self, connection):
+        try:
+            if self.ssl_context is not None:
+                connection = self.ssl_context.wrap_socket(
+                    connection, server_side=True)
+            while self.respond(connection):
+                pass
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            connection.close()
+
+    def respond(self, connection):
+        header = self.recv(connection, 4)
+        if header is None:
+            return False
+        message = riemann_client.riemann_pb2.Msg.FromString(
+            self.recv(connection, struct.unpack('!I', header)[0]))
+        self.messages.append(message)
+
+        response = riemann_client.riemann_pb2.Msg()
+        response.ok = True
+        if message.HasField('query'):
+            for received in self.messages:
+                response.events.extend(received.events)
+        for event in message.events:
+            if event.service == 'error':
+                response.ok = False
+                response.error = 'error event'
+        response = response.SerializeToString()
+        connection.sendall(struct.pack('!I', len(response)) + response)
+        return True
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def riemann_server(request):
+    server = FakeRiemannServer()
+    request.addfinalizer(server.close)
+    return server
+
+
+@pytest.fixture(scope='session')
+def certificate(tmpdir_factory):
+    """A self signed certificate and key for localhost"""
+    path = str(tmpdir_factory.mktemp('tls').join('localhost.pem'))
+    try:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', path, '-out', path,
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("openssl is required to create a certificate")
+    return path
+
+
+@pytest.fixture
+def tls_riemann_server(request, certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate)
+    server = FakeRiemannServer(context)
+    request.addfinalizer(server.close)
+    return server
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+
+import asyncio
+
+import pytest
+
+import riemann_client.riemann_pb2
+from riemann_client.aio import (
+    AsyncClient, AsyncQueuedClient, AsyncTCPTransport, AsyncUDPTransport)
+from riemann_client.transport import RiemannError
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def transport(riemann_server):
+    return AsyncTCPTransport(riemann_server.host, riemann_server.port, 5)
+
+
+def test_event(transport, riemann_server):
+    async def send():
+        async with AsyncClient(transport) as client:
+            return await client.event(service='aio')
+
+    assert run(send()).ok
+    assert riemann_server.messages[0].events[0].service == 'aio'
+
+
+def test_concurrent_events(transport, riemann_server):
+    async def send():
+        async with AsyncClient(transport) as client:
+            return await asyncio.gather(*(
+                client.event(service=str(i)) for i in range(20)))
+
+    assert all(response.ok for response in run(send()))
+    assert len(riemann_server.messages) == 20
+
+
+def test_error(transport):
+    async def send():
+        async with AsyncClient(transport) as client:
+            ok = client.event(service='one')
+            error = client.event(service='error')
+            return await asyncio.gather(ok, error, return_exceptions=True)
+
+    ok, error = run(send())
+    assert ok.ok
+    assert isinstance(error, RiemannError)
+
+
+def test_query(transport):
+    async def query():
+        async with AsyncClient(transport) as client:
+            await client.events({'service': 'one'}, {'service': 'two'})
+            return await client.query('true')
+
+    assert [e['service'] for e in run(query())] == ['one', 'two']
+
+
+def test_queued_flush(transport, riemann_server):
+    async def send():
+        async with AsyncQueuedClient(transport) as client:
+            await client.event(service='one')
+            await client.event(service='two')
+            assert len(riemann_server.messages) == 0
+            return await client.flush()
+
+    assert run(send()).ok
+    assert len(riemann_server.messages[0].events) == 2
+
+
+def test_udp_query():
+    with pytest.raises(Exception):
+        run(AsyncClient(AsyncUDPTransport()).query('true'))
+
+
+def test_udp_send():
+    async def send():
+        async with AsyncUDPTransport('127.0.0.1', 9) as transport:
+            return await transport.send(riemann_client.riemann_pb2.Msg())
+
+    assert run(send()) is None
@@ -1,12 +1,17 @@
 from __future__ import absolute_import
 
+import os
 import pytest
 import socket
+import threading
 import time
 
 import riemann_client.client
 import riemann_client.riemann_pb2
 import riemann_client.transport
+import riemann_client.wire
+
+from riemann_client.spool import Spool
 
 
 @pytest.fixture
@@ -237,3 +242,367 @@ def test_clear_on_fail_true(auto_flushing_queued_client_batch5_broken_t):
         sent += 1
     assert (len(auto_flushing_queued_client_batch5_broken_t.queue.events) ==
             0)
+
+
+class RecoveringTransport(riemann_client.transport.BlankTransport):
+    def __init__(self):
+        super(RecoveringTransport, self).__init__()
+        self.broken = True
+
+    def send(self, message):
+        if self.broken:
+            raise socket.error(32, '[Errno 32] Broken pipe')
+        return super(RecoveringTransport, self).send(message)
+
+
+def test_spool_on_fail(tmpdir):
+    transport = RecoveringTransport()
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=transport,
+        max_delay=300,
+        max_batch_size=5,
+        spool=Spool(str(tmpdir)),
+        spool_rate=1000)
+    for i in range(10):
+        client.event(service='test', description='{0:03d}'.format(i))
+    assert len(client.queue.events) == 0
+    assert len(client.spool) == 1
+
+    transport.broken = False
+    client.event(service='test', description='recovered')
+    client.flush()
+    client.spool_thread.join(5)
+    assert sorted(e.description for e in transport.events) == \
+        ['{0:03d}'.format(i) for i in range(10)] + ['recovered']
+    assert client.spool.peek() is None
+
+
+class SlowSpool(Spool):
+    def __init__(self, path):
+        super(SlowSpool, self).__init__(path)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def append(self, data):
+        self.writing.set()
+        self.release.wait(5)
+        super(SlowSpool, self).append(data)
+
+
+def test_spool_write_does_not_block_producers(tmpdir, broken_transport):
+    spool = SlowSpool(str(tmpdir))
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=broken_transport,
+        max_delay=300,
+        max_batch_size=1000,
+        spool=spool)
+    client.event(service='test')
+    flush = threading.Thread(target=client.flush)
+    flush.start()
+    try:
+        assert spool.writing.wait(5)
+        producer = threading.Thread(target=client.event,
+                                    kwargs={'service': 'producer'})
+        producer.start()
+        producer.join(1)
+        assert not producer.is_alive()
+    finally:
+        spool.release.set()
+        flush.join(5)
+        client.stop_timer()
+    assert len(spool) == 1
+    assert [e.service for e in client.queue.events] == ['producer']
+
+
+class SlowTransport(riemann_client.transport.BlankTransport):
+    def send(self, message):
+        time.sleep(0.2)
+        return super(SlowTransport, self).send(message)
+
+
+def test_producers_do_not_wait_for_flush():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=SlowTransport(),
+        max_delay=300,
+        max_batch_size=5,
+        stay_connected=True)
+    flusher = threading.Thread(target=client.flush)
+    flusher.start()
+    time.sleep(0.05)
+
+    # The flush is sending a batch, and these events fill the new queue
+    start = time.time()
+    for i in range(10):
+        client.event(service='test', description=str(i))
+    assert time.time() - start < 0.1
+
+    flusher.join()
+    client.flush()
+    assert [e.description for e in client.transport.events] == \
+        [str(i) for i in range(10)]
+    client.stop_timer()
+
+
+@pytest.fixture
+def background_client(request):
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=SlowTransport(),
+        max_delay=300,
+        max_batch_size=5,
+        stay_connected=True,
+        background=True,
+        max_queue_size=50)
+    request.addfinalizer(client.stop_sender)
+    return client
+
+
+def test_background_producers_do_not_wait(background_client):
+    start = time.time()
+    for i in range(20):
+        background_client.event(service='test', description=str(i))
+    assert time.time() - start < 0.2
+
+    background_client.flush()
+    assert [e.description for e in background_client.transport.events] == \
+        [str(i) for i in range(20)]
+
+
+def test_background_flush_returns_response(background_client):
+    background_client.event(service='test')
+    assert background_client.flush().ok
+    assert len(background_client.transport) == 1
+
+
+def test_background_queue_is_bounded(background_client):
+    for i in range(200):
+        background_client.event(service='test', description=str(i))
+    assert background_client.dropped_events > 0
+    background_client.stop_sender()
+    assert (len(background_client.transport) +
+            background_client.dropped_events) == 200
+
+
+def test_background_queue_is_bounded_by_default():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        background=True)
+    assert client.max_queue_size == \
+        riemann_client.client.BACKGROUND_MAX_QUEUE_SIZE
+    client.stop_sender()
+
+
+def test_stop_timer_in_background_mode():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        background=True)
+    client.stop_timer()
+    client.stop_sender()
+
+
+def test_background_timer_flush():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=0.05,
+        background=True)
+    client.event(service='test')
+    time.sleep(0.2)
+    assert len(client.transport) == 1
+    client.stop_sender()
+
+
+def run_in_child(function):
+    """Calls a function in a forked process, returning its exit status"""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = 0 if function() else 1
+        finally:
+            os._exit(status)
+    return os.waitpid(pid, 0)[1]
+
+
+requires_fork = pytest.mark.skipif(
+    not hasattr(os, 'fork'), reason="os.fork is not available")
+
+
+@requires_fork
+def test_fork_resets_queue():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=300)
+    client.event(service='parent')
+
+    def child():
+        if client.queue.events:
+            return False
+        client.event(service='child')
+        client.flush()
+        return ([e.service for e in client.transport.events] == ['child'] and
+                client.timer.is_alive())
+
+    assert run_in_child(child) == 0
+    assert [e.service for e in client.queue.events] == ['parent']
+    client.stop_timer()
+
+
+@requires_fork
+def test_fork_reconnects_in_child(riemann_server):
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.TCPTransport(
+            riemann_server.host, riemann_server.port, timeout=5),
+        max_delay=300,
+        stay_connected=True)
+    client.event(service='before')
+    client.flush()
+
+    def child():
+        client.event(service='child')
+        return client.flush().ok
+
+    assert run_in_child(child) == 0
+    # The parent's connection was not shut down by the child
+    client.event(service='after')
+    assert client.flush().ok
+    assert riemann_server.connections == 2
+    assert sorted(e.service for m in riemann_server.messages
+                  for e in m.events) == ['after', 'before', 'child']
+    client.stop_timer()
+    client.disconnect()
+
+
+def test_thread_buffers():
+    buffers = riemann_client.client.ThreadBuffers()
+    assert buffers.append(b'a') == 1
+
+    def add():
+        buffers.append(b'b')
+        buffers.append(b'c')
+
+    thread = threading.Thread(target=add)
+    thread.start()
+    thread.join()
+    assert len(buffers) == 3
+
+    message = riemann_client.wire.MessageBuffer()
+    buffers.take(message)
+    assert len(message) == 3 and len(buffers) == 0
+    # The exited thread's empty buffer is forgotten
+    assert len(buffers.buffers) == 1
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_thread_buffered_client(background):
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=300,
+        max_batch_size=50,
+        stay_connected=True,
+        background=background,
+        thread_buffers=True)
+
+    def send(name):
+        for i in range(100):
+            client.event(service=name, description=str(i))
+
+    threads = [threading.Thread(target=send, args=(str(n),))
+               for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not background:
+        # The batch size limit applies to events from every thread
+        assert len(client.transport) >= 800 - 50 * 2
+    client.flush()
+
+    events = client.transport.events
+    assert len(events) == 800
+    for n in range(8):
+        assert [e.description for e in events if e.service == str(n)] == \
+            [str(i) for i in range(100)]
+    if background:
+        client.stop_sender()
+    else:
+        client.stop_timer()
+
+
+def test_max_batch_bytes():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=300,
+        max_batch_size=1000,
+        max_batch_bytes=1000,
+        stay_connected=True)
+    sizes = []
+    send = client.transport.send
+
+    def record_send(message):
+        sizes.append(len(message))
+        return send(message)
+
+    client.transport.send = record_send
+    for i in range(20):
+        client.event(service='test', description='x' * 100)
+    # Each event is about 120 bytes, so the queue is flushed before the 9th
+    # event is added, and batches are not split into several messages
+    assert sizes == [8, 8]
+    assert len(client.transport) == 16
+    assert len(client.queue) == 4
+    client.stop_timer()
+
+
+def test_max_batch_bytes_keeps_order():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=300,
+        max_batch_size=1000,
+        max_batch_bytes=500,
+        stay_connected=True)
+    client.events(*[{'service': 'test', 'description': str(i) * 100}
+                    for i in range(10)])
+    client.flush()
+    assert [e.description for e in client.transport.events] == \
+        [str(i) * 100 for i in range(10)]
+    client.stop_timer()
+
+
+def test_max_batch_bytes_background():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=5,
+        max_batch_size=1000,
+        max_batch_bytes=200,
+        background=True)
+    for i in range(20):
+        client.event(service='test', description='x' * 50)
+    deadline = time.time() + 1
+    while len(client.transport) < 18 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(client.transport) >= 18
+    client.stop_sender()
+    assert len(client.transport) == 20
+
+
+def test_batch_split_by_max_batch_bytes():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        transport=riemann_client.transport.BlankTransport(),
+        max_delay=300,
+        max_batch_size=1000,
+        stay_connected=True)
+    for i in range(20):
+        client.event(service='test', description=str(i) * 100)
+    client.max_batch_bytes = 500
+    sizes = []
+    send = client.transport.send
+
+    def record_send(message):
+        sizes.append(message.ByteSize())
+        return send(message)
+
+    client.transport.send = record_send
+    client.flush()
+    assert len(sizes) > 1 and max(sizes) <= 500
+    assert [e.description for e in client.transport.events] == \
+        [str(i) * 100 for i in range(20)]
+    client.stop_timer()
@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+
+import time
+
+import pytest
+
+import riemann_client.client
+import riemann_client.transport
+from riemann_client.batching import (
+    AdaptiveBatchPolicy, BatchPolicy, StaticBatchPolicy)
+
+
+def test_static_policy():
+    policy = StaticBatchPolicy(max_batch_size=10, max_delay=2)
+    policy.flushed(1000, 0.1, 0.5)
+    assert (policy.max_batch_size, policy.max_delay) == (10, 2)
+    assert policy.idle_delay == 2
+
+
+def test_adaptive_policy_invalid_alpha():
+    with pytest.raises(ValueError):
+        AdaptiveBatchPolicy(alpha=0)
+
+
+def test_adaptive_policy_light_traffic():
+    policy = AdaptiveBatchPolicy(min_batch_size=5, min_delay=0.01)
+    for _ in range(10):
+        # One event a second, with a 10ms round trip
+        policy.flushed(1, 1.0, 0.01)
+    assert (policy.max_batch_size, policy.max_delay) == (5, 0.01)
+    assert policy.idle_delay == 0.5
+
+
+def test_adaptive_policy_heavy_traffic():
+    policy = AdaptiveBatchPolicy(max_batch_size=1000, max_delay=0.5)
+    for _ in range(10):
+        # 10000 events a second, with a 20ms round trip
+        policy.flushed(1000, 0.1, 0.02)
+    assert policy.max_batch_size == 400
+    assert policy.max_delay == pytest.approx(0.04)
+
+
+def test_adaptive_policy_bounds():
+    policy = AdaptiveBatchPolicy(max_batch_size=100, max_delay=0.5)
+    for _ in range(10):
+        policy.flushed(100000, 1.0, 1.0)
+    assert policy.max_batch_size == 100
+    assert policy.max_delay == 0.01
+
+
+def test_adaptive_policy_ignores_failed_sends():
+    policy = AdaptiveBatchPolicy()
+    policy.flushed(100, 1.0, None)
+    assert policy.latency is None
+    assert policy.max_batch_size == 1000
+
+
+class RecordingPolicy(BatchPolicy):
+    max_batch_size = 3
+    max_delay = 300
+
+    def __init__(self):
+        self.batches = []
+
+    def flushed(self, events, interval, latency):
+        self.batches.append((events, latency is not None))
+        self.max_batch_size = 5
+
+
+def test_client_uses_policy():
+    policy = RecordingPolicy()
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        riemann_client.transport.BlankTransport(), batch_policy=policy,
+        stay_connected=True)
+    for _ in range(8):
+        client.event(service='test')
+    client.stop_timer()
+    assert policy.batches == [(3, True), (5, True)]
+    assert client.max_batch_size == 5 and client.max_delay == 300
+
+
+class SlowTransport(riemann_client.transport.BlankTransport):
+    def send(self, message):
+        time.sleep(0.01)
+        return super(SlowTransport, self).send(message)
+
+
+def test_client_adapts_to_load():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        SlowTransport(), stay_connected=True,
+        batch_policy=AdaptiveBatchPolicy(min_batch_size=2, max_batch_size=50))
+    client.max_batch_size = 2
+    for _ in range(500):
+        client.event(service='test')
+    client.flush()
+    client.stop_timer()
+    assert len(client.transport) == 500
+    # Events arrive much faster than batches can be sent
+    assert client.max_batch_size == 50
+
+
+class CountingTransport(riemann_client.transport.BlankTransport):
+    def __init__(self):
+        super(CountingTransport, self).__init__()
+        self.sends = 0
+
+    def send(self, message):
+        self.sends += 1
+        return super(CountingTransport, self).send(message)
+
+
+def test_idle_client_does_not_send_empty_batches():
+    policy = AdaptiveBatchPolicy(min_delay=0.01)
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        CountingTransport(), batch_policy=policy)
+    client.event(service='test')
+    client.flush()
+    checks = []
+    check_for_flush = client.check_for_flush
+
+    def record_check():
+        checks.append(time.time())
+        check_for_flush()
+
+    client.check_for_flush = record_check
+    client.start_timer()
+    time.sleep(0.3)
+    client.stop_timer()
+    assert client.transport.sends == 1
+    assert client.transport.events[0].service == 'test'
+    # The empty queue is checked after the policy's upper delay, rather
+    # than every min_delay
+    assert len(checks) == 1
+
+
+def test_event_after_idle_is_sent_immediately():
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        CountingTransport(), batch_policy=AdaptiveBatchPolicy())
+    time.sleep(0.05)
+    client.event(service='test')
+    client.stop_timer()
+    assert client.transport.sends == 1
+
+
+def test_empty_batches_are_not_passed_to_policy():
+    policy = RecordingPolicy()
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        riemann_client.transport.BlankTransport(), batch_policy=policy)
+    client.flush()
+    client.event(service='test')
+    client.flush()
+    client.stop_timer()
+    assert policy.batches == [(1, True)]
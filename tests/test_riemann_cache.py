@@ -0,0 +1,166 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+import pytest
+
+import riemann_client.cache
+import riemann_client.client
+import riemann_client.riemann_pb2
+import riemann_client.transport
+from riemann_client.cache import QueryCache, response_ttl
+
+
+def response(*events):
+    message = riemann_client.riemann_pb2.Msg()
+    message.ok = True
+    for event in events:
+        message.events.add(**event)
+    return message.SerializeToString()
+
+
+def test_response_ttl():
+    data = response({'time': 100, 'ttl': 30}, {'time': 110, 'ttl': 10},
+                    {'service': 'no ttl'})
+    assert response_ttl(data, now=105) == 15
+    assert response_ttl(response({'service': 'no ttl'})) is None
+
+
+def test_cache_hit():
+    cache, calls = QueryCache(), []
+
+    def send():
+        calls.append(1)
+        return response()
+
+    assert cache.get('true', send) == cache.get('true', send)
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_by_max_age():
+    cache = QueryCache(max_age=0.01)
+    cache.get('true', response)
+    time.sleep(0.02)
+    cache.get('true', response)
+    assert cache.misses == 2
+
+
+def test_expired_by_event_ttl():
+    cache = QueryCache(max_age=None)
+    data = response({'time': int(time.time()) - 10, 'ttl': 5})
+    cache.get('expired', lambda: data)
+    assert len(cache) == 0
+    cache.get('live', lambda: response({'time': int(time.time()), 'ttl': 60}))
+    assert len(cache) == 1
+
+
+def test_not_cached_without_expiry():
+    cache = QueryCache(max_age=None)
+    cache.get('true', response)
+    assert len(cache) == 0
+
+
+def test_lru_eviction_by_entries():
+    cache = QueryCache(max_entries=2)
+    cache.get('a', response)
+    cache.get('b', response)
+    cache.get('a', response)
+    cache.get('c', response)
+    assert list(cache.entries) == ['a', 'c']
+
+
+def test_lru_eviction_by_bytes():
+    data = response({'service': 'x' * 100})
+    cache = QueryCache(max_bytes=len(data) * 2)
+    for query in 'abc':
+        cache.get(query, lambda: data)
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.size == len(data) * 2
+
+
+def test_errors_are_not_cached():
+    cache = QueryCache()
+
+    def send():
+        raise riemann_client.transport.RiemannError('error')
+
+    with pytest.raises(riemann_client.transport.RiemannError):
+        cache.get('true', send)
+    assert len(cache) == 0 and not cache.in_flight
+
+
+def test_invalidate():
+    cache = QueryCache()
+    cache.get('a', response)
+    cache.get('b', response)
+    cache.invalidate('a')
+    assert list(cache.entries) == ['b']
+    cache.invalidate()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_concurrent_queries_are_coalesced():
+    cache, calls = QueryCache(), []
+    started, release = threading.Event(), threading.Event()
+
+    def send():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return response({'service': 'slow'})
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(cache.get('true', send)))
+        for _ in range(8)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert len(results) == 8 and len(set(results)) == 1
+
+
+def test_hits_do_not_wait_for_decoding(monkeypatch):
+    cache = QueryCache()
+    cache.get('cached', response)
+    decoding, release = threading.Event(), threading.Event()
+
+    def slow_response_ttl(data):
+        decoding.set()
+        release.wait(5)
+        return None
+
+    monkeypatch.setattr(riemann_client.cache, 'response_ttl',
+                        slow_response_ttl)
+    thread = threading.Thread(target=cache.get, args=('slow', response))
+    thread.start()
+    try:
+        assert decoding.wait(5)
+        hit = threading.Thread(target=cache.get, args=('cached', response))
+        hit.start()
+        hit.join(1)
+        assert not hit.is_alive()
+    finally:
+        release.set()
+        thread.join()
+    assert len(cache) == 2
+
+
+def test_client_query_cache(riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    client = riemann_client.client.Client(transport, cache=QueryCache())
+    with client:
+        client.event(service='test')
+        assert client.query('true') == client.query('true')
+        assert client.send_query('true').events[0].service == 'test'
+        assert [e['service'] for e in client.query('true', lazy=True)] == \
+            ['test']
+    # One message for the event, and one for the query
+    assert len(riemann_server.messages) == 2
@@ -129,3 +129,59 @@ class TestCreateDict(object):
 
     def test_attibutes_type(self, event_as_dict):
         assert isinstance(event_as_dict['attributes'], dict)
+
+
+class TestSendColumns(object):
+    @pytest.fixture
+    def client(self):
+        return riemann_client.client.Client(
+            riemann_client.transport.BlankTransport())
+
+    def test_columns(self, client):
+        client.send_columns(service=['a', 'b'], metric=[1, 2.5],
+                            state='ok', tags=['x', 'y'], ttl=60)
+        first, second = client.transport.events
+        assert (first.service, first.metric_sint64) == ('a', 1)
+        assert (second.service, second.metric_d) == ('b', 2.5)
+        for event in client.transport.events:
+            assert event.host == socket.gethostname()
+            assert event.state == 'ok'
+            assert list(event.tags) == ['x', 'y']
+            assert event.ttl == 60
+
+    def test_per_event_tags_and_attributes(self, client):
+        client.send_columns(service='test', tags=[['a'], ['b', 'c']],
+                            attributes=[{'k': '1'}, {}])
+        first, second = client.transport.events
+        assert list(first.tags) == ['a']
+        assert list(second.tags) == ['b', 'c']
+        assert [(a.key, a.value) for a in first.attributes] == [('k', '1')]
+        assert len(second.attributes) == 0
+
+    def test_none_values(self, client):
+        client.send_columns(service=['a', 'b'], description=[None, 'b'])
+        first, second = client.transport.events
+        assert not first.HasField('description')
+        assert second.description == 'b'
+
+    def test_tolist(self, client):
+        import array
+        client.send_columns(metric=array.array('d', [1.0, 2.0]),
+                            time=array.array('l', [10, 20]))
+        assert [(e.metric_d, e.time) for e in client.transport.events] == \
+            [(1.0, 10), (2.0, 20)]
+
+    def test_numpy(self, client):
+        numpy = pytest.importorskip('numpy')
+        client.send_columns(service='test', metric=numpy.arange(3) * 0.5,
+                            host=numpy.array(['a', 'b', 'c']))
+        assert [(e.host, e.metric_d) for e in client.transport.events] == \
+            [('a', 0.0), ('b', 0.5), ('c', 1.0)]
+
+    def test_mismatched_lengths(self, client):
+        with pytest.raises(ValueError):
+            client.send_columns(service=['a', 'b'], metric=[1, 2, 3])
+
+    def test_unknown_field(self, client):
+        with pytest.raises(AttributeError):
+            client.send_columns(colour=['red'])
@@ -0,0 +1,193 @@
+from __future__ import absolute_import
+
+import socket
+
+import pytest
+
+import riemann_client.client
+import riemann_client.codec
+import riemann_client.riemann_pb2
+import riemann_client.transport
+from riemann_client.codec import (
+    EventView, ProtobufCodec, WireCodec, event_views)
+
+EVENTS = [
+    {},
+    {'host': 'example.com', 'service': u'service \u2603', 'state': 'ok'},
+    {'description': 'description', 'time': 1234567890, 'ttl': 60.5},
+    {'time': -1, 'metric_sint64': -(2 ** 63)},
+    {'metric_sint64': 2 ** 63 - 1, 'metric_d': 1e300, 'metric_f': 0.1},
+    {'tags': ['a', 'b', u'\u2603'], 'attributes': {'a': '1', 'b': ''}},
+    {'service': 'none', 'state': None, 'host': None},
+]
+
+
+@pytest.fixture(params=[ProtobufCodec, WireCodec])
+def codec(request):
+    return request.param()
+
+
+@pytest.mark.parametrize('data', EVENTS)
+def test_encode_event(codec, data):
+    expected = riemann_client.codec.create_event(dict(data))
+    encoded = riemann_client.riemann_pb2.Event.FromString(
+        codec.encode_event(data))
+    assert encoded == expected
+
+
+@pytest.mark.parametrize('data', EVENTS)
+def test_decode_events(codec, data):
+    message = riemann_client.riemann_pb2.Msg()
+    message.ok = True
+    message.events.add().MergeFrom(
+        riemann_client.codec.create_event(dict(data)))
+    message.events.add().MergeFrom(
+        riemann_client.codec.create_event(dict(data)))
+    expected = riemann_client.codec.create_dict(message.events[0])
+    assert codec.decode_events(message.SerializeToString()) == \
+        [expected, expected]
+
+
+def test_encode_event_default_host(codec):
+    event = riemann_client.riemann_pb2.Event.FromString(
+        codec.encode_event({'service': 'test'}))
+    assert event.host == socket.gethostname()
+
+
+def test_encode_event_unknown_field(codec):
+    with pytest.raises(AttributeError):
+        codec.encode_event({'colour': 'red'})
+
+
+@pytest.mark.parametrize('data', [
+    {'time': 1.7},
+    {'time': '1'},
+    {'metric_sint64': 2.9},
+    {'metric_d': '1.5'},
+    {'metric_f': 'x'},
+    {'service': 5},
+    {'tags': ['a', 1]},
+    {'attributes': {'a': 1}},
+])
+def test_encode_event_invalid_type(codec, data):
+    with pytest.raises(TypeError):
+        codec.encode_event(data)
+
+
+@pytest.mark.parametrize('data', [
+    {'time': 1 << 64},
+    {'metric_sint64': 1 << 63},
+    {'service': b'\xff'},
+])
+def test_encode_event_invalid_value(codec, data):
+    with pytest.raises(ValueError):
+        codec.encode_event(data)
+
+
+def test_encode_event_float_overflow(codec):
+    event = riemann_client.riemann_pb2.Event.FromString(
+        codec.encode_event({'metric_f': 1e300, 'ttl': -1e300}))
+    assert event.metric_f == float('inf')
+    assert event.ttl == float('-inf')
+
+
+def test_encode_query(codec):
+    message = riemann_client.riemann_pb2.Msg.FromString(
+        codec.encode_query('service = "test"'))
+    assert message.query.string == 'service = "test"'
+
+
+def test_decode_ignores_unknown_fields():
+    data = (riemann_client.codec.create_event({'service': 'test'})
+            .SerializeToString() + b'\x58\x01')
+    message = b'\x10\x01\x32' + bytes(bytearray([len(data)])) + data
+    assert WireCodec().decode_events(message) == \
+        [{'host': socket.gethostname(), 'service': 'test'}]
+
+
+def test_select_codec_from_environment(monkeypatch):
+    monkeypatch.setenv('RIEMANN_CLIENT_CODEC', 'protobuf')
+    assert isinstance(riemann_client.codec.select_codec(), ProtobufCodec)
+    monkeypatch.setenv('RIEMANN_CLIENT_CODEC', 'invalid')
+    with pytest.raises(ValueError):
+        riemann_client.codec.select_codec()
+
+
+def test_select_fastest_codec(monkeypatch):
+    monkeypatch.delenv('RIEMANN_CLIENT_CODEC', raising=False)
+    assert isinstance(riemann_client.codec.select_codec(),
+                      tuple(riemann_client.codec.CODECS.values()))
+
+
+def test_client_query(codec, riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    with riemann_client.client.Client(transport, codec) as client:
+        client.event(service='test', tags=['tag'])
+        assert client.query('true') == [{
+            'host': socket.gethostname(), 'service': 'test', 'tags': ['tag']}]
+
+
+def test_send_serialized_error(riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    data = riemann_client.client.Client(transport).codec.encode_event(
+        {'service': 'error'})
+    with transport:
+        with pytest.raises(riemann_client.transport.RiemannError):
+            transport.send_serialized(b'\x32' + bytes(bytearray(
+                [len(data)])) + data)
+
+
+@pytest.mark.parametrize('data', EVENTS)
+def test_event_view(data):
+    event = riemann_client.codec.create_event(dict(data))
+    view = EventView(event.SerializeToString())
+    expected = riemann_client.codec.create_dict(event)
+    assert view == expected
+    assert view.to_dict() == expected
+    assert sorted(view) == sorted(expected)
+    assert len(view) == len(expected)
+
+
+def test_event_view_is_read_only():
+    view = EventView(riemann_client.codec.create_event(
+        {'service': 'test'}).SerializeToString())
+    assert view['service'] == 'test'
+    assert view.get('description') is None
+    with pytest.raises(KeyError):
+        view['description']
+    with pytest.raises(TypeError):
+        view['service'] = 'changed'
+    with pytest.raises(AttributeError):
+        view.other = 'value'
+
+
+def test_event_views():
+    message = riemann_client.riemann_pb2.Msg()
+    message.ok = True
+    for i in range(3):
+        message.events.add().service = str(i)
+    views = event_views(message.SerializeToString())
+    assert [view['service'] for view in views] == ['0', '1', '2']
+
+
+def test_client_lazy_query(riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    with riemann_client.client.Client(transport) as client:
+        client.event(service='test', metric_f=1.5)
+        events = client.query('true', lazy=True)
+        assert [(e['service'], e['metric_f']) for e in events] == \
+            [('test', 1.5)]
+        assert events[0].to_dict() == client.query('true')[0]
+
+
+def test_client_iter_query(codec, riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    with riemann_client.client.Client(transport, codec) as client:
+        client.events(*({'service': str(i)} for i in range(5)))
+        events = client.iter_query('true')
+        assert [e['service'] for e in events] == [str(i) for i in range(5)]
+        assert list(client.iter_query('true')) == client.query('true')
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+
+import json
+import socket
+
+import pytest
+
+import riemann_client.riemann_pb2
+import riemann_client.transport
+from riemann_client.relay import Relay
+
+
+@pytest.fixture
+def relay(request, tmpdir):
+    relay = Relay(riemann_client.transport.BlankTransport(),
+                  udp_address=('127.0.0.1', 0),
+                  unix_path=str(tmpdir.join('relay.sock')),
+                  json_lines=True,
+                  max_delay=300)
+    relay.bind()
+    request.addfinalizer(relay.close)
+    return relay
+
+
+def message(*services):
+    message = riemann_client.riemann_pb2.Msg()
+    for service in services:
+        message.events.add().service = service
+    return message.SerializeToString()
+
+
+def send(relay, family, data):
+    address = relay.sockets[0 if family == socket.AF_INET else 1] \
+        .getsockname()
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.sendto(data, address)
+    sock.close()
+    relay.poll(5)
+
+
+def services(relay):
+    relay.client.flush()
+    return [e.service for e in relay.client.transport.events]
+
+
+def test_udp(relay):
+    send(relay, socket.AF_INET, message('one', 'two'))
+    send(relay, socket.AF_INET, message('three'))
+    assert services(relay) == ['one', 'two', 'three']
+
+
+def test_unix(relay):
+    send(relay, socket.AF_UNIX, message('one'))
+    assert services(relay) == ['one']
+
+
+def test_json_lines(relay):
+    lines = [json.dumps({'service': 'one', 'tags': ['a']}),
+             json.dumps({'service': 'two', 'metric_f': 1.5})]
+    send(relay, socket.AF_INET, '\n'.join(lines).encode('utf-8'))
+    assert services(relay) == ['one', 'two']
+
+
+def test_invalid_datagram(relay):
+    send(relay, socket.AF_INET, b'\xff\xff\xff')
+    send(relay, socket.AF_INET, message('one'))
+    assert services(relay) == ['one']
+
+
+def test_batches(relay):
+    for i in range(10):
+        send(relay, socket.AF_INET, message(str(i)))
+    assert len(relay.client.transport) == 0
+    assert len(services(relay)) == 10
+
+
+def test_invalid_event(relay):
+    # A well formed message containing a truncated event
+    send(relay, socket.AF_INET, b'\x32\x02\x1a\x05')
+    send(relay, socket.AF_INET, message('one'))
+    assert services(relay) == ['one']
+
+
+def test_close_idle_relay():
+    relay = Relay(riemann_client.transport.TCPTransport('127.0.0.1', 1),
+                  udp_address=('127.0.0.1', 0))
+    relay.bind()
+    relay.close()
@@ -0,0 +1,116 @@
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+import riemann_client.client
+import riemann_client.transport
+from riemann_client.ring import RingCollector, RingProducer
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(os, 'fork'), reason="rings require a POSIX system")
+
+
+@pytest.fixture
+def collector(request, tmpdir):
+    client = riemann_client.client.QueuedClient(
+        riemann_client.transport.BlankTransport())
+    collector = RingCollector(client, str(tmpdir.join('events.ring')),
+                              slots=4, slot_size=256)
+    request.addfinalizer(collector.close)
+    return collector
+
+
+@pytest.fixture
+def producer(request, collector):
+    producer = RingProducer(collector.path)
+    request.addfinalizer(producer.close)
+    return producer
+
+
+def services(collector):
+    return [e.service for e in collector.client.queue.events]
+
+
+def test_collect_events(collector, producer):
+    producer.event(service='a')
+    producer.events({'service': 'b'}, {'service': 'c'})
+    assert collector.drain() == 3
+    assert services(collector) == ['a', 'b', 'c']
+    assert collector.drain() == 0
+
+
+def test_ring_wraps_around(collector, producer):
+    for i in range(50):
+        producer.event(service='{0:03d}'.format(i), description='x' * i)
+        collector.drain()
+    assert services(collector) == ['{0:03d}'.format(i) for i in range(50)]
+    assert collector.dropped == 0
+
+
+def test_full_ring_drops_events(collector, producer):
+    for i in range(20):
+        producer.event(service='test', description='x' * 20)
+    assert 0 < producer.dropped < 20
+    assert collector.drain() + collector.dropped == 20
+
+
+def test_one_producer_per_process(collector, producer):
+    with pytest.raises(RuntimeError):
+        RingProducer(collector.path)
+
+
+def test_invalid_file(tmpdir):
+    path = tmpdir.join('invalid.ring')
+    path.write(b'\0' * 64, mode='wb')
+    with pytest.raises(ValueError):
+        RingProducer(str(path))
+
+
+def run_in_child(function):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            function()
+            status = 0
+        finally:
+            os._exit(status)
+    return os.waitpid(pid, 0)[1]
+
+
+def test_refused_producer_keeps_claim(collector, producer):
+    with pytest.raises(RuntimeError):
+        RingProducer(collector.path)
+
+    def child():
+        assert RingProducer(collector.path).slot != producer.slot
+
+    assert run_in_child(child) == 0
+
+
+def test_producer_processes(collector, producer):
+    def child():
+        RingProducer(collector.path).event(service='child')
+
+    for _ in range(5):
+        # Each child's ring is released when it exits
+        assert run_in_child(child) == 0
+    producer.event(service='parent')
+    collector.drain()
+    assert sorted(services(collector)) == ['child'] * 5 + ['parent']
+
+
+def test_inherited_producer_claims_a_ring(collector, producer):
+    producer.event(service='parent')
+    assert run_in_child(lambda: producer.event(service='child')) == 0
+    collector.drain()
+    assert sorted(services(collector)) == ['child', 'parent']
+
+
+def test_collector_thread(collector, producer):
+    collector.start()
+    producer.event(service='test')
+    collector.stop()
+    assert services(collector) == ['test']
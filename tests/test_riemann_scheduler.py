@@ -0,0 +1,167 @@
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+
+import pytest
+
+import riemann_client.client
+import riemann_client.scheduler
+import riemann_client.transport
+from riemann_client.scheduler import Scheduler
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_calls_run_in_deadline_order():
+    scheduler, calls = Scheduler(), []
+    for delay in (0.03, 0.01, 0.02):
+        scheduler.call_later(delay, lambda d=delay: calls.append(d))
+    assert wait_for(lambda: len(calls) == 3)
+    assert calls == [0.01, 0.02, 0.03]
+
+
+def test_cancel():
+    scheduler, calls = Scheduler(), []
+    call = scheduler.call_later(0.01, lambda: calls.append('cancelled'))
+    scheduler.call_later(0.02, lambda: calls.append('called'))
+    assert call.is_alive()
+    call.cancel()
+    assert not call.is_alive()
+    assert wait_for(lambda: calls)
+    assert calls == ['called']
+
+
+def test_cancelled_calls_are_compacted(monkeypatch):
+    monkeypatch.setattr(riemann_client.scheduler, 'COMPACT_THRESHOLD', 4)
+    scheduler = Scheduler()
+    calls = [scheduler.call_later(60, lambda: None) for _ in range(10)]
+    for call in calls[:6]:
+        call.cancel()
+    assert len(scheduler.heap) == 4 and len(scheduler) == 4
+
+
+def test_errors_do_not_stop_the_thread():
+    scheduler, calls = Scheduler(), []
+
+    def fail():
+        raise ValueError('error')
+
+    scheduler.call_later(0, fail)
+    scheduler.call_later(0.01, lambda: calls.append(1))
+    assert wait_for(lambda: calls)
+    assert scheduler.thread.is_alive()
+
+
+def test_blocking_call_does_not_delay_later_calls():
+    scheduler, release, calls = Scheduler(), threading.Event(), []
+    scheduler.call_later(0, release.wait)
+    scheduler.call_later(0.01, lambda: calls.append(time.time()))
+    started = time.time()
+    try:
+        assert wait_for(lambda: calls, timeout=1)
+        assert calls[0] - started < 0.5
+    finally:
+        release.set()
+
+
+def test_idle_workers_exit():
+    scheduler, calls = Scheduler(idle_timeout=0.01), []
+    scheduler.call_later(0, lambda: calls.append(1))
+    assert wait_for(lambda: calls)
+    assert wait_for(lambda: scheduler.workers == 0)
+    scheduler.call_later(0, lambda: calls.append(2))
+    assert wait_for(lambda: len(calls) == 2)
+
+
+def test_workers_are_limited():
+    scheduler = Scheduler(max_workers=2)
+    release, calls = threading.Event(), []
+    for _ in range(3):
+        scheduler.call_later(0, release.wait)
+    scheduler.call_later(0, lambda: calls.append(1))
+    try:
+        assert wait_for(lambda: scheduler.workers == 2)
+        time.sleep(0.05)
+        assert scheduler.workers == 2 and not calls
+    finally:
+        release.set()
+    assert wait_for(lambda: calls)
+
+
+def test_rescheduling_does_not_start_threads():
+    scheduler = Scheduler()
+    call = scheduler.call_later(60, lambda: None)
+    threads = threading.active_count()
+    for _ in range(100):
+        call.cancel()
+        call = scheduler.call_later(60, lambda: None)
+    assert threading.active_count() == threads
+
+
+def test_clients_share_one_thread():
+    threads = threading.active_count()
+    clients = [riemann_client.client.AutoFlushingQueuedClient(
+        riemann_client.transport.BlankTransport(), max_delay=0.01)
+        for _ in range(20)]
+    for client in clients:
+        client.event(service='test')
+    assert wait_for(lambda: all(len(c.transport) for c in clients))
+    # The scheduler's thread and at most a few workers are started
+    assert (threading.active_count() <=
+            threads + 1 + riemann_client.scheduler.MAX_WORKERS)
+    for client in clients:
+        client.stop_timer()
+
+
+class StalledTransport(riemann_client.transport.BlankTransport):
+    def __init__(self, release):
+        super(StalledTransport, self).__init__()
+        self.release = release
+
+    def send(self, message):
+        self.release.wait(5)
+        return super(StalledTransport, self).send(message)
+
+
+def test_stalled_client_does_not_delay_other_clients():
+    release = threading.Event()
+    stalled = riemann_client.client.AutoFlushingQueuedClient(
+        StalledTransport(release), max_delay=0.05)
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        riemann_client.transport.BlankTransport(), max_delay=0.2)
+    try:
+        stalled.event(service='stalled')
+        client.event(service='test')
+        started = time.time()
+        assert wait_for(lambda: len(client.transport), timeout=1)
+        assert time.time() - started < 0.5
+    finally:
+        release.set()
+        stalled.stop_timer()
+        client.stop_timer()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'),
+                    reason="os.fork is not available")
+def test_fork_resets_scheduler():
+    scheduler = riemann_client.scheduler.default_scheduler()
+    parent_call = scheduler.call_later(60, lambda: None)
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            called = threading.Event()
+            if all(e[2] is not parent_call for e in scheduler.heap):
+                scheduler.call_later(0, called.set)
+                status = 0 if called.wait(5) else 1
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    parent_call.cancel()
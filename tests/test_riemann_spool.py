@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from riemann_client.spool import Spool
+
+
+@pytest.fixture
+def spool(tmpdir):
+    return Spool(str(tmpdir.join('spool')), segment_size=64, max_size=1024)
+
+
+def drain(spool):
+    messages = []
+    while True:
+        message = spool.peek()
+        if message is None:
+            return messages
+        messages.append(message)
+        spool.commit()
+
+
+def test_empty(spool):
+    assert spool.peek() is None
+    assert len(spool) == 0
+
+
+def test_order(spool):
+    for i in range(20):
+        spool.append('message-{0}'.format(i).encode('utf-8'))
+    assert drain(spool) == [
+        'message-{0}'.format(i).encode('utf-8') for i in range(20)]
+    assert len(spool) == 0
+    assert os.listdir(spool.directory) == []
+
+
+def test_peek_without_commit(spool):
+    spool.append(b'one')
+    spool.append(b'two')
+    assert spool.peek() == b'one'
+    assert spool.peek() == b'one'
+    spool.commit()
+    assert spool.peek() == b'two'
+
+
+def test_segments_rotate(spool):
+    for i in range(20):
+        spool.append(b'x' * 28)
+    assert len(spool) == 10
+
+
+def test_append_while_draining(spool):
+    spool.append(b'one')
+    assert spool.peek() == b'one'
+    spool.append(b'two')
+    spool.commit()
+    assert drain(spool) == [b'two']
+
+
+def test_max_size_discards_oldest(spool):
+    for i in range(100):
+        spool.append('{0:030d}'.format(i).encode('utf-8'))
+    assert spool.size <= spool.max_size
+    messages = drain(spool)
+    assert messages[-1] == '{0:030d}'.format(99).encode('utf-8')
+    assert len(messages) < 100
+
+
+def test_replay_after_restart(spool):
+    spool.append(b'one')
+    spool.append(b'two')
+    spool.close()
+    reopened = Spool(spool.directory)
+    assert drain(reopened) == [b'one', b'two']
+
+
+def test_truncated_message(spool):
+    spool.append(b'one')
+    spool.close()
+    path = spool.path(spool.segments[0])
+    with open(path, 'ab') as segment:
+        segment.write(b'\x00\x00\x00\x09abc')
+    assert drain(Spool(spool.directory)) == [b'one']
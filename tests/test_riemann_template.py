@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+
+import socket
+
+import pytest
+
+import riemann_client.client
+import riemann_client.transport
+from riemann_client.template import EventTemplate
+
+
+@pytest.fixture
+def template():
+    return EventTemplate(service_prefix='app.', tags=['a', 'b'],
+                         attributes={'dc': 'eu'}, ttl=60, state='ok')
+
+
+def test_constant_fields(template):
+    event = template.create_event()
+    assert event.host == socket.gethostname()
+    assert list(event.tags) == ['a', 'b']
+    assert [(a.key, a.value) for a in event.attributes] == [('dc', 'eu')]
+    assert event.ttl == 60
+    assert event.state == 'ok'
+
+
+def test_variable_fields(template):
+    event = template.create_event(
+        service='requests', metric_f=1.5, time=100, description='test',
+        state='critical', host='override')
+    assert event.service == 'app.requests'
+    assert event.metric_f == 1.5
+    assert event.time == 100
+    assert event.description == 'test'
+    assert event.state == 'critical'
+    assert event.host == 'override'
+
+
+def test_additional_tags_and_attributes(template):
+    event = template.create_event(tags=['c'], attributes={'rack': '1'})
+    assert list(event.tags) == ['a', 'b', 'c']
+    assert dict((a.key, a.value) for a in event.attributes) == \
+        {'dc': 'eu', 'rack': '1'}
+
+
+@pytest.mark.parametrize('metric,field', [
+    (5, 'metric_sint64'), (-5, 'metric_sint64'), (0.5, 'metric_d')])
+def test_metric(template, metric, field):
+    event = template.create_event(metric=metric)
+    assert event.HasField(field)
+    assert getattr(event, field) == metric
+
+
+def test_matches_create_event():
+    template = EventTemplate(host='host', tags=['tag'])
+    assert template.create_event(service='service', metric_f=2) == \
+        riemann_client.client.Client.create_event({
+            'host': 'host', 'tags': ['tag'], 'service': 'service',
+            'metric_f': 2})
+
+
+def test_unknown_field(template):
+    with pytest.raises(TypeError):
+        template.serialize(colour='red')
+
+
+@pytest.mark.parametrize('client_class', [
+    riemann_client.client.Client,
+    riemann_client.client.QueuedClient,
+    riemann_client.client.AutoFlushingQueuedClient,
+])
+def test_send_serialized_events(template, client_class):
+    transport = riemann_client.transport.BlankTransport()
+    client = client_class(transport)
+    client.send_serialized_events(
+        template.serialize(service=str(i)) for i in range(3))
+    if hasattr(client, 'flush'):
+        client.flush()
+    assert [e.service for e in transport.events] == \
+        ['app.0', 'app.1', 'app.2']
+    if hasattr(client, 'stop_timer'):
+        client.stop_timer()
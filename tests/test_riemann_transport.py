@@ -1,20 +1,41 @@
 from __future__ import absolute_import
 
+import socket
+import struct
+import threading
+import time
+
 import pytest
 
+import riemann_client.client
 import riemann_client.riemann_pb2
 import riemann_client.transport
 
-from riemann_client.transport import socket_recvall
+from riemann_client.transport import (
+    FrameBuffer, socket_recvall, socket_sendall_frame)
+
+from .conftest import FakeRiemannServer
 
 
 class FakeSocket(object):
-    def __init__(self):
-        self.data = [b'hello', b'world', b'']
+    def __init__(self, data=(b'hello', b'world', b'')):
+        self.data = list(data)
+        self.sent = []
 
     def recv(self, bufsize):
         return self.data.pop(0)
 
+    def recv_into(self, view):
+        chunk = self.data.pop(0)[:len(view)]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendmsg(self, buffers):
+        # Simulate a short write, sending at most 3 bytes at a time
+        data = b''.join(bytes(b) for b in buffers)[:3]
+        self.sent.append(data)
+        return len(data)
+
 
 def test_socket_recvall():
     assert socket_recvall(FakeSocket(), 10) == b'helloworld'
@@ -24,6 +45,29 @@ def test_socket_recvall_short():
     assert socket_recvall(FakeSocket(), 5) == b'hello'
 
 
+def test_frame_buffer_short_reads():
+    data = [b'\x00', b'\x00\x00', b'\x05', b'he', b'l', b'lo']
+    assert FrameBuffer().recv_frame(FakeSocket(data)) == b'hello'
+
+
+def test_frame_buffer_grows():
+    buffer = FrameBuffer(size=2)
+    frame = buffer.recv_frame(FakeSocket([struct.pack('!I', 5), b'hello']))
+    assert frame == b'hello'
+    assert len(buffer.buffer) == 5
+
+
+def test_frame_buffer_closed():
+    with pytest.raises(socket.error):
+        FrameBuffer().recv_frame(FakeSocket([b'\x00\x00', b'']))
+
+
+def test_socket_sendall_frame():
+    sock = FakeSocket()
+    socket_sendall_frame(sock, b'hello')
+    assert b''.join(sock.sent) == struct.pack('!I', 5) + b'hello'
+
+
 @pytest.fixture
 def tcp_transport():
     return riemann_client.transport.TCPTransport()
@@ -42,3 +86,403 @@ def test_transport_enter(string_transport):
     assert not hasattr(string_transport, 'string')
     with string_transport:
         assert hasattr(string_transport, 'string')
+
+
+def message_with_service(service):
+    message = riemann_client.riemann_pb2.Msg()
+    message.events.add().service = service
+    return message
+
+
+@pytest.fixture
+def pipelined_transport(request, riemann_server):
+    transport = riemann_client.transport.PipelinedTCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5, max_in_flight=4)
+    transport.connect()
+    request.addfinalizer(transport.disconnect)
+    return transport
+
+
+def test_pipelined_send(pipelined_transport):
+    assert pipelined_transport.send(message_with_service('one')).ok
+
+
+def test_pipelined_send_async(pipelined_transport, riemann_server):
+    futures = [pipelined_transport.send_async(message_with_service(str(i)))
+               for i in range(20)]
+    assert all(future.result(5).ok for future in futures)
+    assert [m.events[0].service for m in riemann_server.messages] == \
+        [str(i) for i in range(20)]
+
+
+def test_pipelined_error_reaches_caller(pipelined_transport):
+    ok = pipelined_transport.send_async(message_with_service('one'))
+    error = pipelined_transport.send_async(message_with_service('error'))
+    after = pipelined_transport.send_async(message_with_service('two'))
+    assert ok.result(5).ok
+    with pytest.raises(riemann_client.transport.RiemannError):
+        error.result(5)
+    assert after.result(5).ok
+
+
+def test_pipelined_write_times_out(request):
+    # A server that accepts the connection, but never reads from it
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    request.addfinalizer(listener.close)
+    transport = riemann_client.transport.PipelinedTCPTransport(
+        *listener.getsockname(), timeout=0.2, max_in_flight=1000)
+    transport.connect()
+    request.addfinalizer(transport.disconnect)
+    connection, _ = listener.accept()
+    request.addfinalizer(connection.close)
+
+    message = message_with_service('x' * 1024 * 1024)
+    started = time.time()
+    with pytest.raises(socket.timeout):
+        for _ in range(100):
+            transport.send_async(message)
+    assert time.time() - started < 5
+    # The connection can't be used after a partly written message
+    with pytest.raises(socket.error):
+        transport.send_async(message).result(1)
+
+
+def test_pooled_send_from_threads(riemann_server):
+    transport = riemann_client.transport.PooledTCPTransport(
+        riemann_server.host, riemann_server.port, max_connections=2)
+    responses = []
+
+    def send():
+        for i in range(10):
+            responses.append(transport.send(message_with_service('pool')))
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    transport.disconnect()
+
+    assert len(responses) == 80 and all(r.ok for r in responses)
+    assert riemann_server.connections <= 2
+
+
+def test_pooled_reuses_connections(riemann_server):
+    transport = riemann_client.transport.PooledTCPTransport(
+        riemann_server.host, riemann_server.port)
+    for i in range(5):
+        transport.send(message_with_service('pool'))
+    assert riemann_server.connections == 1
+
+
+def test_pooled_riemann_error_keeps_connection(riemann_server):
+    transport = riemann_client.transport.PooledTCPTransport(
+        riemann_server.host, riemann_server.port)
+    with pytest.raises(riemann_client.transport.RiemannError):
+        transport.send(message_with_service('error'))
+    assert transport.send(message_with_service('pool')).ok
+    assert riemann_server.connections == 1
+
+
+class BrokenTransport(riemann_client.transport.BlankTransport):
+    created = 0
+
+    def connect(self):
+        BrokenTransport.created += 1
+
+    def send(self, message):
+        raise socket.error("Broken pipe")
+
+
+def test_pooled_discards_broken_connections():
+    transport = riemann_client.transport.PooledTransport(
+        BrokenTransport, max_connections=1)
+    for i in range(3):
+        with pytest.raises(socket.error):
+            transport.send(message_with_service('pool'))
+    assert BrokenTransport.created == 3
+
+
+@pytest.fixture
+def udp_listener(request):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.settimeout(5)
+    request.addfinalizer(listener.close)
+    return listener
+
+
+def test_udp_splits_large_messages(udp_listener):
+    message = riemann_client.riemann_pb2.Msg()
+    for i in range(200):
+        message.events.add().service = 'service-{0:03d}'.format(i)
+
+    transport = riemann_client.transport.UDPTransport(
+        *udp_listener.getsockname(), max_datagram_size=512)
+    with transport:
+        transport.send(message)
+
+    received = riemann_client.riemann_pb2.Msg()
+    while len(received.events) < 200:
+        datagram = udp_listener.recv(65535)
+        assert len(datagram) <= 512
+        received.MergeFromString(datagram)
+    assert received == message
+
+
+def test_udp_refused_datagram_does_not_drop_batch(request):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    address = listener.getsockname()
+    listener.close()
+
+    message = riemann_client.riemann_pb2.Msg()
+    for i in range(50):
+        message.events.add().service = 'service-{0:03d}'.format(i)
+    transport = riemann_client.transport.UDPTransport(
+        *address, max_datagram_size=512)
+    with transport:
+        # The ICMP error for this datagram is reported by the next send
+        transport.send(riemann_client.riemann_pb2.Msg(ok=True))
+        time.sleep(0.05)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        request.addfinalizer(listener.close)
+        listener.bind(address)
+        listener.settimeout(5)
+        transport.send(message)
+
+    received = riemann_client.riemann_pb2.Msg()
+    while len(received.events) < 50:
+        received.MergeFromString(listener.recv(65535))
+    assert received == message
+
+
+def test_udp_prefers_ipv4(monkeypatch):
+    transport = riemann_client.transport.UDPTransport('localhost', 5555)
+    monkeypatch.setattr(transport, 'resolve', lambda socktype: [
+        (socket.AF_INET6, socket.SOCK_DGRAM, 17, '', ('::1', 5555, 0, 0)),
+        (socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('127.0.0.1', 5555)),
+    ])
+    with transport:
+        assert transport.socket.family == socket.AF_INET
+        assert transport.socket.getpeername() == ('127.0.0.1', 5555)
+
+
+def test_address_cache(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(*args):
+        lookups.append(args)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 1))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    cache = riemann_client.transport.AddressCache()
+    for _ in range(3):
+        cache.resolve('riemann.example', 5555, socket.SOCK_STREAM)
+    assert len(lookups) == 1
+
+    cache.invalidate('riemann.example', 5555, socket.SOCK_STREAM)
+    cache.resolve('riemann.example', 5555, socket.SOCK_STREAM, ttl=0)
+    cache.resolve('riemann.example', 5555, socket.SOCK_STREAM)
+    assert len(lookups) == 3
+
+
+def test_address_cache_interleave():
+    addresses = [(socket.AF_INET6, 1), (socket.AF_INET6, 2),
+                 (socket.AF_INET, 3), (socket.AF_INET, 4)]
+    interleaved = riemann_client.transport.AddressCache.interleave(addresses)
+    assert [a[1] for a in interleaved] == [1, 3, 2, 4]
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_create_connection_falls_back(riemann_server):
+    refused = ('127.0.0.1', closed_port())
+    addresses = [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '', refused),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+         (riemann_server.host, riemann_server.port)),
+    ]
+    sock = riemann_client.transport.create_connection(addresses, timeout=5)
+    assert sock.getpeername() == (riemann_server.host, riemann_server.port)
+    assert sock.gettimeout() == 5
+    sock.close()
+
+
+def test_create_connection_refused():
+    refused = ('127.0.0.1', closed_port())
+    with pytest.raises(socket.error):
+        riemann_client.transport.create_connection(
+            [(socket.AF_INET, socket.SOCK_STREAM, 6, '', refused)])
+
+
+def test_hash_ring_moves_few_keys():
+    ring = riemann_client.transport.HashRing()
+    for name in ('a', 'b', 'c', 'd'):
+        ring.add(name, name)
+    keys = [str(i).encode('utf-8') for i in range(2000)]
+    before = dict((key, ring.get(key)) for key in keys)
+    assert set(before.values()) == set('abcd')
+
+    ring.add('e', 'e')
+    after = dict((key, ring.get(key)) for key in keys)
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(after[key] == 'e' for key in moved)
+    assert len(moved) < len(keys) / 3
+
+    ring.remove('e')
+    assert dict((key, ring.get(key)) for key in keys) == before
+
+
+def test_sharded_transport_routes_streams():
+    transports = [riemann_client.transport.BlankTransport() for _ in range(3)]
+    sharded = riemann_client.transport.ShardedTransport()
+    for index, transport in enumerate(transports):
+        sharded.add_transport(transport, name=str(index))
+
+    message = riemann_client.riemann_pb2.Msg()
+    for i in range(300):
+        event = message.events.add()
+        event.host = 'host-{0}'.format(i % 10)
+        event.service = 'service-{0}'.format(i % 7)
+        event.metric_d = i
+    assert sharded.send(message).ok
+
+    assert sum(len(t) for t in transports) == 300
+    assert all(len(t) > 0 for t in transports)
+    streams = [set((e.host, e.service) for e in t.events)
+               for t in transports]
+    assert not streams[0] & streams[1]
+    assert not streams[1] & streams[2]
+
+
+def test_sharded_transport_queries_every_server(request):
+    servers = [FakeRiemannServer() for _ in range(2)]
+    for server in servers:
+        request.addfinalizer(server.close)
+    transports = [riemann_client.transport.TCPTransport(s.host, s.port, 5)
+                  for s in servers]
+    sharded = riemann_client.transport.ShardedTransport(transports)
+    with sharded:
+        message = riemann_client.riemann_pb2.Msg()
+        for i in range(20):
+            message.events.add().service = str(i)
+        sharded.send(message)
+
+        query = riemann_client.riemann_pb2.Msg()
+        query.query.string = 'true'
+        response = sharded.send(query)
+    assert sorted(e.service for e in response.events) == \
+        sorted(str(i) for i in range(20))
+    assert all(len(s.messages) == 2 for s in servers)
+
+
+def test_sharded_transport_stays_connected(request):
+    servers = [FakeRiemannServer() for _ in range(2)]
+    for server in servers:
+        request.addfinalizer(server.close)
+    sharded = riemann_client.transport.ShardedTransport(
+        [riemann_client.transport.TCPTransport(s.host, s.port, 5)
+         for s in servers])
+    client = riemann_client.client.AutoFlushingQueuedClient(
+        sharded, max_delay=300, stay_connected=True)
+    assert not client.is_connected()
+    for i in range(5):
+        client.event(service=str(i))
+        client.flush()
+    assert client.is_connected()
+    assert [s.connections for s in servers] == [1, 1]
+    client.stop_timer()
+    client.disconnect()
+
+
+def test_tls_session_resumption(tls_riemann_server, certificate):
+    transport = riemann_client.transport.TLSTransport(
+        tls_riemann_server.host, tls_riemann_server.port, timeout=5,
+        ca_certs=certificate)
+    for _ in range(2):
+        with transport:
+            assert transport.send(message_with_service('tls')).ok
+            reused = transport.socket.session_reused
+    assert reused
+    assert transport.context is riemann_client.transport.TLSTransport(
+        ca_certs=certificate).context
+
+
+def query_message():
+    message = riemann_client.riemann_pb2.Msg()
+    message.query.string = 'true'
+    return message.SerializeToString()
+
+
+def store_events(transport, count):
+    message = riemann_client.riemann_pb2.Msg()
+    for i in range(count):
+        message.events.add().service = str(i)
+    transport.send(message)
+
+
+@pytest.fixture
+def connected_transport(request, riemann_server):
+    transport = riemann_client.transport.TCPTransport(
+        riemann_server.host, riemann_server.port, timeout=5)
+    transport.connect()
+    request.addfinalizer(transport.disconnect)
+    return transport
+
+
+def test_response_stream_short_reads():
+    message = riemann_client.riemann_pb2.Msg()
+    message.ok = True
+    message.events.add().service = 'x' * 100
+    data = message.SerializeToString()
+    chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+    stream = riemann_client.transport.ResponseStream(
+        FakeSocket(chunks), len(data), chunk_size=3)
+    assert [(n, v) for n, _, v in stream.fields()] == [
+        (2, 1), (6, message.events[0].SerializeToString())]
+
+
+def test_stream_serialized(connected_transport, riemann_server):
+    connected_transport.stream_chunk_size = 16
+    store_events(connected_transport, 50)
+    events = connected_transport.stream_serialized(query_message())
+    assert [riemann_client.riemann_pb2.Event.FromString(e).service
+            for e in events] == [str(i) for i in range(50)]
+
+
+def test_stream_serialized_closed_early(connected_transport, riemann_server):
+    connected_transport.stream_chunk_size = 16
+    store_events(connected_transport, 50)
+    events = connected_transport.stream_serialized(query_message())
+    next(events)
+    events.close()
+    # The rest of the response was discarded, so the connection can be reused
+    assert connected_transport.send(message_with_service('after')).ok
+    assert riemann_server.connections == 1
+
+
+def test_stream_serialized_error(connected_transport):
+    message = message_with_service('error').SerializeToString()
+    with pytest.raises(riemann_client.transport.RiemannError):
+        list(connected_transport.stream_serialized(message))
+
+
+def test_pooled_stream_closed_early(riemann_server):
+    transport = riemann_client.transport.PooledTCPTransport(
+        riemann_server.host, riemann_server.port, max_connections=1)
+    store_events(transport, 10)
+    events = transport.stream_serialized(query_message())
+    next(events)
+    events.close()
+    assert len(list(transport.stream_serialized(query_message()))) == 10
+    assert riemann_server.connections == 1
+    transport.disconnect()
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+
+import pytest
+
+import riemann_client.riemann_pb2
+from riemann_client.wire import (
+    DecodeError, MessageBuffer, decode_varint, encode_varint, field_encoder,
+    iter_fields, split_message)
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2 ** 32, 2 ** 63])
+def test_varint_roundtrip(value):
+    data = encode_varint(value)
+    assert decode_varint(data, 0) == (value, len(data))
+
+
+@pytest.mark.parametrize('name,value', [
+    ('service', u'service \u2603'),
+    ('time', 1234567890),
+    ('time', -1),
+    ('metric_sint64', -300),
+    ('metric_sint64', 2 ** 62),
+    ('metric_d', 1.5),
+    ('metric_f', 0.25),
+])
+def test_field_encoder(name, value):
+    event = riemann_client.riemann_pb2.Event()
+    setattr(event, name, value)
+    encode = field_encoder(event.DESCRIPTOR.fields_by_name[name])
+    assert encode(value) == event.SerializeToString()
+
+
+def test_field_encoder_unsupported():
+    with pytest.raises(TypeError):
+        field_encoder(riemann_client.riemann_pb2.Msg.DESCRIPTOR
+                      .fields_by_name['ok'])
+
+
+def test_varint_truncated():
+    with pytest.raises(DecodeError):
+        decode_varint(b'\x80\x80', 0)
+
+
+@pytest.fixture
+def message():
+    message = riemann_client.riemann_pb2.Msg()
+    message.ok = True
+    for i in range(100):
+        event = message.events.add()
+        event.service = 'service-{0}'.format(i)
+        event.metric_d = i
+        event.ttl = 60
+    return message
+
+
+def test_iter_fields(message):
+    data = message.SerializeToString()
+    fields = list(iter_fields(data))
+    assert fields[0][:3] == (2, 0, 1)
+    assert len(fields) == 101
+    assert fields[-1][4] == len(data)
+    event = riemann_client.riemann_pb2.Event.FromString(fields[1][2])
+    assert event == message.events[0]
+
+
+def test_iter_fields_truncated(message):
+    with pytest.raises(DecodeError):
+        list(iter_fields(message.SerializeToString()[:-1]))
+
+
+def test_split_message_small(message):
+    data = message.SerializeToString()
+    assert list(split_message(data, len(data))) == [data]
+
+
+def test_split_message(message):
+    chunks = list(split_message(message.SerializeToString(), 200))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+
+    merged = riemann_client.riemann_pb2.Msg()
+    for chunk in chunks:
+        merged.MergeFromString(chunk)
+    assert merged == message
+
+
+def test_split_message_oversized_field(message):
+    chunks = list(split_message(message.SerializeToString(), 1))
+    assert len(chunks) == 101
+
+
+def test_message_buffer(message):
+    buffer = MessageBuffer()
+    for event in message.events:
+        buffer.append(event.SerializeToString())
+    assert len(buffer) == 100
+    assert buffer.events == message.events
+    assert buffer.ByteSize() == len(buffer.SerializeToString())
+
+
+def test_message_buffer_extend_and_drop(message):
+    first, second = MessageBuffer(), MessageBuffer()
+    for event in message.events[:10]:
+        first.append(event.SerializeToString())
+    for event in message.events[10:20]:
+        second.append(event.SerializeToString())
+    first.extend(second)
+    first.drop(15)
+    assert len(first) == 5
+    assert list(first.events) == list(message.events[15:20])
+
+
+def test_message_buffer_head(message):
+    buffer, sizes = MessageBuffer(), []
+    for event in message.events:
+        before = buffer.ByteSize()
+        buffer.append(event.SerializeToString())
+        sizes.append(buffer.ByteSize() - before)
+
+    head = buffer.head(sum(sizes[:30]) + 1)
+    assert len(head) == 30 and head.ByteSize() == sum(sizes[:30])
+    assert list(head.events) == list(message.events[:30])
+    assert len(buffer) == 100
+
+    # An event larger than the limit is included on it's own
+    assert len(buffer.head(1)) == 1
+    assert buffer.head(buffer.ByteSize()) is buffer